@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""
+augmentation of whole minibatches in the collate function.
+
+data loader workers only cut out the un-augmented source region of each training crop
+(AugmentWindow, in __getitem__); the collate function BatchAugment then warps
+and color-jitters the whole minibatch, with per-sample random parameters. Warping is done per
+sample with cv2 (warp_region), which is several times faster than a vectorized numpy gather over
+the batch; the numpy version is kept for dtypes cv2 cannot warp. The distribution of transforms is that of affine_augmentation and
+color_augmentation in img_proc.py, plus optional 90 degree rotations.
+"""
+
+import numpy as np
+
+import cv2
+
+import imgaug as ia
+
+import torch
+from torch.utils.data.dataloader import default_collate
+
+from geometric_aug import sample_transform, source_region, warp_region, _translation, _CV2_DTYPES
+from img_proc import numpy_img_to_torch
+
+
+def window_size(crop_size, scale_min=0.6, margin=2):
+    """side of a square window that contains the source region of any rotated and scaled crop"""
+    return int(np.ceil(np.hypot(crop_size[0], crop_size[1]) / scale_min)) + 2 * margin + 2
+
+
+class AugmentWindow(object):
+
+    """
+    Worker side of batched augmentation.
+
+    samples the geometric transform of a training crop, and returns, for each image field,
+    the bounding box of the input pixels the crop is interpolated from (symmetrically reflected
+    at the image border). Without rotation or downscaling, that is little more than the crop
+    itself; only a few samples need a window as large as window_size(). The transform is
+    returned in the fields 'aug_inv' (3x3 map from crop to window coordinates) and 'aug_order'
+    (interpolation order for images).
+    """
+
+    def __init__(self, size):
+        if size is None:
+            raise ValueError('batched augmentation requires a crop size')
+        if not isinstance(size, (list, tuple)):
+            size = (size, size)
+        self.size = tuple(size)
+
+
+    def __call__(self, fields, random_state=None):
+        if random_state is None:
+            random_state = ia.current_random_state()
+
+        arrays = [(k, v) for k, v in fields.items() if isinstance(v, np.ndarray) and v.ndim >= 2]
+        if not arrays:
+            raise ValueError('no image fields to augment')
+        h, w = arrays[0][1].shape[:2]
+
+        params, (out_h, out_w), _, _, inv = sample_transform(random_state, h, w, self.size)
+
+        rows, cols, x0, y0 = source_region(inv, out_h, out_w, h, w)
+
+        result = dict(fields)
+        for k, v in arrays:
+            if v.shape[:2] != (h, w):
+                raise ValueError('field %s has size %s, expected %s' % (k, v.shape[:2], (h, w)))
+            result[k] = v[rows[:, None], cols[None, :]]
+        result['aug_inv'] = _translation(-x0, -y0).dot(inv).astype(np.float32)
+        result['aug_order'] = np.int64(params['order'])
+        return result
+
+
+def pad_stack(windows):
+    """stack windows of different sizes into B x H x W [x C], padding at the bottom and right"""
+    h = max([win.shape[0] for win in windows])
+    w = max([win.shape[1] for win in windows])
+    out = np.zeros((len(windows), h, w) + windows[0].shape[2:], dtype=windows[0].dtype)
+    for i, win in enumerate(windows):
+        out[i, :win.shape[0], :win.shape[1]] = win
+    return out
+
+
+def batch_warp(windows, inv, out_h, out_w, linear):
+    """
+    resample a batch of windows (B x H x W [x C]) to B x out_h x out_w [x C].
+
+    output pixel p of sample b is taken from location inv[b] * p of its window, with bilinear
+    interpolation where linear[b] is true, and nearest neighbor otherwise.
+    """
+    n, sh, sw = windows.shape[:3]
+    if windows.dtype.type in _CV2_DTYPES:
+        return np.stack([warp_region(windows[b], inv[b], out_h, out_w, 1 if linear[b] else 0) for b in range(n)])
+    ys, xs = np.mgrid[0:out_h, 0:out_w].astype(np.float32)
+    sx = inv[:, 0, 0, None, None] * xs + inv[:, 0, 1, None, None] * ys + inv[:, 0, 2, None, None]
+    sy = inv[:, 1, 0, None, None] * xs + inv[:, 1, 1, None, None] * ys + inv[:, 1, 2, None, None]
+    b = np.arange(n)[:, None, None]
+
+    if not np.any(linear):
+        yi = np.clip(np.floor(sy + 0.5).astype(np.intp), 0, sh - 1)
+        xi = np.clip(np.floor(sx + 0.5).astype(np.intp), 0, sw - 1)
+        return windows[b, yi, xi]
+
+    x0 = np.floor(sx)
+    y0 = np.floor(sy)
+    fx = sx - x0
+    fy = sy - y0
+    # nearest neighbor samples: snap the interpolation weights to 0 or 1
+    nearest = ~np.asarray(linear, dtype=bool)
+    fx[nearest] = np.floor(fx[nearest] + 0.5)
+    fy[nearest] = np.floor(fy[nearest] + 0.5)
+
+    x0 = np.clip(x0.astype(np.intp), 0, sw - 1)
+    y0 = np.clip(y0.astype(np.intp), 0, sh - 1)
+    x1 = np.minimum(x0 + 1, sw - 1)
+    y1 = np.minimum(y0 + 1, sh - 1)
+    if windows.ndim == 4:
+        fx = fx[..., None]
+        fy = fy[..., None]
+
+    win = windows.astype(np.float32, copy=False)
+    top = win[b, y0, x0] * (1 - fx) + win[b, y0, x1] * fx
+    bottom = win[b, y1, x0] * (1 - fx) + win[b, y1, x1] * fx
+    out = top * (1 - fy) + bottom * fy
+    if windows.dtype == np.uint8:
+        out = np.clip(np.floor(out + 0.5), 0, 255)
+    return out.astype(windows.dtype)
+
+
+def batch_color_jitter(imgs, random_state, max_add=100):
+    """
+    color_augmentation for a batch of uint8 RGB images (B x H x W x 3), in place.
+
+    per sample, one of six branches is chosen uniformly: add a value in [0, max_add] to one
+    RGB channel, or to one HSV channel. All samples with HSV branches are converted with a
+    single cv2 call in each direction.
+    """
+    n = imgs.shape[0]
+    branch = random_state.randint(0, 6, n)
+    value = random_state.randint(0, max_add + 1, n)
+
+    hsv = np.where(branch < 3)[0]
+    if hsv.size > 0:
+        sub = imgs[hsv]
+        shape = sub.shape
+        # the batch as one tall image
+        sub = cv2.cvtColor(np.ascontiguousarray(sub.reshape(-1, shape[2], 3)), cv2.COLOR_RGB2HSV).reshape(shape)
+        _add_channel(sub, branch[hsv], value[hsv])
+        imgs[hsv] = cv2.cvtColor(sub.reshape(-1, shape[2], 3), cv2.COLOR_HSV2RGB).reshape(shape)
+
+    rgb = np.where(branch >= 3)[0]
+    if rgb.size > 0:
+        sub = imgs[rgb]
+        _add_channel(sub, branch[rgb] - 3, value[rgb])
+        imgs[rgb] = sub
+    return imgs
+
+
+def _add_channel(imgs, channel, value):
+    """add value[b] to channel channel[b] of image b, clipped to uint8"""
+    b = np.arange(imgs.shape[0])
+    v = imgs[b, :, :, channel].astype(np.int16) + value[:, None, None].astype(np.int16)
+    imgs[b, :, :, channel] = np.clip(v, 0, 255).astype(np.uint8)
+
+
+class BatchAugment(object):
+
+    """
+    Collate function for samples from AugmentWindow.
+
+    warps all image fields of the minibatch at once (images with the sampled interpolation
+    order, masks with nearest neighbor), optionally rotates by multiples of 90 degrees,
+    applies color jitter to 3-channel images, and converts to torch tensors.
+
+    args:
+        size: crop size (height, width)
+        p_rot90: probability of an additional rotation by 90, 180, or 270 degrees (square crops only)
+        color: apply color augmentation
+    """
+
+    def __init__(self, size, p_rot90=0.0, color=True):
+        if not isinstance(size, (list, tuple)):
+            size = (size, size)
+        self.size = tuple(size)
+        if p_rot90 > 0 and self.size[0] != self.size[1]:
+            raise ValueError('90 degree rotations require square crops')
+        self.p_rot90 = p_rot90
+        self.color = color
+
+
+    def rot90_matrices(self, n, random_state):
+        """per-sample map from rotated to unrotated crop coordinates"""
+        h, w = self.size
+        k = np.where(random_state.uniform(size=n) < self.p_rot90, random_state.randint(1, 4, n), 0)
+        c = np.array([(w - 1) / 2.0, (h - 1) / 2.0])
+        mats = np.zeros((n, 3, 3))
+        for i in range(n):
+            a = k[i] * np.pi / 2
+            r = np.round([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+            mats[i, :2, :2] = r
+            mats[i, :2, 2] = c - r.dot(c)
+            mats[i, 2, 2] = 1.0
+        return mats
+
+
+    def __call__(self, batch):
+        random_state = ia.current_random_state()
+
+        inv = np.stack([sample.pop('aug_inv') for sample in batch]).astype(np.float64)
+        linear = np.array([sample.pop('aug_order') == 1 for sample in batch])
+        if self.p_rot90 > 0:
+            inv = np.einsum('bij,bjk->bik', inv, self.rot90_matrices(len(batch), random_state))
+
+        keys = [k for k, v in batch[0].items() if isinstance(v, np.ndarray) and v.ndim >= 2]
+        result = default_collate([dict([(k, v) for k, v in sample.items() if k not in keys]) for sample in batch]) \
+            if len(batch[0]) > len(keys) else {}
+
+        out_h, out_w = self.size
+        for k in keys:
+            windows = pad_stack([sample[k] for sample in batch])
+            is_img = windows.ndim == 4 and windows.shape[3] == 3
+            warped = batch_warp(windows, inv, out_h, out_w, linear if is_img else np.zeros(len(batch), dtype=bool))
+            if is_img and self.color and warped.dtype == np.uint8:
+                batch_color_jitter(warped, random_state)
+            result[k] = torch.stack([numpy_img_to_torch(img) for img in warped])
+        return result
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""
+collation into a ring of preallocated shared-memory batch buffers.
+
+with the default collate function, each worker stacks the samples of a batch into newly
+allocated shared-memory tensors, whose handles are sent back to the main process. Here, the
+batch buffers are allocated once, before the workers start: n_slots batches, with one tensor per
+field. Batch k is written into slot k % n_slots directly by the worker that loads it; only the
+slot number is sent back, and the training loop gets views of the slot's buffers.
+
+a slot is reused once the training loop calls recycle(), after optimizer.step(); until then,
+a worker that wants to write into the slot waits. Should the training loop hold all slots (e.g.,
+with gradient accumulation over many batches), the oldest batch is copied out of the ring
+instead of waiting. When an epoch is not run to the end, batches that were loaded ahead but never
+returned keep their slots; the ring is then reallocated before the next epoch.
+
+    ring_loader = make_ring_loader(...)
+    for batch in ring_loader:
+        ...
+        optimizer.step()
+        ring_loader.recycle()
+"""
+
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data.sampler import Sampler
+
+
+def is_scalar(v):
+    """numpy and python scalars (and 0-d arrays) are collated into vectors, like default_collate does"""
+    return not torch.is_tensor(v) and np.ndim(v) == 0
+
+
+def as_tensor(v):
+    """tensor of a sample field (torch tensor or numpy array)"""
+    if torch.is_tensor(v):
+        return v
+    if isinstance(v, np.ndarray):
+        return torch.from_numpy(np.ascontiguousarray(v))
+    raise ValueError('cannot put a field of type %s into a batch buffer' % type(v))
+
+
+def field_buffer(v, batch_size):
+    """shared tensor for the values of a field in a batch: batch_size x size of v"""
+    if is_scalar(v):
+        buf = torch.from_numpy(np.zeros(1, dtype=np.asarray(v).dtype)).new(batch_size)
+    else:
+        t = as_tensor(v)
+        buf = t.new(*((batch_size,) + tuple(t.size())))
+    return buf.zero_().share_memory_()
+
+
+class BatchRing(object):
+
+    """
+    n_slots batch buffers in shared memory, each a dict field -> tensor of batch_size samples.
+
+    args:
+        sample: a sample as returned by the dataset; it determines fields, shapes and types
+    """
+
+    def __init__(self, n_slots, batch_size, sample):
+        self.n_slots = n_slots
+        self.batch_size = batch_size
+        self.sample = sample
+        self.allocate()
+        self.nbytes = sum([t.numel() * t.element_size() for t in self.buffers[0].values()]) * n_slots
+
+
+    def allocate(self):
+        """new buffers and slot semaphores; must be called before the workers are started"""
+        self.buffers = [dict([(k, field_buffer(v, self.batch_size)) for k, v in self.sample.items()])
+                        for _ in range(self.n_slots)]
+        self.free = [multiprocessing.Semaphore(1) for _ in range(self.n_slots)]
+
+
+    def reset(self):
+        """
+        after an interrupted epoch: wake up workers still waiting for a slot (they write into
+        the old buffers), and replace buffers and semaphores, since slots taken by batches
+        that were never returned would not be released.
+        """
+        for sem in self.free:
+            sem.release()
+        self.allocate()
+
+
+    def collate(self, batch):
+        """collate function (runs in the workers): write (slot, sample) pairs into the slot's buffers"""
+        slot = batch[0][0]
+        if len(batch) > self.batch_size:
+            raise ValueError('batch of %d samples does not fit into buffers of %d' % (len(batch), self.batch_size))
+        self.free[slot].acquire()
+        bufs = self.buffers[slot]
+        for i, (_, sample) in enumerate(batch):
+            for k, v in sample.items():
+                if is_scalar(v):
+                    bufs[k][i] = np.asarray(v).item()
+                    continue
+                t = as_tensor(v)
+                if bufs[k][i].size() != t.size():
+                    raise ValueError('field %s has size %s, expected %s (samples must have a fixed size)' % (
+                        k, tuple(t.size()), tuple(bufs[k][i].size())))
+                bufs[k][i].copy_(t)
+        return {'slot': slot, 'n': len(batch)}
+
+
+    def views(self, out):
+        """batch (dict field -> tensor) for the output of collate()"""
+        return dict([(k, t[:out['n']]) for k, t in self.buffers[out['slot']].items()])
+
+
+    def release(self, slot):
+        self.free[slot].release()
+
+
+class SlotDataset(Dataset):
+
+    """dataset wrapper: item (slot, idx) -> (slot, dataset[idx])"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+    def __getitem__(self, item):
+        slot, idx = item
+        return slot, self.dataset[idx]
+
+
+class SlotBatchSampler(Sampler):
+
+    """batch sampler wrapper: tags the indices of batch k with its ring slot, k % n_slots"""
+
+    def __init__(self, batch_sampler, n_slots):
+        self.batch_sampler = batch_sampler
+        self.n_slots = n_slots
+
+
+    def __iter__(self):
+        for k, batch in enumerate(self.batch_sampler):
+            yield [(k % self.n_slots, i) for i in batch]
+
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class RingLoader(object):
+
+    """
+    iterates over the batches of a loader that collates with ring.collate, as views of the ring buffers.
+
+    args:
+        loader: DataLoader (or ThreadDataLoader) over SlotDataset, with a SlotBatchSampler
+    """
+
+    def __init__(self, loader, ring):
+        self.loader = loader
+        self.ring = ring
+        self.batch_sampler = loader.batch_sampler
+        self.held = OrderedDict()
+        self.detached = 0
+        # an epoch is open while it has batches loaded ahead that were not returned yet
+        self.epoch = 0
+        self.open = False
+
+
+    def __len__(self):
+        return len(self.loader)
+
+
+    def recycle(self):
+        """release the slots of all batches returned so far; call after optimizer.step()"""
+        for slot in self.held:
+            self.ring.release(slot)
+        self.held.clear()
+
+
+    def detach(self, slot):
+        """copy a batch out of its slot, and release the slot"""
+        batch = self.held.pop(slot)
+        for k in batch.keys():
+            batch[k] = batch[k].clone()
+        self.ring.release(slot)
+        self.detached += 1
+
+
+    def close(self):
+        """release all slots; if the epoch was interrupted, reallocate the ring"""
+        self.recycle()
+        if self.open:
+            self.ring.reset()
+            self.open = False
+
+
+    def __iter__(self):
+        # the previous epoch may have been abandoned without its iterator being finalized yet
+        self.close()
+        self.epoch += 1
+        epoch = self.epoch
+        self.open = True
+        it = iter(self.loader)
+        try:
+            for k in range(len(self.loader)):
+                slot = k % self.ring.n_slots
+                if slot in self.held:
+                    # the training loop still holds the batch in the slot that batch k is written to
+                    self.detach(slot)
+                out = next(it)
+                batch = self.ring.views(out)
+                self.held[out['slot']] = batch
+                yield batch
+            self.open = False
+        finally:
+            if self.epoch == epoch:
+                self.close()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+throughput of the training augmentation modes, in images per second (single process).
+
+runs NucleusDataset.apply_augment and the collate function of each --augment-mode on
+synthetic images and masks of typical stage1 sizes.
+
+usage:
+    python bench_augment.py --batches 50 --batch-size 16
+"""
+
+import time
+import logging
+
+import configargparse
+import numpy as np
+
+from torch.utils.data.dataloader import default_collate
+
+from dataset import NucleusDataset
+from batch_aug import BatchAugment
+from utils import int_list
+
+
+def make_samples(n, sizes, seed=0):
+    rs = np.random.RandomState(seed)
+    samples = []
+    for i in range(n):
+        h, w = sizes[i % len(sizes)]
+        mask = (rs.uniform(size=(h // 8, w // 8)) < 0.3).astype(np.uint8)
+        mask = np.kron(mask, np.ones((8, 8), dtype=np.uint8))
+        samples.append({'images_prep': rs.randint(0, 256, (h, w, 3)).astype(np.uint8),
+                        'masks_prep_bin': mask[:, :, np.newaxis],
+                        'contours': mask[:, :, np.newaxis].copy()})
+    return samples
+
+
+def bench(mode, samples, crop_size, batch_size, n_batches, p_rot90, color_lut=False):
+    dset = NucleusDataset(dset_type='train', img_size=crop_size, img_size_mode='crop', augment_mode=mode,
+                          color_lut=color_lut)
+    collate = default_collate
+    if mode == 'batched':
+        collate = BatchAugment(crop_size, p_rot90=p_rot90)
+
+    t = time.time()
+    k = 0
+    for _ in range(n_batches):
+        batch = []
+        for _ in range(batch_size):
+            batch.append(dset.apply_augment(dict(samples[k % len(samples)])))
+            k += 1
+        collate(batch)
+    return n_batches * batch_size / (time.time() - t)
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgumentParser(description='benchmark augmentation modes.')
+    parser.add('--modes', default='sequential,crop_first,fused,batched', help='augmentation modes to compare [default: %(default)s]')
+    parser.add('--crop-size', type=int_list, default='192,192', help='training crop size [default: %(default)s]')
+    parser.add('--batch-size', type=int, default=16, help='mini-batch size [default: %(default)s]')
+    parser.add('--batches', type=int, default=50, help='number of batches per mode [default: %(default)s]')
+    parser.add('--images', type=int, default=64, help='number of distinct synthetic images [default: %(default)s]')
+    parser.add('--color-lut', type=int, default=0, help='color augmentation with lookup tables (not used in batched mode) [default: %(default)s]')
+    parser.add('--rot90', type=float, default=0.0, help='probability of 90 degree rotations in batched mode [default: %(default)s]')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    # most frequent image sizes in stage1_train
+    samples = make_samples(args.images, [(256, 256), (256, 320), (520, 696), (360, 360), (1024, 1024)])
+
+    results = []
+    for mode in args.modes.split(','):
+        results.append((mode, bench(mode, samples, args.crop_size, args.batch_size, args.batches, args.rot90,
+                                      args.color_lut > 0)))
+
+    base = results[0][1]
+    for mode, ips in results:
+        print '%-12s %8.1f images/sec  (x%.2f)' % (mode, ips, ips / base)
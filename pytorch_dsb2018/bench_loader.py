@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+throughput of process (torch DataLoader) and thread (loaders.ThreadDataLoader) data loaders,
+in images per second, for the same number of workers.
+
+samples are synthetic images and masks of typical stage1 sizes, augmented as in training.
+
+usage:
+    python bench_loader.py --workers 4 --batches 50 --batch-size 16
+"""
+
+import time
+import logging
+
+import configargparse
+
+from torch.utils.data import Dataset, DataLoader
+
+from dataset import NucleusDataset
+from loaders import ThreadDataLoader
+from bench_augment import make_samples
+from utils import int_list
+
+
+class AugmentedSamples(Dataset):
+
+    def __init__(self, samples, crop_size, augment_mode):
+        self.samples = samples
+        self.dset = NucleusDataset(dset_type='train', img_size=crop_size, img_size_mode='crop',
+                                   augment_mode=augment_mode)
+
+
+    def __len__(self):
+        return len(self.samples)
+
+
+    def __getitem__(self, idx):
+        return self.dset.apply_augment(dict(self.samples[idx]))
+
+
+def bench(loader, n_batches, batch_size):
+    t = time.time()
+    k = 0
+    while k < n_batches:
+        for _ in loader:
+            k += 1
+            if k == n_batches:
+                break
+    return n_batches * batch_size / (time.time() - t)
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgumentParser(description='benchmark process and thread data loaders.')
+    parser.add('--workers', type=int_list, default='1,2,4', help='numbers of workers to compare [default: %(default)s]')
+    parser.add('--crop-size', type=int_list, default='192,192', help='training crop size [default: %(default)s]')
+    parser.add('--augment-mode', default='fused', help='augmentation mode [default: %(default)s]')
+    parser.add('--batch-size', type=int, default=16, help='mini-batch size [default: %(default)s]')
+    parser.add('--batches', type=int, default=50, help='number of batches per loader [default: %(default)s]')
+    parser.add('--images', type=int, default=256, help='number of distinct synthetic images [default: %(default)s]')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    dset = AugmentedSamples(make_samples(args.images, [(256, 256), (256, 320), (520, 696), (360, 360), (1024, 1024)]),
+                            args.crop_size, args.augment_mode)
+
+    for workers in args.workers:
+        proc = DataLoader(dset, batch_size=args.batch_size, shuffle=True, num_workers=workers)
+        thread = ThreadDataLoader(dset, batch_size=args.batch_size, shuffle=True, num_workers=workers)
+        ips_proc = bench(proc, args.batches, args.batch_size)
+        ips_thread = bench(thread, args.batches, args.batch_size)
+        st = thread.stats()
+        print '%2d workers: process %8.1f images/sec, thread %8.1f images/sec (x%.2f); thread wait %.0f%%, ready batches %.1f' % (
+            workers, ips_proc, ips_thread, ips_thread / ips_proc, 100.0 * st['wait_frac'], st['depth_avg'])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+color augmentation with lookup tables, without the per-sample overhead of the imgaug chain.
+
+img_proc.color_augmentation builds each HSV branch from three imgaug augmenters (colorspace
+conversion, channel add, conversion back) inside OneOf and Sequential, sampling their
+parameters one by one. LUTColorAugment draws branch and value once per image, and does the
+channel add as one indexing pass through a 256-entry table; all (max_add + 1) tables are built
+once. HSV branches still convert RGB -> HSV and back with the same cv2 calls imgaug makes (a
+table indexed by RGB value would need 2^24 entries per shift), so the result is exactly that of
+color_augmentation for the same branch and value; the gain is in skipping the augmenter overhead
+and the per-pixel add, about 2x per 192x192 image.
+
+usage (check against the imgaug chain, and time both):
+    python color_lut_aug.py --n 200 --crop-size 192,192
+"""
+
+import numpy as np
+
+import cv2
+
+import imgaug as ia
+
+
+def add_luts(max_add):
+    """tables for adding 0 .. max_add to a uint8 channel, with clipping; row v adds v"""
+    return np.clip(np.arange(256)[np.newaxis, :] + np.arange(max_add + 1)[:, np.newaxis], 0, 255).astype(np.uint8)
+
+
+def add_to_channel(img, channel, lut):
+    out = img.copy()
+    out[:, :, channel] = lut[img[:, :, channel]]
+    return out
+
+
+def color_shift(img, branch, lut):
+    """branch 0-2: add through lut to HSV channel branch; 3-5: to RGB channel branch - 3"""
+    if branch >= 3:
+        return add_to_channel(img, branch - 3, lut)
+    hsv = add_to_channel(cv2.cvtColor(img, cv2.COLOR_RGB2HSV), branch, lut)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+
+
+class LUTColorAugment(ia.augmenters.Augmenter):
+
+    """
+    Lookup-table version of img_proc.color_augmentation.
+
+    one of six branches is chosen uniformly per image: add a value in [0, max_add] to one HSV
+    channel (RGB -> HSV, add, HSV -> RGB), or to one RGB channel.
+    """
+
+    def __init__(self, max_add=100, name=None, deterministic=False, random_state=None):
+        super(LUTColorAugment, self).__init__(name=name, deterministic=deterministic, random_state=random_state)
+        self.max_add = max_add
+        self.luts = add_luts(max_add)
+
+
+    def get_parameters(self):
+        return [self.max_add]
+
+
+    def _augment_images(self, images, random_state, parents, hooks):
+        result = []
+        branches = random_state.randint(0, 6, (len(images),))
+        values = random_state.randint(0, self.max_add + 1, (len(images),))
+        for branch, value, img in zip(branches, values, images):
+            if img.dtype != np.uint8:
+                raise ValueError('color augmentation requires uint8 images, got %s' % img.dtype)
+            result.append(color_shift(img, branch, self.luts[value]))
+        return result
+
+
+    def _augment_keypoints(self, keypoints_on_images, random_state, parents, hooks):
+        return keypoints_on_images
+
+
+if __name__ == '__main__':
+    import time
+
+    import configargparse
+
+    from imgaug import augmenters as iaa
+
+    from img_proc import color_augmentation
+    from utils import int_list
+
+    parser = configargparse.ArgumentParser(description='compare lookup-table and imgaug color augmentation.')
+    parser.add('--n', type=int, default=200, help='number of images [default: %(default)s]')
+    parser.add('--crop-size', type=int_list, default='192,192', help='image size [default: %(default)s]')
+    args = parser.parse_args()
+
+    rs = np.random.RandomState(0)
+    imgs = [rs.randint(0, 256, tuple(args.crop_size) + (3,)).astype(np.uint8) for _ in range(args.n)]
+    luts = add_luts(100)
+
+    # exactness: each branch and value against the imgaug chain it replaces
+    max_diff = 0
+    for branch in range(6):
+        for value in (0, 1, 50, 99, 100):
+            add = iaa.WithChannels(branch % 3, iaa.Add(value))
+            if branch < 3:
+                add = iaa.Sequential([iaa.ChangeColorspace(from_colorspace='RGB', to_colorspace='HSV'), add,
+                                      iaa.ChangeColorspace(from_colorspace='HSV', to_colorspace='RGB')])
+            for img in imgs[:20]:
+                ref = add.augment_image(img)
+                max_diff = max(max_diff, np.abs(ref.astype(int) - color_shift(img, branch, luts[value])).max())
+    print 'max difference to imgaug: %d levels' % max_diff
+
+    for name, aug in (('imgaug', color_augmentation()), ('lut', color_augmentation(lut=True))):
+        t = time.time()
+        for img in imgs:
+            aug.augment_image(img)
+        print '%-6s %.3f ms/image' % (name, 1000.0 * (time.time() - t) / len(imgs))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""columnar storage of variable-sized arrays"""
+
+import os
+import atexit
+import uuid
+
+import numpy as np
+
+
+class ColumnStore(object):
+
+    """
+    Store for per-sample arrays of varying shape, with one contiguous buffer per field.
+
+    For each field, the arrays of all rows are concatenated into a flat buffer; offsets[i]:offsets[i+1]
+    delimits row i, and shapes[i] holds its shape. All arrays of a field must have the same type and
+    number of dimensions; rows can be missing (None). Retrieving a row is a slice and reshape of the
+    buffer, so no Python objects are created per row apart from the returned view.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.buffers = {}
+        self.offsets = {}
+        self.shapes = {}
+        self.shared_files = {}  # field -> backing file, for buffers in shared memory
+
+
+    def add(self, name, arrays):
+        """add a field from a list of n arrays (or None for missing rows)"""
+
+        if len(arrays) != self.n:
+            raise ValueError('field %s: expected %d rows, got %d' % (name, self.n, len(arrays)))
+
+        present = [np.asarray(a) for a in arrays if a is not None]
+        if not present:
+            raise ValueError('field %s: no data' % name)
+        dtype = present[0].dtype
+        ndim = present[0].ndim
+        for a in present:
+            if a.ndim != ndim:
+                raise ValueError('field %s: inconsistent number of dimensions' % name)
+
+        shapes = np.zeros((self.n, ndim), dtype=np.int64)
+        offsets = np.zeros(self.n + 1, dtype=np.int64)
+        for i, a in enumerate(arrays):
+            size = 0
+            if a is not None:
+                a = np.asarray(a)
+                shapes[i] = a.shape
+                size = a.size
+            offsets[i + 1] = offsets[i] + size
+
+        buf = np.empty(offsets[-1], dtype=dtype)
+        for i, a in enumerate(arrays):
+            if a is not None:
+                buf[offsets[i]:offsets[i + 1]] = np.asarray(a, dtype=dtype).ravel()
+
+        self.buffers[name] = buf
+        self.offsets[name] = offsets
+        self.shapes[name] = shapes
+
+
+    def get(self, name, i):
+        """view of row i of a field. 0-dimensional entries are returned as numpy scalars"""
+        buf = self.buffers[name]
+        offsets = self.offsets[name]
+        shape = self.shapes[name][i]
+        if len(shape) == 0:
+            return buf[offsets[i]]
+        return buf[offsets[i]:offsets[i + 1]].reshape(shape)
+
+
+    def __contains__(self, name):
+        return name in self.buffers
+
+
+    def fields(self):
+        return list(self.buffers.keys())
+
+
+    def share(self, shm_dir='/dev/shm'):
+        """
+        move all buffers into read-only memory-mapped files in shm_dir.
+
+        forked data loader workers then map the same physical pages instead of touching (and
+        copying on write) private memory; when pickled, the store only carries the file names,
+        and attaches to the files again when unpickled. The files are removed when the creating
+        process exits.
+        """
+        for name, buf in self.buffers.items():
+            if name in self.shared_files:
+                continue
+            fname = os.path.join(shm_dir, 'dsb_%d_%s_%s.bin' % (os.getpid(), name, uuid.uuid4().hex[:8]))
+            if buf.size > 0:
+                mm = np.memmap(fname, dtype=buf.dtype, mode='w+', shape=buf.shape)
+                mm[:] = buf
+                mm.flush()
+                del mm
+            else:
+                open(fname, 'wb').close()
+            atexit.register(_remove_file, fname, os.getpid())
+            self.shared_files[name] = fname
+            self.buffers[name] = self._attach(fname, buf.dtype, buf.shape)
+
+
+    @staticmethod
+    def _attach(fname, dtype, shape):
+        if shape[0] == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(fname, dtype=dtype, mode='r', shape=shape)
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['buffers'] = dict([(name, ('shared', self.shared_files[name], buf.dtype.str, buf.shape))
+                                 if name in self.shared_files else (name, buf)
+                                 for name, buf in self.buffers.items()])
+        return state
+
+
+    def __setstate__(self, state):
+        buffers = {}
+        for name, buf in state['buffers'].items():
+            if isinstance(buf, tuple) and buf[0] == 'shared':
+                buf = self._attach(buf[1], np.dtype(buf[2]), buf[3])
+            buffers[name] = buf
+        state['buffers'] = buffers
+        self.__dict__.update(state)
+
+
+    @property
+    def nbytes(self):
+        return sum([b.nbytes for b in self.buffers.values()])
+
+
+def _remove_file(fname, owner_pid):
+    if os.getpid() != owner_pid:
+        return
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
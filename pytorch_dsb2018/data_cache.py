@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""on-disk caches for decoded images and label images"""
+
+import os
+import logging
+import pickle
+import hashlib
+
+import numpy as np
+
+from utils import mkdir_p
+from zip_source import split_zip_path
+
+
+def file_signature(paths):
+    """(path, mtime, size) for each file (of the archive, for zip members); used to detect changed source files"""
+    sig = []
+    for p in paths:
+        zp = split_zip_path(p)
+        st = os.stat(zp[0] if zp is not None else p)
+        sig.append((p, st.st_mtime, st.st_size))
+    return sig
+
+
+def array_hash(arr):
+    """content hash of an array, including shape and type"""
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha1()
+    h.update(repr((str(arr.dtype), arr.shape)).encode('utf-8'))
+    h.update(arr.data)
+    return h.hexdigest()
+
+
+def param_key(*parts):
+    """cache key from a tuple of hashes and parameters"""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def save_array(fname, arr):
+    """write a .npy file atomically, so that readers never see partial files"""
+    tmp = '%s.tmp.%d' % (fname, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, np.ascontiguousarray(arr))
+    os.rename(tmp, fname)
+
+
+class DecodedCache(object):
+
+    """
+    Cache of decoded RGB images and (uint16) label images, stored as .npy files.
+
+    layout:
+        <cache_dir>/<stage>/<id>/{image.npy,labels.npy,meta.pkl}
+
+    meta.pkl holds the image size and the signature (path, mtime, size) of all source
+    files; an entry is only valid if the signature of the current source files matches.
+    Arrays are opened memory-mapped and read-only.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+
+    def entry_dir(self, stage, img_id):
+        return os.path.join(self.cache_dir, stage, img_id)
+
+
+    def get(self, stage, img_id, signature, with_labels=True):
+        """return (image, size, labels) or None if missing or stale"""
+        d = self.entry_dir(stage, img_id)
+        try:
+            with open(os.path.join(d, 'meta.pkl'), 'rb') as f:
+                meta = pickle.load(f)
+            if meta['signature'] != signature:
+                self.misses += 1
+                return None
+            img = np.load(os.path.join(d, 'image.npy'), mmap_mode='r')
+            labels = None
+            if with_labels:
+                labels = np.load(os.path.join(d, 'labels.npy'), mmap_mode='r')
+        except (IOError, OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return img, meta['size'], labels
+
+
+    def put(self, stage, img_id, signature, img, size, labels=None):
+        d = self.entry_dir(stage, img_id)
+        mkdir_p(d)
+        meta_file = os.path.join(d, 'meta.pkl')
+        # invalidate first, in case we are interrupted half-way
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+        save_array(os.path.join(d, 'image.npy'), img)
+        if labels is not None:
+            save_array(os.path.join(d, 'labels.npy'), labels)
+        tmp = '%s.tmp.%d' % (meta_file, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump({'signature': signature, 'size': size}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, meta_file)
+
+
+    def log_stats(self):
+        logging.info('decoded cache %s: %d hits, %d misses' % (self.cache_dir, self.hits, self.misses))
+
+
+class PrepCache(object):
+
+    """
+    Content-addressed cache of preprocessing outputs.
+
+    layout:
+        <cache_dir>/prep/<column>/<key[:2]>/<key>.npy
+
+    the key of an entry is derived from the hash of its input arrays and the parameters
+    of the preprocessing step that produced it (see param_key()), so entries never go
+    stale; changing a parameter only invalidates the columns that depend on it.
+    """
+
+    def __init__(self, cache_dir):
+        self.root = os.path.join(cache_dir, 'prep')
+        self.hits = 0
+        self.misses = 0
+
+
+    def path(self, col, key):
+        return os.path.join(self.root, col, key[:2], key + '.npy')
+
+
+    def get(self, col, key):
+        try:
+            arr = np.load(self.path(col, key), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arr
+
+
+    def put(self, col, key, arr):
+        fname = self.path(col, key)
+        mkdir_p(os.path.dirname(fname))
+        save_array(fname, arr)
+
+
+    def log_stats(self):
+        logging.info('preprocessing cache %s: %d hits, %d misses' % (self.root, self.hits, self.misses))
@@ -6,21 +6,65 @@ import pandas as pd
 import numpy as np
 import sys
 import logging
+import time
+import multiprocessing
 from glob import glob
+from collections import OrderedDict, Counter
 
+import torch
 from torch.utils.data import Dataset
 
 from PIL import Image
 
-from skimage.io import imread
+from zip_source import imread_any, find_archive, scan_zip
 
 from sklearn.model_selection import train_test_split as train_test_split_sk
+from sklearn.model_selection import KFold, StratifiedKFold, GroupKFold, GroupShuffleSplit
 
 from tqdm import tqdm
 
+from data_cache import DecodedCache, PrepCache, file_signature, array_hash, param_key
+from utils import parallel_map, LRUCache
+from column_store import ColumnStore
+from manifest import manifest_file, read_manifest
+from geometric_aug import FusedAffine
+from batch_aug import AugmentWindow, window_size
+from image_reader import open_image
+from rle_labels import read_rle_csv, rle_to_labels
+from shards import ShardStore
+from dedup import dhash, image_hash, find_clusters, hash_cache_file, read_hash_cache, write_hash_cache
+
 from img_proc import numpy_img_to_torch, binarize, noop_augmentation, affine_augmentation, color_augmentation, preprocess_img, preprocess_mask, get_contour
 
 
+# preprocessing outputs, grouped by the inputs and parameters they depend on
+PREP_GROUPS = OrderedDict([('image', ('images_prep',)),                                # preprocessed input image
+                           ('mask', ('masks_bin', 'inst_wt')),                           # binarized mask, instance weight
+                           ('mask_prep', ('masks_prep', 'masks_prep_bin', 'contours'))])  # eroded mask, binarized, contours
+
+
+def prep_sample(img, m, groups, params):
+    """
+    compute the preprocessing outputs of the given groups for one image and its label image.
+
+    inst_wt is the (unnormalized) instance weight 1 / (#nuclei + 1), as a one-element array.
+    """
+    sample = {}
+    if 'image' in groups:
+        sample['images_prep'] = preprocess_img(img, params['resize'])
+    if 'mask' in groups:
+        sample['masks_bin'] = binarize(m)
+        sample['inst_wt'] = np.array([1.0 / (m.max() + 1.0)], dtype=np.float32)
+    if 'mask_prep' in groups:
+        prep = preprocess_mask(m, params['dset_type'], params['resize'], params['erosion_size'])
+        prep_bin = binarize(prep)
+        sample['masks_prep'] = prep
+        sample['masks_prep_bin'] = prep_bin
+        # contours on the eroded mask for multi-task
+        sample['contours'] = get_contour(prep_bin)
+    return sample
+
+
 class NucleusDataset(Dataset):
 
     """
@@ -42,13 +86,49 @@ class NucleusDataset(Dataset):
 
     @staticmethod
     def read_and_stack(in_img_list):
-        return np.sum(np.stack([i * (imread(c_img) > 0)
-                                for i, c_img in enumerate(in_img_list, 1)], 0), 0)
+        """
+        assemble a label image from one binary mask file per nucleus.
+
+        masks are painted one at a time into a single preallocated label image, so peak memory
+        is O(H x W) regardless of the number of masks. Labels are numbered in file order; where
+        masks overlap, the later mask wins.
+        """
+        dtype = np.uint16 if len(in_img_list) <= np.iinfo(np.uint16).max else np.int32
+        labels = None
+        overlap = 0
+        for i, c_img in enumerate(in_img_list, 1):
+            m = imread_any(c_img) > 0
+            if m.ndim == 3:
+                m = m.any(axis=2)
+            if labels is None:
+                labels = np.zeros(m.shape, dtype=dtype)
+            elif m.shape != labels.shape:
+                raise ValueError('mask %s has shape %s, expected %s' % (c_img, m.shape, labels.shape))
+            overlap += np.count_nonzero(labels[m])
+            labels[m] = i
+        if overlap > 0:
+            logging.warning('%d overlapping mask pixels in %s' % (overlap, os.path.dirname(in_img_list[0])))
+        return labels
+
+    @staticmethod
+    def read_image(in_img_list, window=None):
+        """
+        decode an image (or a window (top, left, height, width) of it) as RGB; see image_reader.py
+        for the supported formats. Returns the image and the (width, height) of the full image.
+        """
+        reader = open_image(in_img_list[0])
+        try:
+            return reader.read(window), reader.size
+        finally:
+            reader.close()
 
     @staticmethod
-    def read_image(in_img_list):
-        img = Image.open(in_img_list[0])
-        return np.array(img.convert('RGB')), img.size
+    def read_image_size(in_img_list):
+        # only reads the header
+        reader = open_image(in_img_list[0])
+        size = reader.size
+        reader.close()
+        return size
 
 
     @property
@@ -66,25 +146,40 @@ class NucleusDataset(Dataset):
 
         self._dset_type = value
         self.is_preprocessed = False
+        if getattr(self, 'sample_cache', None) is not None:
+            self.sample_cache.clear()
 
         if value == 'train':
             sz = None
             if self.img_size is not None and self.img_size_mode == 'crop':
                 sz = self.img_size
-            self.augment = affine_augmentation(sz)
-            self.augment_color = color_augmentation()
+            if self.augment_mode == 'fused':
+                self.augment = FusedAffine(sz)
+            elif self.augment_mode == 'batched':
+                # resized images are augmented at full size
+                self.augment = AugmentWindow(sz if sz is not None else self.img_size)
+            else:
+                self.augment = affine_augmentation(sz, crop_first=(self.augment_mode == 'crop_first'))
+            self.augment_color = color_augmentation(lut=self.color_lut)
         else:
             self.augment = noop_augmentation()
             self.augment_color = noop_augmentation()
 
 
-    def __init__(self, root_dir=None, stage_name=None, group_name=None, dset_type='train', img_size=None, img_size_mode=None):
+    def __init__(self, root_dir=None, stage_name=None, group_name=None, dset_type='train', img_size=None, img_size_mode=None, cache_dir=None, load_workers=1, lazy=False, lazy_cache_bytes=1024**3, erosion_size=2, manifest=None, augment_mode='sequential', color_lut=False, max_decode_pixels=None, labels_csv=None, shards=None, archive=None):
         """
         Read all images and masks into memory.
 
+        In lazy mode, only the paths (and image sizes) are read; images and masks are decoded and
+        preprocessed on demand in __getitem__, and kept in a size-bounded LRU cache.
+
         directory structure is assumed to be:
             <root>/<stage>_<train/test>/{images,masks}/*png
 
+        if a manifest (see manifest.py) is present, it is used instead of walking the directory tree.
+        if the directory is missing, but the zip archive <root>/<stage>_<group>.zip is present, images
+        and masks are read from the archive, without extracting it (see zip_source.py).
+
         args:
             root_dir (string): directory with all the images.
             stage_name (string): stage of data
@@ -93,6 +188,24 @@ class NucleusDataset(Dataset):
             img_size (int pair): desired size of images. For minibatches > 1, sizes must agree.
             img_size_mode (string): one of 'resize', 'crop', or 'keep'. Resizing is done during initial preparation.
                                     cropping is part of augmentation pipeline.
+            cache_dir (string): if given, decoded images and label images are cached here as memory-mapped
+                                .npy files. Entries are rebuilt only if the source files have changed.
+            load_workers (int): number of processes for decoding images and masks.
+            lazy (bool): decode and preprocess samples on demand.
+            lazy_cache_bytes (int): in lazy mode, maximum size of decoded samples to keep in memory (per process).
+            erosion_size (int): radius for eroding training masks.
+            manifest (string): manifest file, which must exist [default: <root>/<stage>_<group>_manifest.csv, if it exists]
+            augment_mode (string): 'sequential' applies the geometric augmentations to the full image, then crops;
+                                   'crop_first' only warps the region that ends up in the crop;
+                                   'fused' is crop-first, and transforms all return_fields in one pass;
+                                   'batched' returns un-augmented windows, to be augmented by batch_aug.BatchAugment.
+            color_lut (bool): color augmentation with color_lut_aug.LUTColorAugment (channel add through a lookup table; HSV branches still convert colorspaces).
+            max_decode_pixels (int): in lazy mode, training images with more pixels are not decoded whole;
+                                     instead, a random window containing a (cropped) training sample is read.
+            labels_csv (string): run-length encoded ground truth (columns ImageId, EncodedPixels, see rle_labels.py),
+                                 used instead of the mask files; the masks directories are not read.
+            shards (string): directory of packed shards (see shards.py), read instead of root_dir.
+            archive (string): zip archive to read instead of the directory tree or the manifest.
         """
 
         self.root_dir = root_dir
@@ -105,16 +218,142 @@ class NucleusDataset(Dataset):
                 img_size_mode = 'crop'
         self.img_size_mode = img_size_mode
 
+        if augment_mode not in ('sequential', 'crop_first', 'fused', 'batched'):
+            raise ValueError('invalid augmentation mode: %s' % augment_mode)
+        self.augment_mode = augment_mode
+        self.color_lut = color_lut
+        self.max_decode_pixels = max_decode_pixels
+        self.labels_csv = labels_csv
+        self.shard_store = None
+        self.prerendered = None
+        self.live_fraction = 1.0
+        self.item_time = None
+        self.item_count = None
+        self.tensor_cache = None
+        self.tensor_cache_fields = None
+
         self.dset_type = dset_type
         self.is_preprocessed = False
+        self.load_timings = {}
+
+        self.cache_dir = cache_dir
+        self.load_workers = load_workers
+        self.erosion_size = erosion_size
+        self.lazy = lazy
+        self.lazy_cache_bytes = lazy_cache_bytes
+        self.decoded_cache = None
+        self.prep_cache = None
+        if cache_dir is not None:
+            self.decoded_cache = DecodedCache(cache_dir)
+            self.prep_cache = PrepCache(cache_dir)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.store = None
+        self.sample_cache = None
+        if lazy:
+            self.sample_cache = LRUCache(lazy_cache_bytes)
+
+        if shards is not None:
+            self.load_shards(shards)
+            return
 
         if root_dir is None:
             return
 
-        p = os.path.join(root_dir, stage_name + '_*', '*', '*', '*')
+        if manifest is None:
+            manifest = manifest_file(root_dir, stage_name, group_name)
+        elif not os.path.isfile(manifest):
+            # only the default location is optional
+            raise ValueError('manifest %s does not exist' % manifest)
+        if archive is None and not os.path.isfile(manifest):
+            archive = find_archive(root_dir, stage_name, group_name)
+        if archive is not None:
+            t = time.time()
+            data_df = scan_zip(archive, stage_name, with_masks=(self.dset_type != 'test' and labels_csv is None))
+            self.load_timings['glob'] = time.time() - t
+            logging.info('found %d images in archive %s' % (len(data_df), archive))
+        elif os.path.isfile(manifest):
+            t = time.time()
+            data_df = read_manifest(manifest, root_dir, with_masks=(self.dset_type != 'test' and labels_csv is None))
+            self.load_timings['manifest'] = time.time() - t
+            logging.info('read %d images from manifest %s' % (len(data_df), manifest))
+        else:
+            data_df = self.scan_files(root_dir, stage_name, group_name)
+        if labels_csv is not None and self.dset_type != 'test':
+            self.attach_rle_labels(data_df, labels_csv)
+
+        if lazy:
+            if 'size' not in data_df:
+                # the manifest has the image sizes already
+                t = time.time()
+                data_df['size'] = parallel_map(_read_image_size, data_df['images'].tolist(), load_workers)
+                self.load_timings['images'] = time.time() - t
+        else:
+            self.read_data(data_df, self.decoded_cache, load_workers)
+        self.data_df = data_df
+        self.rows = np.arange(len(data_df))
+        self.log_load_timings()
+
+
+    def log_load_timings(self):
+        logging.info('load timings: %s' % ', '.join(
+            ['%s %.1fs' % (k, self.load_timings[k]) for k in ('manifest', 'shards', 'glob', 'group', 'labels', 'cache', 'images', 'masks')
+             if k in self.load_timings]))
+        logging.debug('done reading data')
+
+
+    def load_shards(self, shards):
+        """
+        read the index of packed shards. Unless in lazy mode, images and label images are
+        memory-mapped from the shards, instead of decoded.
+        """
+        t = time.time()
+        self.shard_store = ShardStore(shards)
+        if self.dset_type != 'test' and not self.shard_store.has_labels:
+            raise ValueError('shards in %s have no label images' % shards)
+        data_df = self.shard_store.data_df()
+        self.load_timings['shards'] = time.time() - t
+        logging.info('read %d images from shards %s' % (len(data_df), shards))
+
+        if not self.lazy:
+            t = time.time()
+            data_df['images'] = [self.shard_store.image(r) for r in range(len(data_df))]
+            if self.dset_type != 'test':
+                data_df['masks'] = [self.shard_store.labels(r) for r in range(len(data_df))]
+            self.load_timings['images'] = time.time() - t
+        self.data_df = data_df
+        self.rows = np.arange(len(data_df))
+        self.log_load_timings()
+
+
+    def shard_ids(self):
+        """shard of each row of this dataset (None if not read from shards)"""
+        if self.shard_store is None:
+            return None
+        return [self.get_field('shard', i) for i in range(len(self))]
+
+
+    def attach_rle_labels(self, data_df, labels_csv):
+        """set the masks column to the run-length encodings of each image"""
+        t = time.time()
+        rles = read_rle_csv(labels_csv)
+        missing = [img_id for img_id in data_df['id'] if img_id not in rles]
+        if missing:
+            logging.warning('%d images without labels in %s, e.g. %s' % (len(missing), labels_csv, missing[0]))
+        data_df['masks'] = [rles.get(img_id, []) for img_id in data_df['id']]
+        self.load_timings['labels'] = time.time() - t
+
+
+    def scan_files(self, root_dir, stage_name, group_name):
+        """find all images and masks by walking the directory tree"""
+
+        t = time.time()
+        # with run-length encoded labels, the mask files are not needed
+        p = os.path.join(root_dir, stage_name + '_*', '*', 'images' if self.labels_csv is not None else '*', '*')
         all_images = glob(p)
+        self.load_timings['glob'] = time.time() - t
         if len(all_images) == 0:
             raise ValueError("Failed to find any images :( [%s]" % p)
+        t = time.time()
         img_df = pd.DataFrame({'path': all_images})
 
         def img_id(in_path): return in_path.split('/')[-3]
@@ -130,101 +369,393 @@ class NucleusDataset(Dataset):
         img_df['stage'] = img_df['path'].map(img_stage)
         self.img_df = img_df
 
+        # a single groupby instead of one query per image
         data_df = img_df.query('group=="%s"' % group_name)
-        data_rows = []
-        group_cols = ['stage', 'id']
-        for n_group, n_rows in data_df.groupby(group_cols):
-            c_row = {
-                col_name: col_value for col_name,
-                col_value in zip(
-                    group_cols,
-                    n_group)}
-            c_row['images'] = n_rows.query('type == "images"')[
-                'path'].values.tolist()
-            if self.dset_type != 'test':
-                c_row['masks'] = n_rows.query('type == "masks"')[
-                    'path'].values.tolist()
-            data_rows += [c_row]
-        data_df = pd.DataFrame(data_rows)
-
-        logging.debug('reading images')
-        ret = data_df['images'].map(self.read_image)
-        (data_df['images'], data_df['size']) = (
-            [x[i] for x in ret] for i in range(2))
-
-        if self.dset_type != 'test':
-            logging.debug('reading masks')
-            data_df['masks'] = data_df['masks'].map(
-                self.read_and_stack).map(
-                    lambda x: x.astype(np.uint8))
+        paths = data_df.groupby(['stage', 'id', 'type'])['path'].apply(list)
+        data_rows = OrderedDict()
+        for (stage, n_id, n_type), n_paths in paths.items():
+            c_row = data_rows.setdefault((stage, n_id), {'stage': stage, 'id': n_id, 'images': [], 'masks': []})
+            c_row[n_type] = n_paths
+        data_df = pd.DataFrame(list(data_rows.values()), columns=['stage', 'id', 'images', 'masks'])
+        if self.dset_type == 'test':
+            del data_df['masks']
 
-        self.data_df = data_df
+        self.load_timings['group'] = time.time() - t
+        return data_df
 
-        logging.debug('done reading data')
 
+    def read_data(self, data_df, cache=None, load_workers=1):
+        """
+        decode images and masks, optionally going through the on-disk cache.
 
-    def preprocess(self):
+        decoding of cache misses is spread over load_workers processes; results are
+        stored back in data_df in the original row order.
+        """
+
+        with_masks = self.dset_type != 'test'
+        n = len(data_df)
+        images, sizes, masks = [None] * n, [None] * n, [None] * n
+        sigs = [None] * n
+
+        todo = range(n)
+        if cache is not None:
+            t = time.time()
+            todo = []
+            for i in range(n):
+                paths = list(data_df['images'].iloc[i])
+                if with_masks:
+                    paths += self.label_files(data_df['masks'].iloc[i])
+                sigs[i] = file_signature(paths)
+                entry = cache.get(data_df['stage'].iloc[i], data_df['id'].iloc[i], sigs[i], with_labels=with_masks)
+                if entry is None:
+                    todo.append(i)
+                else:
+                    images[i], sizes[i], masks[i] = entry
+            cache.log_stats()
+            self.load_timings['cache'] = time.time() - t
+
+        t = time.time()
+        logging.debug('reading %d images' % len(todo))
+        ret = parallel_map(_read_image, [data_df['images'].iloc[i] for i in todo], load_workers)
+        for i, (img, size) in zip(todo, ret):
+            images[i], sizes[i] = img, size
+        self.load_timings['images'] = time.time() - t
+
+        if with_masks:
+            t = time.time()
+            logging.debug('reading %d masks' % len(todo))
+            if self.labels_csv is not None:
+                # decoding is cheap compared to sending the label images back from worker processes
+                for i in todo:
+                    masks[i] = self.read_labels(data_df['masks'].iloc[i], sizes[i])
+            else:
+                ret = parallel_map(_read_and_stack, [data_df['masks'].iloc[i] for i in todo], load_workers)
+                for i, labels in zip(todo, ret):
+                    masks[i] = labels
+            self.load_timings['masks'] = time.time() - t
+
+        if cache is not None:
+            for i in todo:
+                cache.put(data_df['stage'].iloc[i], data_df['id'].iloc[i], sigs[i], images[i], sizes[i],
+                          masks[i] if with_masks else None)
+
+        data_df['images'] = images
+        data_df['size'] = sizes
+        if with_masks:
+            data_df['masks'] = masks
 
-        imgs_prep = []       # preprocessed input images
-        masks_bin = []       # binarized masks
-        masks_prep = []      # preprocesed masks
-        masks_prep_bin = []  # binarized preprocessed masks
-        contours = []        # contours on the eroded mask for multi-task
-        inst_wt = []         # instance weights, 1 / (#nuclei + 1), used as instance weight
 
+    def label_files(self, masks):
+        """files the label image of a row is decoded from, for cache signatures"""
+        if self.labels_csv is not None:
+            return [self.labels_csv]
+        return list(masks)
+
+
+    def read_labels(self, masks, size):
+        """label image from the masks field of a row: mask files, or run-length encodings if labels_csv is set"""
+        if self.labels_csv is not None:
+            return rle_to_labels(masks, (size[1], size[0]))
+        return self.read_and_stack(masks)
+
+
+    def prep_params(self):
+        """parameters of the preprocessing steps"""
         sz = None
         if self.img_size is not None and self.img_size_mode == 'resize':
-            sz = self.img_size
-
-        for i in tqdm(range(len(self.data_df)), desc='prep ' + self.dset_type):
-
-            img = self.data_df['images'].iloc[i]
-            imgs_prep.append(preprocess_img(img, sz))
-
-            if (self.dset_type != 'test'):
-                m = self.data_df['masks'].iloc[i]
-                prep = preprocess_mask(m, self.dset_type, sz)
-
-                masks_prep.append(prep)
-                masks_bin.append(binarize(m))
-                prep_bin = binarize(prep)
-                masks_prep_bin.append(prep_bin)
-                contours.append(get_contour(prep_bin))
-                w = (1.0 / (m.flatten().max() + 1.0)).astype(np.float32)
-                inst_wt.append(w)
-
-        # for some reason, the following (which is recommended) gives an error:
-        # self.data_df.loc[:, 'imgs_prep'] = imgs_prep
-        # the following "only" gives a warning:
-        self.data_df['images_prep'] = imgs_prep
-        if masks_bin:
-            self.data_df['masks_bin'] = masks_bin
-        if masks_prep:
-            self.data_df['masks_prep'] = masks_prep
-        if masks_prep_bin:
-            self.data_df['masks_prep_bin'] = masks_prep_bin
-        if contours:
-            self.data_df['contours'] = contours
-
-        if inst_wt:
-            # normalize!
-            inst_wt = inst_wt / np.mean(inst_wt)
-            self.data_df['inst_wt'] = inst_wt
+            sz = tuple(self.img_size)
+        return {'dset_type': self.dset_type, 'resize': sz, 'erosion_size': self.erosion_size}
+
+
+    def prep_sample(self, img, m=None):
+        """preprocess one image and (optionally) its label image; returns a dict of fields"""
+        groups = PREP_GROUPS.keys() if m is not None else ['image']
+        return prep_sample(img, m, groups, self.prep_params())
+
+
+    def prep_keys(self, img, m, params):
+        """
+        cache key for each preprocessing group, from the content hash of the inputs and the
+        parameters the group depends on. erosion and resizing of masks only apply to training.
+        """
+        keys = {'image': param_key(array_hash(img), params['resize'])}
+        if m is not None:
+            m_hash = array_hash(m)
+            keys['mask'] = param_key(m_hash)
+            if params['dset_type'] == 'train':
+                keys['mask_prep'] = param_key(m_hash, 'train', params['resize'], params['erosion_size'])
+            else:
+                keys['mask_prep'] = param_key(m_hash)
+        return keys
+
+
+    def preprocess(self):
+        """
+        compute the preprocessed fields of all rows of this dataset, and put them in a column store.
+
+        the store is aligned with the rows of data_df, which can be shared with other datasets.
+        """
+
+        has_masks = self.dset_type != 'test' and ('masks' in self.data_df.columns or self.shard_store is not None)
+        self.store = ColumnStore(len(self.data_df))
+
+        if self.lazy:
+            # samples are preprocessed on demand; only the instance weights are needed up front.
+            # the number of nuclei is the number of mask files (or recorded in the shard index).
+            if has_masks:
+                if self.shard_store is not None:
+                    n_labels = [self.get_field('n_labels', i) for i in range(len(self))]
+                else:
+                    n_labels = [len(self.get_field('masks', i)) for i in range(len(self))]
+                inst_wt = np.array([1.0 / (n + 1.0) for n in n_labels], dtype=np.float32)
+                self.add_column('inst_wt', inst_wt / np.mean(inst_wt))
+            self.is_preprocessed = True
+            return
+
+        params = self.prep_params()
+        groups = PREP_GROUPS.keys() if has_masks else ['image']
+        samples = [{} for _ in range(len(self))]
+        keys = [None] * len(self)
+
+        # look up the cache, and collect the groups that need to be recomputed
+        jobs, job_rows = [], []
+        for i in range(len(self)):
+            img = self.get_field('images', i)
+            m = self.get_field('masks', i) if has_masks else None
+            todo = groups
+            if self.prep_cache is not None:
+                keys[i] = self.prep_keys(img, m, params)
+                todo = []
+                for g in groups:
+                    cached = [self.prep_cache.get(col, keys[i][g]) for col in PREP_GROUPS[g]]
+                    if any([c is None for c in cached]):
+                        todo.append(g)
+                    else:
+                        samples[i].update(zip(PREP_GROUPS[g], cached))
+            if todo:
+                jobs.append((img, m, todo, params))
+                job_rows.append(i)
+
+        if self.prep_cache is not None:
+            self.prep_cache.log_stats()
+
+        t = time.time()
+        logging.info('prep %s: preprocessing %d of %d images' % (self.dset_type, len(jobs), len(self)))
+        ret = parallel_map(_prep_job, jobs, self.load_workers)
+        for i, (job, sample) in zip(job_rows, zip(jobs, ret)):
+            samples[i].update(sample)
+            if self.prep_cache is not None:
+                for g in job[2]:
+                    for col in PREP_GROUPS[g]:
+                        self.prep_cache.put(col, keys[i][g], sample[col])
+        self.load_timings['prep_' + self.dset_type] = time.time() - t
+
+        for g in groups:
+            for k in PREP_GROUPS[g]:
+                v = [samples[i][k] for i in range(len(self))]
+                if k == 'inst_wt':
+                    # normalize!
+                    v = np.array([w[0] for w in v], dtype=np.float32)
+                    v = v / np.mean(v)
+                self.add_column(k, v)
 
         self.is_preprocessed = True
 
 
+    def add_column(self, name, values):
+        """add a field to the column store, one value per row of this dataset"""
+        arrays = [None] * self.store.n
+        for r, v in zip(self.rows, values):
+            arrays[r] = v
+        self.store.add(name, arrays)
+
+
+    def share_memory(self, shm_dir='/dev/shm'):
+        """
+        move the preprocessed fields into shared memory, so that data loader workers attach to
+        them instead of copying them; see ColumnStore.share().
+        """
+        if not self.is_preprocessed:
+            raise ValueError('data has not been preprocessed yet')
+        self.store.share(shm_dir)
+        logging.info('%s: %.1f MB of preprocessed data in shared memory' % (self.dset_type, self.store.nbytes / 1024.0**2))
+
+
+    def get_field(self, name, idx):
+        """value of a field for row idx of this dataset, from the column store or from data_df"""
+        if self.store is not None and name in self.store:
+            return self.store.get(name, self.rows[idx])
+        return self.data_df[name].iat[self.rows[idx]]
+
+
+    def image_sizes(self, field='images_prep'):
+        """(height, width) of a preprocessed image field, for all rows"""
+        if self.store is not None and field in self.store:
+            return [tuple(self.store.shapes[field][r][:2]) for r in self.rows]
+        resize = self.prep_params()['resize']
+        if resize is not None:
+            return [resize] * len(self)
+        return [(sz[1], sz[0]) for sz in [self.get_field('size', i) for i in range(len(self))]]
+
+
+    def decode_row(self, idx):
+        """decode image and label image (if available) of row idx, going through the decoded cache if set"""
+
+        if self.shard_store is not None:
+            # the index rows are the data_df rows
+            m = None
+            if self.dset_type != 'test':
+                m = self.shard_store.labels(self.rows[idx])
+            return self.shard_store.image(self.rows[idx]), m
+
+        img_paths = self.get_field('images', idx)
+        mask_paths = None
+        if self.dset_type != 'test' and 'masks' in self.data_df.columns:
+            mask_paths = self.get_field('masks', idx)
+
+        if self.decoded_cache is not None:
+            stage, img_id = self.get_field('stage', idx), self.get_field('id', idx)
+            sig = file_signature(list(img_paths) + (self.label_files(mask_paths) if mask_paths is not None else []))
+            entry = self.decoded_cache.get(stage, img_id, sig, with_labels=mask_paths is not None)
+            if entry is not None:
+                return entry[0], entry[2]
+
+        img, size = self.read_image(img_paths)
+        m = None
+        if mask_paths is not None:
+            m = self.read_labels(mask_paths, size)
+        if self.decoded_cache is not None:
+            self.decoded_cache.put(stage, img_id, sig, img, size, m)
+        return img, m
+
+
+    def read_window(self, idx, window):
+        """
+        image and label image (if available) of row idx, restricted to window (top, left, height, width).
+
+        only the window of the image is decoded (for memory-mapped and tiled formats, see image_reader.py).
+        label images are decoded whole, unless the label image is in the decoded cache, which is memory-mapped.
+        """
+        top, left, height, width = window
+        if self.shard_store is not None:
+            m = None
+            if self.dset_type != 'test':
+                m = np.array(self.shard_store.labels(self.rows[idx], window))
+            return np.array(self.shard_store.image(self.rows[idx], window)), m
+
+        img, _ = self.read_image(self.get_field('images', idx), window)
+
+        m = None
+        if self.dset_type != 'test' and 'masks' in self.data_df.columns:
+            mask_paths = self.get_field('masks', idx)
+            entry = None
+            if self.decoded_cache is not None:
+                sig = file_signature(list(self.get_field('images', idx)) + self.label_files(mask_paths))
+                entry = self.decoded_cache.get(self.get_field('stage', idx), self.get_field('id', idx), sig)
+            m = entry[2] if entry is not None else self.read_labels(mask_paths, self.get_field('size', idx))
+            m = np.array(m[top:top + height, left:left + width])
+        return img, m
+
+
+    def load_window_sample(self, idx):
+        """
+        in lazy mode, the (unaugmented) return_fields of a random window of a large training image.
+
+        the window is large enough to contain the source region of any augmented training crop.
+        """
+        w, h = self.get_field('size', idx)
+        win = window_size(self.img_size)
+        win_h, win_w = min(win, h), min(win, w)
+        top = np.random.randint(0, h - win_h + 1)
+        left = np.random.randint(0, w - win_w + 1)
+        img, m = self.read_window(idx, (top, left, win_h, win_w))
+
+        prep = self.prep_sample(img, m)
+        prep['images'] = img
+        if m is not None:
+            prep['masks'] = m
+        sample = dict([(k, prep[k]) for k in self.return_fields if k in prep])
+        for k in self.return_fields:
+            if k not in sample or k == 'inst_wt':
+                sample[k] = self.get_field(k, idx)
+        return sample
+
+
+    def load_sample(self, idx):
+        """in lazy mode, return the (unaugmented) return_fields of row idx"""
+
+        if (self.max_decode_pixels is not None and self.dset_type == 'train' and self.img_size is not None
+                and self.img_size_mode == 'crop'):
+            w, h = self.get_field('size', idx)
+            if w * h > self.max_decode_pixels:
+                # not cached: each call reads a different window
+                return self.load_window_sample(idx)
+
+        key = (self.get_field('stage', idx), self.get_field('id', idx), tuple(self.return_fields))
+        sample = self.sample_cache.get(key)
+        if sample is None:
+            img, m = self.decode_row(idx)
+            prep = self.prep_sample(img, m)
+            prep['images'] = img
+            if m is not None:
+                prep['masks'] = m
+            sample = dict([(k, prep[k]) for k in self.return_fields if k in prep])
+            nbytes = sum([v.nbytes for v in sample.values() if isinstance(v, np.ndarray)])
+            self.sample_cache.put(key, sample, nbytes)
+
+        sample = dict(sample)
+        for k in self.return_fields:
+            # normalized instance weights are computed over the whole dataset
+            if k not in sample or k == 'inst_wt':
+                sample[k] = self.get_field(k, idx)
+        return sample
+
+
+    def use_prerendered(self, store, live_fraction=0.0):
+        """
+        read augmented training samples from a prerender_augment.PrerenderedStore; a fraction
+        live_fraction of the samples (and images that were not pre-rendered) is augmented live.
+        """
+        if self.augment_mode == 'batched':
+            raise ValueError('pre-rendered samples cannot be used with batched augmentation')
+        if self.img_size is not None and store.crop_size is not None and tuple(store.crop_size) != tuple(self.img_size):
+            raise ValueError('pre-rendered crops have size %s, expected %s' % (store.crop_size, tuple(self.img_size)))
+        self.prerendered = store
+        self.live_fraction = live_fraction
+        logging.info('using %d epochs of pre-rendered samples from %s, %.0f%% live' % (
+            store.epochs, store.out_dir, 100.0 * live_fraction))
+
+
+    def cache_stats(self):
+        """
+        hit/miss/eviction counters of the lazy sample cache, summed over data loader workers;
+        items and bytes are those of the cache in the calling (main) process only
+        """
+        if self.sample_cache is None:
+            return {}
+        return self.sample_cache.stats()
+
+
     def apply_augment(self, cols):
-        trans_det = self.augment.to_deterministic()
+        if isinstance(self.augment, AugmentWindow):
+            # augmented in the collate function
+            return self.augment(cols)
+
         trans_det_color = self.augment_color.to_deterministic()
+        if isinstance(self.augment, FusedAffine):
+            # same geometric transform for all fields, in one pass
+            cols = self.augment(cols)
+            trans_geom = lambda img: img
+        else:
+            trans_geom = self.augment.to_deterministic().augment_image
 
         def trans_if_img(img):
             if isinstance(img, np.ndarray):
-                img = trans_det.augment_image(img)
+                img = trans_geom(img)
                 if len(
                         img.shape) == 3 and img.shape[2] == 3:  # exclude the mask from color transformations
                     img = trans_det_color.augment_image(img)
-                return numpy_img_to_torch(trans_det.augment_image(img))
+                return numpy_img_to_torch(img)
             else:
                 # if you want to return something else than an image
                 return img
@@ -233,10 +764,84 @@ class NucleusDataset(Dataset):
 
 
     def __len__(self):
-        return self.data_df.shape[0]
+        return len(self.rows)
+
+
+    def enable_timing(self):
+        """
+        record the time spent in __getitem__ for each row. The totals are in shared memory,
+        so that they include the work of forked data loader workers.
+        """
+        self.item_time = multiprocessing.Array('d', len(self), lock=False)
+        self.item_count = multiprocessing.Array('l', len(self), lock=False)
+
+
+    def busy_time(self):
+        """total time spent in __getitem__ since enable_timing()"""
+        if self.item_time is None:
+            return 0.0
+        return sum(self.item_time[:])
+
+
+    def item_costs(self):
+        """
+        estimated time of __getitem__ for each row: the measured mean where available; otherwise
+        proportional to the number of pixels, scaled by the median measured time per pixel.
+        """
+        pixels = np.array([w * h for w, h in [self.get_field('size', i) for i in range(len(self))]], dtype=np.float64)
+        if self.item_time is None:
+            return pixels
+        counts = np.array(self.item_count[:], dtype=np.float64)
+        measured = counts > 0
+        if not measured.any():
+            return pixels
+        mean_time = np.array(self.item_time[:]) / np.maximum(counts, 1)
+        per_pixel = np.median(mean_time[measured] / pixels[measured])
+        return np.where(measured, mean_time, per_pixel * pixels)
+
+
+    def cache_tensors(self, max_bytes=None):
+        """
+        for validation sets: compute the return_fields of all rows once, as the torch tensors that
+        __getitem__ returns, and serve them from memory afterwards. The no-op augmentation, the
+        conversion to torch and the copy are then done once instead of in every validation pass.
+
+        returns False (and keeps no cache) if the tensors would take more than max_bytes.
+        """
+        if self.dset_type != 'valid':
+            raise ValueError('only validation samples can be cached, not %s' % self.dset_type)
+        if not self.is_preprocessed or not hasattr(self, 'return_fields'):
+            raise ValueError('data has to be preprocessed and return_fields set before caching')
+
+        t = time.time()
+        fields = tuple(self.return_fields)
+        cache, nbytes = [], 0
+        for idx in range(len(self)):
+            sample = self.apply_augment(dict([(k, self.get_field(k, idx)) for k in fields]))
+            nbytes += sum([v.numel() * v.element_size() for v in sample.values() if torch.is_tensor(v)])
+            if max_bytes is not None and nbytes > max_bytes:
+                logging.warning('validation tensors exceed %.0f MB, not cached' % (max_bytes / 1024.0**2))
+                return False
+            cache.append(sample)
+        self.tensor_cache, self.tensor_cache_fields = cache, fields
+        logging.info('cached %d validation samples as tensors: %.1f MB, %.1fs' % (
+            len(cache), nbytes / 1024.0**2, time.time() - t))
+        return True
 
 
     def __getitem__(self, idx):
+        if self.tensor_cache is not None and self.tensor_cache_fields == tuple(self.return_fields):
+            return self.tensor_cache[idx]
+        if self.item_time is None:
+            return self.load_item(idx)
+        t = time.time()
+        sample = self.load_item(idx)
+        self.item_time[idx] += time.time() - t
+        self.item_count[idx] += 1
+        return sample
+
+
+    def load_item(self, idx):
 
         # NOTE on returning more than 2 items (train and test image):
         # conveniently, the dataloader actually collates dictionaries with arbitrarily many keys,
@@ -254,39 +859,172 @@ class NucleusDataset(Dataset):
         if not hasattr(self, 'return_fields'):
             raise ValueError('return_fields has to be set before calling __getitem__')
 
-        row = self.data_df.iloc[idx].to_dict()
+        if self.prerendered is not None and np.random.uniform() >= self.live_fraction:
+            sample = self.prerendered.sample(self.get_field('stage', idx), self.get_field('id', idx),
+                                             [k for k in self.return_fields if k != 'inst_wt'])
+            if sample is not None:
+                # normalized over this dataset, not the pre-rendered one
+                if 'inst_wt' in self.return_fields:
+                    sample['inst_wt'] = self.get_field('inst_wt', idx)
+                return sample
+
+        if self.lazy:
+            return self.apply_augment(self.load_sample(idx))
+
         return self.apply_augment(
-            dict([(k, row[k]) for k in self.return_fields]))
+            dict([(k, self.get_field(k, idx)) for k in self.return_fields]))
+
+
+    def view(self, rows, **options):
+        """
+        new dataset on a subset of rows, with the same loading options.
+
+        rows are positions in data_df, which is shared rather than copied.
+        """
+        dset = NucleusDataset(cache_dir=self.cache_dir, load_workers=self.load_workers, lazy=self.lazy,
+                              lazy_cache_bytes=self.lazy_cache_bytes, erosion_size=self.erosion_size,
+                              augment_mode=self.augment_mode, color_lut=self.color_lut,
+                              max_decode_pixels=self.max_decode_pixels, labels_csv=self.labels_csv, **options)
+        dset.data_df = self.data_df
+        dset.shard_store = self.shard_store
+        dset.rows = np.asarray(rows, dtype=np.int64)
+        return dset
+
 
+    def duplicate_clusters(self, max_distance=6, hash_size=8):
+        """
+        near-duplicate cluster of each row (see dedup.py), also stored in the 'cluster' column of data_df.
+
+        hashes are computed once per image, from the decoded images if they are in memory, else
+        from the image files; with cache_dir, they are kept in <cache_dir>/dhash<hash_size>.csv.
+        """
+        keys = [(self.get_field('stage', i), self.get_field('id', i)) for i in range(len(self))]
+        cached, fname = {}, None
+        if self.cache_dir is not None:
+            fname = hash_cache_file(self.cache_dir, hash_size)
+            cached = read_hash_cache(fname)
+
+        todo = [i for i, k in enumerate(keys) if k not in cached]
+        if todo:
+            t = time.time()
+            if self.shard_store is not None and self.lazy:
+                hashes = [dhash(self.shard_store.image(self.rows[i]), hash_size) for i in todo]
+            elif self.lazy:
+                hashes = parallel_map(_image_hash, [(self.get_field('images', i), hash_size) for i in todo],
+                                      self.load_workers)
+            else:
+                hashes = [dhash(self.get_field('images', i), hash_size) for i in todo]
+            cached.update(zip([keys[i] for i in todo], hashes))
+            self.load_timings['dhash'] = time.time() - t
+            if fname is not None:
+                write_hash_cache(fname, cached)
+
+        clusters = find_clusters([cached[k] for k in keys], max_distance)
+        col = np.full(len(self.data_df), -1, dtype=np.int64)
+        col[self.rows] = clusters
+        self.data_df['cluster'] = col
+        return clusters
 
-    def train_test_split(self, **options):
+
+    def train_test_split(self, by_cluster=False, **options):
         """ Return splitted train and validation datasets.
         options are passed to sklearn.model_selection.train_test_split, see there.
+        with by_cluster, near-duplicate clusters (see duplicate_clusters) are not split;
+        stratification is then not possible.
         """
 
+        rows = self.rows
+        if by_cluster:
+            if options.pop('stratify', False):
+                logging.info('splitting by near-duplicate cluster; not stratifying by image size')
+            clusters = [self.get_field('cluster', i) for i in range(len(self))]
+            splitter = GroupShuffleSplit(n_splits=1, test_size=options.get('test_size'),
+                                         random_state=options.get('random_state'))
+            idx_train, idx_valid = next(splitter.split(rows, groups=clusters))
+            return (self.view(rows[idx_train], dset_type='train', img_size=self.img_size, img_size_mode=self.img_size_mode),
+                    self.view(rows[idx_valid], dset_type='valid', img_size=None, img_size_mode='keep'))
+
         if 'stratify' in options:
             if not options['stratify']:
                 del options['stratify']
             else:
                 # stratify by image size.
                 # NOTE: image sizes that occur only once will not be stratifiable, remove
-                grouped = self.data_df.groupby('size', sort=False)
-                to_delete = []
-                for group in grouped:
-                    if len(group[1]) <= 1:
-                        to_delete.append(group[0])
-                for sz in to_delete:
-                    logging.warn('img size {} only occurs once, deleting due to stratification'.format(sz))
-                    self.data_df = self.data_df[self.data_df['size'] != sz]
-
-                options['stratify'] = self.data_df['images'].map(lambda x: '{}'.format(x.size))
-
-        df_train, df_valid = train_test_split_sk(self.data_df, **options)
-        dset_train = NucleusDataset(dset_type='train', img_size=self.img_size, img_size_mode=self.img_size_mode)
-        dset_train.data_df = df_train
+                sizes = [str(self.get_field('size', i)) for i in range(len(self))]
+                counts = Counter(sizes)
+                for sz, cnt in counts.items():
+                    if cnt <= 1:
+                        logging.warn('img size {} only occurs once, deleting due to stratification'.format(sz))
+                keep = np.array([counts[sz] > 1 for sz in sizes], dtype=bool)
+                rows = rows[keep]
+                options['stratify'] = [sz for sz in sizes if counts[sz] > 1]
+
+        rows_train, rows_valid = train_test_split_sk(rows, **options)
+        dset_train = self.view(rows_train, dset_type='train', img_size=self.img_size, img_size_mode=self.img_size_mode)
 
         # validation images should never be resized or cropped
-        dset_valid = NucleusDataset(dset_type='valid', img_size=None, img_size_mode='keep')
-        dset_valid.data_df = df_valid
+        dset_valid = self.view(rows_valid, dset_type='valid', img_size=None, img_size_mode='keep')
 
         return dset_train, dset_valid
+
+
+    def kfold_split(self, n_folds, random_state=None, stratify=False, shared_memory=False, by_cluster=False):
+        """
+        Return a list of (train, valid) dataset pairs for k-fold cross validation.
+
+        the folds are views on the same data_df. The training and validation preprocessing is run
+        once over all rows, and the resulting column stores are shared by all folds.
+        Note: instance weights are normalized over the whole dataset rather than per fold.
+        with by_cluster, near-duplicate clusters (see duplicate_clusters) are not split.
+        """
+
+        if by_cluster:
+            clusters = [self.get_field('cluster', i) for i in range(len(self))]
+            splits = GroupKFold(n_folds).split(self.rows, groups=clusters)
+        elif stratify:
+            # image sizes with fewer than n_folds images are spread as evenly as possible
+            sizes = [str(self.get_field('size', i)) for i in range(len(self))]
+            splits = StratifiedKFold(n_folds, shuffle=True, random_state=random_state).split(self.rows, sizes)
+        else:
+            splits = KFold(n_folds, shuffle=True, random_state=random_state).split(self.rows)
+
+        full_train = self.view(self.rows, dset_type='train', img_size=self.img_size, img_size_mode=self.img_size_mode)
+        full_valid = self.view(self.rows, dset_type='valid', img_size=None, img_size_mode='keep')
+        for d in (full_train, full_valid):
+            d.preprocess()
+            if shared_memory and not self.lazy:
+                d.share_memory()
+
+        folds = []
+        for idx_train, idx_valid in splits:
+            dset_train = self.view(self.rows[idx_train], dset_type='train', img_size=self.img_size,
+                                   img_size_mode=self.img_size_mode)
+            dset_valid = self.view(self.rows[idx_valid], dset_type='valid', img_size=None, img_size_mode='keep')
+            for d, full in ((dset_train, full_train), (dset_valid, full_valid)):
+                d.store = full.store
+                d.is_preprocessed = True
+            folds.append((dset_train, dset_valid))
+        return folds
+
+
+# module level, so that they can be pickled for parallel_map
+
+def _read_image(in_img_list):
+    return NucleusDataset.read_image(in_img_list)
+
+
+def _read_and_stack(in_img_list):
+    return NucleusDataset.read_and_stack(in_img_list)
+
+
+def _image_hash(job):
+    return image_hash(*job)
+
+
+def _read_image_size(in_img_list):
+    return NucleusDataset.read_image_size(in_img_list)
+
+
+def _prep_job(job):
+    img, m, groups, params = job
+    return prep_sample(img, m, groups, params)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""
+near-duplicate detection with perceptual hashes.
+
+the difference hash (dhash) of an image is computed on a (hash_size + 1) x hash_size grey
+thumbnail: bit (i, j) is set if pixel (i, j + 1) is brighter than pixel (i, j). Images are
+near-duplicates if their hashes differ in at most max_distance bits; clusters are the
+connected components of the near-duplicate relation (union-find).
+
+usage (report the clusters of a dataset):
+    python dedup.py --data <root> --stage stage1 --group train --max-distance 6
+"""
+
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+from PIL import Image
+
+from image_reader import open_image
+from utils import mkdir_p
+
+
+def dhash(img, hash_size=8):
+    """difference hash of an RGB image array, as a uint64 (hash_size <= 8)"""
+    if hash_size > 8:
+        raise ValueError('hash_size must be at most 8, got %d' % hash_size)
+    grey = Image.fromarray(np.asarray(img, dtype=np.uint8)).convert('L')
+    small = np.asarray(grey.resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return np.uint64(sum([1 << i for i, b in enumerate(bits) if b]))
+
+
+def image_hash(image, hash_size=8):
+    """dhash of a decoded image, or of the first of a list of image paths"""
+    if isinstance(image, np.ndarray):
+        return dhash(image, hash_size)
+    reader = open_image(image[0])
+    try:
+        return dhash(reader.read(), hash_size)
+    finally:
+        reader.close()
+
+
+# number of set bits of each byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(hashes, rows):
+    """number of differing bits between hashes[rows] and all hashes, as a len(rows) x n array"""
+    x = np.bitwise_xor(hashes[rows][:, np.newaxis], hashes[np.newaxis, :])
+    return POPCOUNT[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=2)
+
+
+def find_clusters(hashes, max_distance, chunk=256):
+    """
+    cluster label (0 .. k-1) of each hash: connected components of pairs within max_distance bits.
+    distances are computed in chunks of rows, so memory is O(chunk x n).
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for start in range(0, n, chunk):
+        rows = np.arange(start, min(start + chunk, n))
+        d = hamming_distances(hashes, rows)
+        for i, j in zip(*np.nonzero(d <= max_distance)):
+            a, b = find(rows[i]), find(j)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+    roots = np.array([find(i) for i in range(n)])
+    _, labels = np.unique(roots, return_inverse=True)
+    return labels
+
+
+def cluster_summary(clusters):
+    sizes = np.bincount(np.asarray(clusters))
+    return '%d images in %d clusters; %d clusters with duplicates, largest %d' % (
+        len(clusters), len(sizes), np.sum(sizes > 1), sizes.max() if len(sizes) else 0)
+
+
+def hash_cache_file(cache_dir, hash_size):
+    return os.path.join(cache_dir, 'dhash%d.csv' % hash_size)
+
+
+def read_hash_cache(fname):
+    """dict (stage, id) -> hash"""
+    if not os.path.isfile(fname):
+        return {}
+    df = pd.read_csv(fname, dtype={'stage': str, 'id': str, 'hash': str}, keep_default_na=False)
+    return dict([((s, i), np.uint64(int(h, 16))) for s, i, h in zip(df['stage'], df['id'], df['hash'])])
+
+
+def write_hash_cache(fname, hashes):
+    mkdir_p(os.path.dirname(fname))
+    keys = sorted(hashes.keys())
+    df = pd.DataFrame({'stage': [k[0] for k in keys], 'id': [k[1] for k in keys],
+                       'hash': ['%016x' % int(hashes[k]) for k in keys]}, columns=['stage', 'id', 'hash'])
+    tmp = '%s.tmp.%d' % (fname, os.getpid())
+    df.to_csv(tmp, index=False)
+    os.rename(tmp, fname)
+
+
+if __name__ == '__main__':
+    import configargparse
+
+    from dataset import NucleusDataset
+
+    parser = configargparse.ArgumentParser(description='find near-duplicate images.')
+    parser.add('--data', '-d', metavar='DIR', required=True, help='path to dataset')
+    parser.add('--stage', '-s', default='stage1', help='stage [default: %(default)s]')
+    parser.add('--group', '-g', default='train', help='group name [default: %(default)s]')
+    parser.add('--max-distance', type=int, default=6, help='maximum number of differing hash bits [default: %(default)s]')
+    parser.add('--hash-size', type=int, default=8, help='hash grid size [default: %(default)s]')
+    parser.add('--load-workers', type=int, default=1, help='number of processes for hashing [default: %(default)s]')
+    parser.add('--cache-dir', help='directory for caching the hashes [default: %(default)s]')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    dset = NucleusDataset(args.data, args.stage, args.group, dset_type='test', lazy=True,
+                          load_workers=args.load_workers, cache_dir=args.cache_dir)
+    clusters = dset.duplicate_clusters(args.max_distance, args.hash_size)
+    print cluster_summary(clusters)
+    sizes = np.bincount(clusters)
+    for c in np.argsort(-sizes)[:10]:
+        if sizes[c] > 1:
+            print '%3d: %s' % (sizes[c], ' '.join([dset.get_field('id', i) for i in np.nonzero(clusters == c)[0]][:5]))
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+"""geometric augmentation that only warps the pixels ending up in the output crop"""
+
+import numpy as np
+
+import cv2
+
+import imgaug as ia
+
+
+# dtypes that cv2.warpAffine accepts
+_CV2_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+
+def _translation(dx, dy):
+    return np.array([[1.0, 0.0, dx], [0.0, 1.0, dy], [0.0, 0.0, 1.0]])
+
+
+def _about_center(m, h, w):
+    """conjugate a linear map so that it operates around the image center"""
+    cx, cy = (w - 1) / 2.0, (h - 1) / 2.0
+    return _translation(cx, cy).dot(m).dot(_translation(-cx, -cy))
+
+
+def sample_affine_params(random_state, p_flip=0.5, rotate=(-45, 45), scale=(.6, 1.4)):
+    """
+    draw the parameters of img_proc.affine_augmentation: one or two of
+    (fliplr, flipud, rotate, scale), applied in this order.
+    """
+    ops = sorted(random_state.choice(4, random_state.randint(1, 3), replace=False))
+    return {'fliplr': 0 in ops and random_state.uniform() < p_flip,
+            'flipud': 1 in ops and random_state.uniform() < p_flip,
+            'rotate': random_state.uniform(rotate[0], rotate[1]) if 2 in ops else 0.0,
+            'scale': random_state.uniform(scale[0], scale[1]) if 3 in ops else 1.0,
+            'order': random_state.randint(0, 2),
+            'crop': random_state.randint(0, 5)}
+
+
+def forward_matrix(params, h, w):
+    """3x3 matrix mapping input to (uncropped) output coordinates, in (x, y) order"""
+    m = np.eye(3)
+    if params['fliplr']:
+        m = np.array([[-1.0, 0.0, w - 1.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]).dot(m)
+    if params['flipud']:
+        m = np.array([[1.0, 0.0, 0.0], [0.0, -1.0, h - 1.0], [0.0, 0.0, 1.0]]).dot(m)
+    if params['rotate'] != 0.0:
+        a = np.deg2rad(params['rotate'])
+        r = np.array([[np.cos(a), -np.sin(a), 0.0], [np.sin(a), np.cos(a), 0.0], [0.0, 0.0, 1.0]])
+        m = _about_center(r, h, w).dot(m)
+    if params['scale'] != 1.0:
+        s = params['scale']
+        m = _about_center(np.diag([s, s, 1.0]), h, w).dot(m)
+    return m
+
+
+def crop_offset(which, h, w, crop_h, crop_w):
+    """(top, left) of the crop, with the positions of FiveCrop"""
+    if crop_h > h or crop_w > w:
+        raise ValueError('Requested crop size {} is bigger than input size {}'.format((crop_h, crop_w), (h, w)))
+    if which == 0:
+        return 0, 0
+    elif which == 1:
+        return 0, w - crop_w
+    elif which == 2:
+        return h - crop_h, 0
+    elif which == 3:
+        return h - crop_h, w - crop_w
+    return int(round((h - crop_h) / 2.)), int(round((w - crop_w) / 2.))
+
+
+def sample_transform(random_state, h, w, size=None):
+    """
+    draw a transform for an image of size (h, w).
+
+    returns (params, (out_h, out_w), fwd, (top, left), inv), with fwd the forward matrix of
+    the uncropped transform, and inv the map from output (crop) to input coordinates.
+    """
+    params = sample_affine_params(random_state)
+    crop_h, crop_w = (h, w) if size is None else size
+    top, left = crop_offset(params['crop'], h, w, crop_h, crop_w)
+    fwd = forward_matrix(params, h, w)
+    inv = np.linalg.inv(fwd).dot(_translation(left, top))
+    return params, (crop_h, crop_w), fwd, (top, left), inv
+
+
+def _reflect_index(idx, n):
+    """indices for 'symmetric' padding (edge pixel repeated), like skimage and cv2.BORDER_REFLECT"""
+    idx = np.mod(idx, 2 * n)
+    return np.where(idx >= n, 2 * n - 1 - idx, idx)
+
+
+def source_region(inv, out_h, out_w, h, w, margin=2):
+    """
+    row and column indices of the input pixels needed for an output of size (out_h, out_w),
+    where inv maps output to input coordinates. Indices outside the image are reflected.
+
+    returns (rows, cols, x0, y0), with (x0, y0) the input coordinates of the region's top left.
+    """
+    corners = np.array([[0, 0, 1], [out_w - 1, 0, 1], [0, out_h - 1, 1], [out_w - 1, out_h - 1, 1]], dtype=np.float64)
+    src = inv.dot(corners.T)
+    x0 = int(np.floor(src[0].min())) - margin
+    x1 = int(np.ceil(src[0].max())) + margin
+    y0 = int(np.floor(src[1].min())) - margin
+    y1 = int(np.ceil(src[1].max())) + margin
+    rows = _reflect_index(np.arange(y0, y1 + 1), h)
+    cols = _reflect_index(np.arange(x0, x1 + 1), w)
+    return rows, cols, x0, y0
+
+
+def warp_region(img, inv, out_h, out_w, order):
+    """
+    output of size (out_h, out_w), where output pixel p is sampled at input location inv * p.
+
+    only the part of img covered by the output (plus interpolation margin) is touched.
+    """
+    h, w = img.shape[:2]
+    if _is_axis_aligned(inv):
+        # flips and whole-pixel shifts only: plain indexing, no interpolation
+        rows, cols = _axis_aligned_index(inv, out_h, out_w, h, w)
+        return img[rows[:, None], cols[None, :]]
+
+    rows, cols, x0, y0 = source_region(inv, out_h, out_w, h, w)
+    region = img[rows[:, None], cols[None, :]]
+    m = _translation(-x0, -y0).dot(inv)[:2]
+    flags = (cv2.INTER_NEAREST if order == 0 else cv2.INTER_LINEAR) | cv2.WARP_INVERSE_MAP
+
+    dtype = region.dtype
+    if dtype.type not in _CV2_DTYPES:
+        region = region.astype(np.float32)
+
+    # cv2 handles at most 4 channels
+    if region.ndim == 3 and region.shape[2] > 4:
+        out = np.concatenate([_warp(region[:, :, i:i + 4], m, out_h, out_w, flags)
+                              for i in range(0, region.shape[2], 4)], axis=2)
+    else:
+        out = _warp(region, m, out_h, out_w, flags)
+
+    if out.dtype != dtype:
+        out = out.astype(dtype)
+    return out
+
+
+def _is_axis_aligned(inv):
+    lin = inv[:2, :2]
+    return (np.allclose(lin, np.diag(np.round(np.diag(lin)))) and np.allclose(np.abs(np.diag(lin)), 1.0)
+            and np.allclose(inv[:2, 2], np.round(inv[:2, 2])))
+
+
+def _axis_aligned_index(inv, out_h, out_w, h, w):
+    cols = _reflect_index(int(round(inv[0, 0])) * np.arange(out_w) + int(round(inv[0, 2])), w)
+    rows = _reflect_index(int(round(inv[1, 1])) * np.arange(out_h) + int(round(inv[1, 2])), h)
+    return rows, cols
+
+
+def _warp(region, m, out_h, out_w, flags):
+    out = cv2.warpAffine(np.ascontiguousarray(region), m, (out_w, out_h), flags=flags,
+                         borderMode=cv2.BORDER_REFLECT)
+    if region.ndim == 3 and out.ndim == 2:
+        # cv2 drops singleton channel dimensions
+        out = out[:, :, np.newaxis]
+    return out
+
+
+class CropFirstAffine(ia.augmenters.Augmenter):
+
+    """
+    Random flips, rotation, and scaling followed by FiveCrop, computed crop-first.
+
+    Produces the same distribution of geometric transforms as img_proc.affine_augmentation,
+    but instead of warping the full image and then cutting out the crop, it maps the crop
+    back into the input, and warps only that region (plus a margin for interpolation). The
+    cost is proportional to the crop size rather than the image size.
+
+    Differences to the sequential pipeline: the transforms are combined into one resampling
+    step (one interpolation order per sample, instead of one per affine op), so images are
+    slightly sharper.
+    """
+
+    def __init__(self, size=None, name=None, deterministic=False, random_state=None):
+        super(CropFirstAffine, self).__init__(name=name, deterministic=deterministic, random_state=random_state)
+        if size is None or ia.is_single_integer(size):
+            self.size = size if size is None else (size, size)
+        elif isinstance(size, (list, tuple)) and len(size) == 2:
+            self.size = tuple(size)
+        else:
+            raise ValueError('Invalid size parameter: %s' % str(size))
+
+
+    def get_parameters(self):
+        return [self.size]
+
+
+    def _sample(self, seed, h, w):
+        return sample_transform(ia.new_random_state(seed), h, w, self.size)
+
+
+    def _augment_images(self, images, random_state, parents, hooks):
+        result = []
+        seeds = random_state.randint(0, 10**6, (len(images),))
+        for seed, img in zip(seeds, images):
+            h, w = img.shape[0:2]
+            params, (crop_h, crop_w), _, _, inv = self._sample(seed, h, w)
+            result.append(warp_region(img, inv, crop_h, crop_w, params['order']))
+        return result
+
+
+    def _augment_keypoints(self, keypoints_on_images, random_state, parents, hooks):
+        result = []
+        seeds = random_state.randint(0, 10**6, (len(keypoints_on_images),))
+        for seed, keypoints_on_image in zip(seeds, keypoints_on_images):
+            h, w = keypoints_on_image.shape[0:2]
+            _, (crop_h, crop_w), fwd, (top, left), _ = self._sample(seed, h, w)
+            m = _translation(-left, -top).dot(fwd)
+            kps = []
+            for kp in keypoints_on_image.keypoints:
+                x, y, _ = m.dot([kp.x, kp.y, 1.0])
+                kps.append(ia.Keypoint(x=x, y=y))
+            result.append(ia.KeypointsOnImage(kps, shape=(crop_h, crop_w) + tuple(keypoints_on_image.shape[2:])))
+        return result
+
+
+class FusedAffine(object):
+
+    """
+    Crop-first flips, rotation, scaling and FiveCrop, applied to all fields of a sample at once.
+
+    The transform is sampled once per sample. Fields are grouped by interpolation order; the
+    source regions of each group are stacked along the channel axis and resampled together:
+    for nearest neighbor, with a single gather through a shared index map, and for linear
+    interpolation, with cv2.remap on a shared coordinate map. This guarantees identical
+    geometry for image and masks.
+
+    By default, fields with 3 channels (images) are interpolated with the sampled order, and
+    all other fields (masks, labels, contours) with nearest neighbor, so they keep their values.
+    Arrays with fewer than 2 dimensions are passed through.
+
+    args:
+        size: crop size (height, width), or None for no cropping
+        order: dict of field name -> interpolation order (0 or 1), overrides the default
+    """
+
+    def __init__(self, size=None, order=None):
+        if size is not None and not isinstance(size, (list, tuple)):
+            size = (size, size)
+        self.size = None if size is None else tuple(size)
+        self.order = order or {}
+
+
+    def field_order(self, name, arr, params):
+        if name in self.order:
+            return self.order[name]
+        if arr.ndim == 3 and arr.shape[2] == 3:
+            return params['order']
+        return 0
+
+
+    def __call__(self, fields, random_state=None):
+        if random_state is None:
+            random_state = ia.current_random_state()
+
+        arrays = [(k, v) for k, v in fields.items() if isinstance(v, np.ndarray) and v.ndim >= 2]
+        if not arrays:
+            return dict(fields)
+        h, w = arrays[0][1].shape[:2]
+        for k, v in arrays:
+            if v.shape[:2] != (h, w):
+                raise ValueError('field %s has size %s, expected %s' % (k, v.shape[:2], (h, w)))
+
+        params, (out_h, out_w), _, _, inv = sample_transform(random_state, h, w, self.size)
+
+        groups = {}
+        for k, v in arrays:
+            order = 0 if _is_axis_aligned(inv) else self.field_order(k, v, params)
+            groups.setdefault(order, []).append(k)
+
+        result = dict(fields)
+        if _is_axis_aligned(inv):
+            rows, cols = _axis_aligned_index(inv, out_h, out_w, h, w)
+            for k in groups[0]:
+                result[k] = fields[k][rows[:, None], cols[None, :]]
+            return result
+
+        rows, cols, x0, y0 = source_region(inv, out_h, out_w, h, w)
+        ys, xs = np.mgrid[0:out_h, 0:out_w]
+        src_x = inv[0, 0] * xs + inv[0, 1] * ys + inv[0, 2] - x0
+        src_y = inv[1, 0] * xs + inv[1, 1] * ys + inv[1, 2] - y0
+
+        for order, names in groups.items():
+            stacked = _stack_regions([fields[k] for k in names], rows, cols)
+            if order == 0:
+                out = stacked[np.floor(src_y + 0.5).astype(np.intp), np.floor(src_x + 0.5).astype(np.intp)]
+            else:
+                out = _remap(stacked, src_x.astype(np.float32), src_y.astype(np.float32))
+            c = 0
+            for k in names:
+                v = fields[k]
+                nc = v.shape[2] if v.ndim == 3 else 1
+                result[k] = out[:, :, c:c + nc].reshape((out_h, out_w) + v.shape[2:]).astype(v.dtype, copy=False)
+                c += nc
+        return result
+
+
+def _stack_regions(arrays, rows, cols):
+    """crop the same region out of several arrays, and stack them along the channel axis"""
+    dtype = np.result_type(*arrays)
+    if dtype.type not in _CV2_DTYPES:
+        dtype = np.float32
+    return np.concatenate([a[rows[:, None], cols[None, :]].reshape(rows.size, cols.size, -1).astype(dtype, copy=False)
+                           for a in arrays], axis=2)
+
+
+def _remap(region, map_x, map_y):
+    # cv2 handles at most 4 channels
+    out = [cv2.remap(np.ascontiguousarray(region[:, :, i:i + 4]), map_x, map_y, cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_REFLECT)
+           for i in range(0, region.shape[2], 4)]
+    out = [o[:, :, np.newaxis] if o.ndim == 2 else o for o in out]
+    return np.concatenate(out, axis=2) if len(out) > 1 else out[0]
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+"""
+readers that serve windows of an image without decoding all of it.
+
+    reader = open_image(path)
+    h, w = reader.shape[:2]
+    tile = reader.read((top, left, height, width))
+
+formats:
+    .png, .jpg, ... (PIL): the file is decoded on the first read; windows are slices of it
+    <archive>.zip/<member> (PIL): likewise, from the member read into memory (see zip_source.py)
+    .npy: memory-mapped; a window only touches the pages it covers
+    .tif, .tiff (tifffile, optional): uncompressed images are memory-mapped; tiled (and
+          compressed) images are read through tifffile's zarr interface (requires zarr), which
+          only decodes the tiles a window intersects
+
+all readers return RGB uint8 arrays of shape (height, width, 3), like NucleusDataset.read_image.
+integer images of more than 8 bits are scaled by the range of the whole image (as numpy_img_to_torch
+does), so that all windows of an image are scaled alike; the range is found on the first read, one
+tile at a time, unless it is given to open_image.
+"""
+
+import os
+
+import numpy as np
+
+from PIL import Image
+
+from zip_source import split_zip_path, open_member
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def to_rgb(arr, value_range=None):
+    """
+    convert a (window of an) image array to RGB uint8.
+
+    integer images are shifted to start at 0 if they have negative values, and scaled to 8 bits if
+    their maximum is above 255, like numpy_img_to_torch does; value_range (min, max) is that of the
+    whole image (by default, of arr).
+    """
+    arr = np.asarray(arr)
+    if arr.dtype != np.uint8:
+        if arr.dtype.kind in 'ui':
+            lo, hi = value_range if value_range is not None else (arr.min(), arr.max())
+            lo, hi = min(float(lo), 0.0), float(hi)
+            arr = arr.astype(np.float32) - lo
+            if hi - lo > 255:
+                arr *= 255.0 / (hi - lo)
+            arr = np.clip(arr, 0, 255).astype(np.uint8)
+        else:
+            arr = (np.clip(arr, 0.0, 1.0) * 255.0).astype(np.uint8)
+    if arr.ndim == 2:
+        arr = arr[:, :, np.newaxis]
+    if arr.shape[2] == 1:
+        return np.repeat(arr, 3, axis=2)
+    return np.ascontiguousarray(arr[:, :, :3])
+
+
+def clip_window(window, shape):
+    """intersect a window (top, left, height, width) with the image; None means the whole image"""
+    if window is None:
+        return 0, 0, shape[0], shape[1]
+    top, left, height, width = window
+    top, left = max(0, top), max(0, left)
+    return top, left, min(height, shape[0] - top), min(width, shape[1] - left)
+
+
+class ImageReader(object):
+
+    """base class; subclasses set self.shape and implement _read(top, left, height, width)"""
+
+    def __init__(self, path, value_range=None):
+        self.path = path
+        self.shape = None
+        self.value_range = value_range
+
+
+    @property
+    def size(self):
+        """(width, height), like PIL"""
+        return self.shape[1], self.shape[0]
+
+
+    def read(self, window=None):
+        """RGB uint8 array of a window (top, left, height, width), or of the whole image"""
+        top, left, height, width = clip_window(window, self.shape)
+        arr = np.asarray(self._read(top, left, height, width))
+        if arr.dtype != np.uint8 and arr.dtype.kind in 'ui' and self.value_range is None:
+            self.value_range = self.find_value_range()
+        return to_rgb(arr, self.value_range)
+
+
+    def find_value_range(self, tile=4096):
+        """(min, max) of the image, read one tile at a time"""
+        lo, hi = None, None
+        for top, left, height, width in iter_tiles(self.shape, tile):
+            arr = np.asarray(self._read(top, left, height, width))
+            lo = arr.min() if lo is None else min(lo, arr.min())
+            hi = arr.max() if hi is None else max(hi, arr.max())
+        return lo, hi
+
+
+    def close(self):
+        pass
+
+
+class PILReader(ImageReader):
+
+    def __init__(self, path, value_range=None):
+        super(PILReader, self).__init__(path, value_range)
+        # PIL only reads the header here; an archive member is inflated into memory first, so its
+        # image is kept for the first read rather than inflating the member again
+        in_zip = split_zip_path(path) is not None
+        pil = open_member(path) if in_zip else Image.open(path)
+        width, height = pil.size
+        self.shape = (height, width, 3)
+        self._pil = pil if in_zip else None
+        self._img = None
+
+
+    def _read(self, top, left, height, width):
+        if self._img is None:
+            pil = self._pil if self._pil is not None else Image.open(self.path)
+            self._img = np.array(pil.convert('RGB'))
+            self._pil = None
+        return self._img[top:top + height, left:left + width]
+
+
+    def close(self):
+        self._img = None
+        self._pil = None
+
+
+class NpyReader(ImageReader):
+
+    def __init__(self, path, value_range=None):
+        super(NpyReader, self).__init__(path, value_range)
+        self._arr = np.load(path, mmap_mode='r')
+        if self._arr.ndim not in (2, 3):
+            raise ValueError('%s: expected an image array, got shape %s' % (path, self._arr.shape))
+        self.shape = self._arr.shape[:2] + (3,)
+
+
+    def _read(self, top, left, height, width):
+        return self._arr[top:top + height, left:left + width]
+
+
+    def close(self):
+        self._arr = None
+
+
+class TiffReader(ImageReader):
+
+    def __init__(self, path, value_range=None):
+        super(TiffReader, self).__init__(path, value_range)
+        if tifffile is None:
+            raise ValueError('reading %s requires the tifffile package' % path)
+        self._tif = tifffile.TiffFile(path)
+        page = self._tif.pages[0]
+        if page.is_memmappable:
+            self._arr = tifffile.memmap(path, page=0, mode='r')
+        else:
+            if zarr is None:
+                raise ValueError('reading compressed or tiled tiff %s requires the zarr package' % path)
+            self._arr = zarr.open(page.aszarr(), mode='r')
+        self._samples_first = len(page.shape) == 3 and page.shape[0] in (3, 4) and page.shape[2] not in (3, 4)
+        shape = page.shape[1:] if self._samples_first else page.shape
+        self.shape = tuple(shape[:2]) + (3,)
+
+
+    def _read(self, top, left, height, width):
+        if self._samples_first:
+            return np.moveaxis(np.asarray(self._arr[:, top:top + height, left:left + width]), 0, -1)
+        return np.asarray(self._arr[top:top + height, left:left + width])
+
+
+    def close(self):
+        self._arr = None
+        self._tif.close()
+
+
+class ArrayReader(ImageReader):
+
+    """reader for an image that is already in memory"""
+
+    def __init__(self, arr, path=None):
+        super(ArrayReader, self).__init__(path)
+        self._arr = arr
+        self.shape = arr.shape[:2] + (3,)
+
+
+    def _read(self, top, left, height, width):
+        return self._arr[top:top + height, left:left + width]
+
+
+def open_image(path, value_range=None):
+    """reader for an image file; value_range (min, max) of integer images, if known, saves a pass over the image"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return NpyReader(path, value_range)
+    if ext in TIFF_EXTENSIONS and tifffile is not None:
+        return TiffReader(path, value_range)
+    return PILReader(path, value_range)
+
+
+def iter_tiles(shape, tile, overlap=0):
+    """
+    windows (top, left, height, width) covering an image of the given shape, with tiles of size
+    `tile` overlapping by `overlap` pixels; the last row and column are shifted to end at the border.
+    """
+    h, w = shape[:2]
+    step = max(1, tile - overlap)
+
+    def starts(n):
+        if n <= tile:
+            return [0]
+        s = list(range(0, n - tile, step))
+        return s + [n - tile]
+
+    for top in starts(h):
+        for left in starts(w):
+            yield top, left, min(tile, h), min(tile, w)
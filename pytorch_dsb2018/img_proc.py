@@ -13,10 +13,12 @@ import cv2
 import imgaug as ia
 from imgaug import augmenters as iaa
 from five_crop_aug import FiveCrop
+from geometric_aug import CropFirstAffine
+from color_lut_aug import LUTColorAugment
 
 import skimage
 from skimage.color import rgb2grey
-from skimage import img_as_ubyte, img_as_float, exposure, morphology
+from skimage import img_as_ubyte, img_as_float, exposure, morphology, transform
 from skimage.io import imread
 from skimage.feature import peak_local_max
 from skimage.util import invert
@@ -56,22 +58,23 @@ def numpy_img_to_torch(n, unsqueeze=False):
     # see https://discuss.pytorch.org/t/problem-with-reading-pfm-image/2924
     n = np.ascontiguousarray(n)
 
-    mi = np.min(n)
-    ma = np.max(n)
-
-    if mi < 0.0:
-        logging.warning('image values out of range: [%f %f]' % (mi, ma))
-        n -= mi
-    if ma > 255.0:
-        logging.warning('image values out of range: [%f %f]' % (mi, ma))
-        n = (1.0 * n / np.max(n) * 255.0).astype(np.uint8)
-
     if n.ndim == 2:
         n = np.expand_dims(n, 2)
     if n.ndim == 3 and n.shape[2] == 1:
-        # single channel or mask
-        n_conv = torch.from_numpy(np.transpose(n, (2, 0, 1))).float()
+        # single channel or mask. note: label images can have more than 255 labels,
+        # and torch does not support uint16, so convert to float here
+        n_conv = torch.from_numpy(np.transpose(n, (2, 0, 1)).astype(np.float32))
     else:
+        mi = np.min(n)
+        ma = np.max(n)
+
+        if mi < 0.0:
+            logging.warning('image values out of range: [%f %f]' % (mi, ma))
+            n -= mi
+        if ma > 255.0:
+            logging.warning('image values out of range: [%f %f]' % (mi, ma))
+            n = (1.0 * n / np.max(n) * 255.0).astype(np.uint8)
+
         n_conv = ToTensor()(n)
     if unsqueeze:
         n_conv = n_conv.unsqueeze(0)
@@ -169,13 +172,34 @@ def preprocess_img_grey(img, do_inversion=True, invert_thresh=0.5):
     return img
 
 
-def preprocess_mask(img, dset_type='train', resize=None):
+def resize_labels(img, resize):
+    """resize a label image to resize (height, width) with nearest neighbor; the dtype is kept"""
+    out = cv2.resize(np.ascontiguousarray(img), (resize[1], resize[0]), interpolation=cv2.INTER_NEAREST)
+    if img.ndim == 3 and out.ndim == 2:
+        # cv2 drops singleton channel dimensions
+        out = out[:, :, np.newaxis]
+    return out
+
+
+def check_resize_labels():
+    """regression check: uint16 label images with more than 255 labels survive resizing"""
+    m = np.zeros((64, 64), dtype=np.uint16)
+    m[:32, :32] = 1
+    m[32:, 32:] = 300
+    m[:32, 32:] = 65535
+    for img in (m, m[:, :, np.newaxis]):
+        out = resize_labels(img, (32, 48))
+        assert out.dtype == np.uint16 and out.shape[:2] == (32, 48) and out.ndim == img.ndim
+        assert set(np.unique(out)) == set([0, 1, 300, 65535]), np.unique(out)
+    assert set(np.unique(preprocess_mask(m, 'train', (32, 48), 0))) == set([0, 1, 300, 65535])
+
+
+def preprocess_mask(img, dset_type='train', resize=None, erosion_size=2):
     if dset_type == 'train':
         if resize is not None:
-            img = transform.resize(img, resize)
-            #  transform.resize() changes type to float!
-            img = img_as_ubyte(img)
-        img = erode_mask(img)
+            # labels must not be interpolated or rescaled to [0, 1]
+            img = resize_labels(img, resize)
+        img = erode_mask(img, erosion_size)
     return img
 
 
@@ -184,12 +208,104 @@ def postprocess_prediction(pred, sz=2, max_clusters_for_dilation=100, thresh=0.0
     # output is in numpy format
     if not isinstance(pred, np.ndarray):
         pred_np = pred.data.cpu().numpy().squeeze()
+    else:
+        pred_np = pred.squeeze()
     img_th = (pred_np > thresh).astype(int)
 
     img_th = redilate_mask(img_th, sz=sz, skip_clusters=max_clusters_for_dilation)
     return img_th, pred_np
 
 
+def postprocess_prediction_rles(pred, tmp_dir, sz=2, thresh=0.0, stripe_pixels=1024**2):
+    """
+    run-length encodings of the clusters of a large prediction, in bounded memory. The result is
+    the same as that of
+        labels_to_rles(postprocess_prediction(pred, sz, max_clusters_for_dilation=1e20, thresh=thresh)[0])
+
+    the prediction (height x width, e.g. memory-mapped) is processed in stripes of whole columns
+    of about stripe_pixels pixels:
+    1. connected components of each stripe are written to a memory-mapped label image in tmp_dir;
+       components touching across a stripe border are merged (union-find), and clusters are
+       numbered in raster order of their first pixel, like ndi.label does.
+    2. redilate_mask dilates each cluster in turn, later ones overwriting earlier ones; that is a
+       maximum filter over the label image with a disk footprint. Runs of each cluster are
+       collected in column-major order, continuing runs from the previous stripe.
+    """
+    h, w = pred.shape
+    step = max(1, stripe_pixels // h)
+    labels = np.lib.format.open_memmap(os.path.join(tmp_dir, 'cluster_labels.npy'), mode='w+', dtype=np.int32, shape=(h, w))
+
+    # per stripe component: union-find parent, and raster position of its first pixel
+    parent = [0]
+    first = [-1]
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for c0 in range(0, w, step):
+        c1 = min(c0 + step, w)
+        lab, n = ndi.label(pred[:, c0:c1] > thresh)
+        if n > 0:
+            ids, idx = np.unique(lab, return_index=True)
+            idx = idx[ids > 0]
+            first.extend((idx // (c1 - c0)) * w + c0 + idx % (c1 - c0))
+            offset = len(parent) - 1
+            parent.extend(range(offset + 1, offset + n + 1))
+            lab[lab > 0] += offset
+            if c0 > 0:
+                left, right = labels[:, c0 - 1], lab[:, 0]
+                both = (left > 0) & (right > 0)
+                for a, b in set(zip(left[both], right[both])):
+                    a, b = find(a), find(b)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+        labels[:, c0:c1] = lab
+
+    roots = np.array(parent)
+    while True:
+        up = roots[roots]
+        if np.array_equal(up, roots):
+            break
+        roots = up
+    first = np.array(first, dtype=np.int64)
+    root_first = np.full(len(roots), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(root_first, roots[1:], first[1:])
+    clusters = np.unique(roots[1:])
+    cluster_id = np.zeros(len(roots), dtype=np.int32)
+    cluster_id[clusters[np.argsort(root_first[clusters])]] = np.arange(1, len(clusters) + 1)
+    cluster_id = cluster_id[roots]
+
+    struc = morphology.disk(sz)
+    runs = dict([(i, []) for i in range(1, len(clusters) + 1)])
+    for c0 in range(0, w, step):
+        c1 = min(c0 + step, w)
+        a, b = max(0, c0 - sz), min(w, c1 + sz)
+        dil = ndi.grey_dilation(cluster_id[labels[:, a:b]], footprint=struc, mode='constant', cval=0)
+        flat = dil[:, c0 - a:c1 - a].T.ravel()
+        starts = np.concatenate([[0], np.nonzero(np.diff(flat))[0] + 1])
+        ends = np.concatenate([starts[1:], [len(flat)]])
+        for s, e, v in zip(starts, ends, flat[starts]):
+            if v == 0:
+                continue
+            r = runs[v]
+            # 1-based position in column-major order
+            pos = c0 * h + s + 1
+            if r and r[-2] + r[-1] == pos:
+                r[-1] += e - s
+            else:
+                r.extend((pos, e - s))
+
+    del labels
+    if not runs:
+        # like labels_to_rles, at least one prediction per image
+        yield [1, 1]
+    for i in range(1, len(clusters) + 1):
+        yield runs[i]
+
+
 ### augmentation
 
 
@@ -232,7 +348,11 @@ def noop_augmentation():
 # WARNING: PiecewiseAffine basically erases contour lines!!!
 # iaa.PiecewiseAffine(scale=(0.00, 0.06))
 
-def affine_augmentation(crop_size):
+def affine_augmentation(crop_size, crop_first=False):
+    if crop_first:
+        # same transforms, but only the crop region is warped
+        return CropFirstAffine(crop_size)
+
     seq = iaa.SomeOf((1, 2),
                      [iaa.Fliplr(0.5),
                       iaa.Flipud(0.5),
@@ -244,7 +364,11 @@ def affine_augmentation(crop_size):
     return iaa.Sequential([seq, FiveCrop(crop_size)])
 
 
-def color_augmentation():
+def color_augmentation(lut=False):
+    if lut:
+        # same branches and result; the channel add goes through a lookup table, HSV branches still convert
+        return LUTColorAugment(max_add=100)
+
     return iaa.Sequential([
         # Color
         iaa.OneOf([
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""data loader that runs on threads instead of worker processes"""
+
+import time
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from torch.utils.data.sampler import SequentialSampler, RandomSampler, BatchSampler
+from torch.utils.data.dataloader import default_collate, pin_memory_batch
+
+
+class ThreadDataLoader(object):
+
+    """
+    Drop-in replacement for torch's DataLoader, with num_workers threads instead of processes.
+
+    Most of the per-sample work (cv2, numpy, imgaug) releases the GIL, so threads load in
+    parallel, without forking workers and without pickling each sample back through a pipe.
+    Workers share the dataset, including the lazy sample cache.
+
+    each batch (loading its samples and collating them) is a job for the thread pool. At most
+    prefetch batches are in flight: when the consumer falls behind, no new jobs are submitted
+    (backpressure), which bounds memory. Batches are returned in sampler order.
+
+    stats() reports, for the last epoch:
+        batches: number of batches returned
+        wait_sec: total time the consumer was blocked waiting for a batch
+        wait_frac: wait_sec as a fraction of the epoch time
+        depth_avg, depth_max: number of batches ready (loaded but not yet consumed) at each request
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None,
+                 num_workers=1, collate_fn=default_collate, pin_memory=False, drop_last=False, prefetch=None):
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+        self.num_workers = max(1, num_workers)
+        self.pin_memory = pin_memory
+        self.prefetch = prefetch if prefetch is not None else 2 * self.num_workers
+
+        if batch_sampler is None:
+            if sampler is None:
+                sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        self.batch_sampler = batch_sampler
+        self._stats = {}
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+    def load_batch(self, indices):
+        batch = self.collate_fn([self.dataset[i] for i in indices])
+        if self.pin_memory:
+            batch = pin_memory_batch(batch)
+        return batch
+
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+    def __iter__(self):
+        pool = ThreadPool(self.num_workers)
+        pending = deque()
+        m = {'batches': 0, 'wait_sec': 0.0, 'depth_sum': 0, 'depth_max': 0}
+        t_start = time.time()
+
+        def take():
+            depth = sum([1 for p in pending if p.ready()])
+            t = time.time()
+            batch = pending.popleft().get()
+            m['wait_sec'] += time.time() - t
+            m['batches'] += 1
+            m['depth_sum'] += depth
+            m['depth_max'] = max(m['depth_max'], depth)
+            return batch
+
+        try:
+            for indices in self.batch_sampler:
+                pending.append(pool.apply_async(self.load_batch, (indices,)))
+                if len(pending) >= self.prefetch:
+                    yield take()
+            while pending:
+                yield take()
+        finally:
+            pool.terminate()
+            with self._lock:
+                self._stats = {'batches': m['batches'],
+                               'wait_sec': m['wait_sec'],
+                               'wait_frac': m['wait_sec'] / max(time.time() - t_start, 1e-9),
+                               'depth_avg': m['depth_sum'] / float(max(m['batches'], 1)),
+                               'depth_max': m['depth_max']}
@@ -13,6 +13,8 @@ import math
 from glob import glob
 from collections import OrderedDict
 import subprocess
+import tempfile
+import multiprocessing
 
 from tqdm import tqdm
 
@@ -27,17 +29,27 @@ from torch.autograd import Variable
 from torch.optim.lr_scheduler import LambdaLR, MultiStepLR
 from reduce_lr_on_plateau2 import ReduceLROnPlateau2
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.sampler import SequentialSampler, RandomSampler, BatchSampler
 
 import cv2
 
 from meter import NamedMeter
 
-from img_proc import numpy_img_to_torch, torch_img_to_numpy, torch_flip, torch_rot90, postprocess_prediction
+from img_proc import numpy_img_to_torch, torch_img_to_numpy, torch_flip, torch_rot90, postprocess_prediction, postprocess_prediction_rles
 
-from utils import mkdir_p, csv_list, int_list, float_dict, strip_end, init_logging, labels_to_rles, get_latest_checkpoint_file, get_checkpoint_file, checkpoint_file_from_dir, moving_average, as_py_scalar, stop_current_instance, get_learning_rate
+from utils import mkdir_p, csv_list, int_list, float_dict, strip_end, init_logging, labels_to_rles, get_latest_checkpoint_file, get_checkpoint_file, checkpoint_file_from_dir, moving_average, as_py_scalar, stop_current_instance, get_learning_rate, get_children_rss, fork_map
 from metrics_log import get_the_log, set_the_log, clear_log, insert_log, get_latest_log, get_log
 
 from dataset import NucleusDataset
+from stream import TestImageStream
+from image_reader import ImageReader, ArrayReader, iter_tiles
+from prerender_augment import PrerenderedStore
+from loaders import ThreadDataLoader
+from batch_ring import BatchRing, SlotDataset, SlotBatchSampler, RingLoader
+from samplers import SizeBucketBatchSampler, ShardShuffleSampler, CostBalancedBatchSampler, ClusterSampler, pad_collate
+from dedup import cluster_summary
+from batch_aug import BatchAugment
 
 from architectures import CNNSimple, UNetClassify, UNetClassifyMulti, init_weights
 
@@ -378,6 +390,24 @@ def apply_criteria(data_row,
     apply_weights(data_row, targets, instance_weight_field, use_class_weights, meter)
 
 
+    # padded batches: only count valid pixels, and weight each image as if it was not padded.
+    # the loss is then the average over images of the per-image pixel average.
+
+    batch_size = data_row[targets[0]['col']].size()[0]
+    n = 1
+    if 'valid_mask' in data_row:
+        n = batch_size
+        valid_mask = data_row['valid_mask']
+        if valid_mask.min() < 1.0:
+            hw = valid_mask.size(2) * valid_mask.size(3)
+            n_valid = valid_mask.view(batch_size, -1).sum(1).view(-1, 1, 1, 1)
+            pixel_w = dev(valid_mask * hw / n_valid)
+            for target in targets:
+                if not isinstance(target['crit'], nn.BCEWithLogitsLoss):
+                    raise ValueError('padded batches are only supported with the bce criterion')
+                target['crit'].weight = target['crit'].weight * pixel_w
+
+
     # apply criteria
 
     losses = {}
@@ -392,23 +422,29 @@ def apply_criteria(data_row,
 
         l = criterion(pred[name], target)
         losses[name] = l
-        meter.update(name, as_py_scalar(l))
+        meter.update(name, as_py_scalar(l), n)
 
 
     # calculate iou
 
     if calc_iou:
         pred_seg = pred[pred_field_iou]
-        for n in range(pred_seg.size()[0]):
-            pred_l, _ = postprocess_prediction(pred_seg[n], max_clusters_for_dilation=max_clusters_for_dilation)
-            meter.update('iou',
-                iou_metric(data_row[target_field_iou][n].numpy().squeeze(), pred_l))
+        for j in range(pred_seg.size()[0]):
+            p = pred_seg[j]
+            t = data_row[target_field_iou][j]
+            if 'size_hw' in data_row:
+                # strip padding
+                h, w = [int(x) for x in data_row['size_hw'][j]]
+                p = p[:, :h, :w]
+                t = t[:, :h, :w]
+            pred_l, _ = postprocess_prediction(p, max_clusters_for_dilation=max_clusters_for_dilation)
+            meter.update('iou', iou_metric(t.numpy().squeeze(), pred_l))
 
 
     # sum total loss, and add it to meter
 
     total_loss = torch.sum(torch.cat([losses[target['name']] * target['w_crit'] for target in targets]))
-    meter.update('loss', as_py_scalar(total_loss))
+    meter.update('loss', as_py_scalar(total_loss), n)
     return total_loss
 
 
@@ -474,20 +510,136 @@ def validate(
     stats.update('time', time_end - time_start)
 
 
+def make_loader(dset, args, num_workers=None, **options):
+    """DataLoader with args.workers processes, or ThreadDataLoader with args.workers threads (--loader)"""
+    if num_workers is None:
+        num_workers = args.workers
+    if args.loader == 'thread':
+        return ThreadDataLoader(dset, pin_memory=(args.cuda > 0), num_workers=num_workers,
+                                prefetch=(args.loader_prefetch or None), **options)
+    return DataLoader(dset, pin_memory=(args.cuda > 0), num_workers=num_workers, **options)
+
+
+def cache_valid_tensors(dset, args):
+    """keep the return_fields of a validation set as ready tensors (--valid-tensor-cache-mb)"""
+    if args.valid_tensor_cache_mb > 0 and args.lazy == 0:
+        dset.cache_tensors(args.valid_tensor_cache_mb * 1024**2)
+
+
+def loader_stats_message(loader):
+    msgs = []
+    if isinstance(loader, RingLoader):
+        if loader.detached > 0:
+            msgs.append('%d batches copied out of the ring' % loader.detached)
+        loader = loader.loader
+    if isinstance(loader, ThreadDataLoader):
+        st = loader.stats()
+        msgs.append('wait %.1fs (%.0f%%), ready batches avg %.1f max %d' % (
+            st['wait_sec'], 100.0 * st['wait_frac'], st['depth_avg'], st['depth_max']))
+    batch_sampler = loader.batch_sampler
+    if isinstance(batch_sampler, SlotBatchSampler):
+        batch_sampler = batch_sampler.batch_sampler
+    if isinstance(batch_sampler, CostBalancedBatchSampler) and batch_sampler.imbalance is not None:
+        msgs.append('max/mean batch cost %.2f' % batch_sampler.imbalance)
+    return '; '.join(msgs) if msgs else None
+
+
+def make_eval_loader(dset, args):
+    """
+    data loader for original images of varying sizes (validation and scoring).
+
+    for batch sizes > 1, images are grouped by (padded) size; see SizeBucketBatchSampler.
+    """
+    if dset.item_time is None:
+        dset.enable_timing()
+    # cached tensors are collated faster in the main process than passed back from workers
+    workers = 0 if dset.tensor_cache is not None else args.workers
+    if args.valid_batch_size <= 1:
+        if args.cost_balance > 0:
+            sampler = CostBalancedBatchSampler(dset.item_costs, 1, shuffle=False)
+            return make_loader(dset, args, num_workers=workers, batch_sampler=sampler)
+        return make_loader(dset, args, num_workers=workers, batch_size=1, shuffle=True)
+
+    sampler = SizeBucketBatchSampler(dset.image_sizes(args.input_field), args.valid_batch_size,
+                                     max_pad_ratio=args.valid_max_pad_ratio, shuffle=True)
+    return make_loader(dset, args, num_workers=workers, batch_sampler=sampler, collate_fn=pad_collate)
+
+
 def make_submission(dset, model, args, pred_field_iou='seg'):
     """generate file with run-length encoded predictions as required for kaggle submission"""
 
     dset.preprocess()
+    samples = ((dset.get_field('id', i), dset.get_field(args.input_field, i)) for i in range(len(dset)))
+    write_submission(samples, model, args, pred_field_iou, total=len(dset))
+
+
+def make_submission_stream(stream, model, args, pred_field_iou='seg'):
+    """like make_submission, for images from a TestImageStream"""
+    samples = ((sample['id'], sample[args.input_field]) for sample in stream)
+    write_submission(samples, model, args, pred_field_iou)
+
+
+def predict_tiled(model, reader, args):
+    """
+    predict an image tile by tile, reading only one tile at a time.
+
+    tiles overlap by --infer-tile-overlap pixels; each tile contributes its interior, without half of the
+    overlap at borders shared with other tiles. The stitched predictions are memory-mapped temporary files.
+    returns a dict of target name -> prediction (height x width), and the temporary directory.
+    """
+
+    h, w = reader.shape[:2]
+    tile = args.infer_tile_size
+    margin = args.infer_tile_overlap // 2
+    tmp_dir = tempfile.mkdtemp(dir=args.out_dir)
+    out = {}
+    for top, left, th, tw in iter_tiles(reader.shape, tile, args.infer_tile_overlap):
+        img = reader.read((top, left, th, tw))
+        pred = run_model(model, numpy_img_to_torch(img, True), train=False, tta=args.tta)
+
+        y0 = 0 if top == 0 else margin
+        x0 = 0 if left == 0 else margin
+        y1 = th if top + th == h else th - margin
+        x1 = tw if left + tw == w else tw - margin
+        for name, pred_part in pred.items():
+            if name not in out:
+                out[name] = np.lib.format.open_memmap(os.path.join(tmp_dir, '%s.npy' % name), mode='w+',
+                                                      dtype=np.float32, shape=(h, w))
+            out[name][top + y0:top + y1, left + x0:left + x1] = pred_part.data.cpu().numpy().squeeze()[y0:y1, x0:x1]
+    return out, tmp_dir
+
+
+def write_submission(samples, model, args, pred_field_iou='seg', total=None):
+    """predict (id, image) pairs, and write the run-length encoded predictions"""
+
     model.eval()
 
-    preds = []
-    for i in tqdm(range(len(dset.data_df))):
-        img = dset.data_df[args.input_field].iloc[i]
+    out_pred_list = []
+    n_images = 0
+    for i, (img_id, img) in enumerate(tqdm(samples, total=total)):
+
+        # large images, and images that are not decoded (see TestImageStream), are predicted in tiles
+        reader = img if isinstance(img, ImageReader) else None
+        if reader is None and args.infer_tile_size > 0 and max(img.shape[:2]) > args.infer_tile_size:
+            reader = ArrayReader(img)
+        if reader is not None:
+            pred, tmp_dir = predict_tiled(model, reader, args)
+            # post-processed in stripes, without full-size label images
+            for c_rle in postprocess_prediction_rles(pred[pred_field_iou], tmp_dir,
+                                                     stripe_pixels=args.infer_tile_size ** 2):
+                out_pred_list.append({'ImageId': img_id,
+                                      'EncodedPixels': ' '.join(np.array(c_rle).astype(str))})
+            pred = None
+            shutil.rmtree(tmp_dir)
+            reader.close()
+            n_images += 1
+            continue
+
         pred =run_model(model, numpy_img_to_torch(img, True), train=False, tta=args.tta)
 
         pred_l, pred_seg = postprocess_prediction(
             pred[pred_field_iou], max_clusters_for_dilation=1e20)  # highest precision
-        preds.append(pred_l)
+        n_images += 1
 
         if 1:
             # generate images for visual inspection
@@ -513,20 +665,14 @@ def make_submission(dset, model, args, pred_field_iou='seg'):
                     os.path.join(args.out_dir, 'img_%s.%d.png' % (args.experiment, i)))
             plt.close()
 
-    dset.data_df['pred'] = preds
-
-    dset.data_df['rles'] = dset.data_df['pred'].map(
-        lambda x: list(labels_to_rles(x)))
-
-    out_pred_list = []
-    for _, c_row in tqdm(dset.data_df.iterrows()):
-        for c_rle in c_row['rles']:
-            out_pred_list.append({'ImageId': c_row['id'],
+        # encode right away, rather than keeping all label images
+        for c_rle in labels_to_rles(pred_l):
+            out_pred_list.append({'ImageId': img_id,
                                   'EncodedPixels': ' '.join(np.array(c_rle).astype(str))})
 
-    out_pred_df = pd.DataFrame(out_pred_list)
+    out_pred_df = pd.DataFrame(out_pred_list, columns=['ImageId', 'EncodedPixels'])
     msg = '%d regions found for %d images; writing predictions to %s' % (
-        out_pred_df.shape[0], dset.data_df.shape[0], args.predictions_file)
+        out_pred_df.shape[0], n_images, args.predictions_file)
     logging.info(msg)
     print msg
     out_pred_df[['ImageId', 'EncodedPixels']].to_csv(
@@ -628,8 +774,18 @@ def train_epoch(train_loader,
 
         num_acc = len(acc)
         acc = []
+        if isinstance(train_loader, RingLoader):
+            # batch buffers can be refilled
+            train_loader.recycle()
         train_loss = stats_train['loss'].last
 
+        if global_state['args'].workers > 0 and (it % 20 == 0 or it == it_last):
+            # memory of data loader workers, to check for copy-on-write growth
+            rss = get_children_rss()
+            if rss:
+                stats_train.update('worker_rss', max([r[0] for r in rss.values()]))
+                stats_train.update('worker_rss_anon', max([r[1] for r in rss.values()]))
+
         if math.isnan(train_loss):
             msg = 'iteration %d - training blew up ...' % it
             logging.error(msg)
@@ -699,6 +855,138 @@ def train_epoch(train_loader,
     return stats_train, stats_valid
 
 
+def make_model(args, targets):
+    """create and initialize a new model"""
+
+    if args.arch == 'simple':
+        model = CNNSimple(32)
+    else:
+        model = UNetClassifyMulti(targets, layers=4, init_filters=16)
+
+    if args.weight_init_method != 'default' or len(args.init_output_bias) > 0:
+        init_weights(model, args.weight_init_method, args.init_output_bias)
+    return dev(model)
+
+
+def make_optimizer(model, args):
+    if args.optim == 'adam':
+        optimizer = optim.Adam(model.parameters(), args.lr,
+                               weight_decay=args.weight_decay)
+    elif args.optim == 'sgd':
+        optimizer = optim.SGD(model.parameters(), args.lr,
+                              momentum=args.momentum,
+                              weight_decay=args.weight_decay)
+    elif args.optim == 'lbfgs':
+        optimizer = optim.LBFGS(model.parameters(),
+                                lr=args.lr,
+                                max_iter=args.lbfgs_max_iter,
+                                history_size=args.lbfgs_history_size,
+                                tolerance_change=args.lbfgs_tolerance_change)
+    else:
+        raise ValueError('unknown optimizer: %s' % args.optim)
+    return optimizer
+
+
+def make_scheduler(optimizer, args):
+    """learning rate scheduler, or None"""
+    scheduler = None
+    if args.scheduler == 'plateau':
+        scheduler = ReduceLROnPlateau2(
+            optimizer,
+            factor=args.lr_decay,
+            patience=args.patience,
+            patience_threshold=args.patience_threshold,
+            cooldown=args.cooldown,
+            min_lr=args.min_lr,
+            verbose=1)
+    elif args.scheduler == 'multistep':
+        if args.scheduler_milestones is None or len(
+                args.scheduler_milestones) == 0:
+            raise ValueError(
+                'scheduler-milestones cannot be empty for multi-step')
+        scheduler = MultiStepLR(optimizer, args.scheduler_milestones)
+    elif args.scheduler == 'exp':
+        scheduler = LambdaLR(optimizer, lr_lambda=lambda epoch: args.lr_decay)
+    return scheduler
+
+
+def make_train_loader(dset, args):
+    if args.prerendered is not None:
+        dset.use_prerendered(PrerenderedStore(args.prerendered), args.prerendered_live_fraction)
+    collate_fn = default_collate
+    if args.augment_mode == 'batched':
+        collate_fn = BatchAugment(args.train_img_size, p_rot90=args.augment_rot90)
+    if dset.item_time is None:
+        dset.enable_timing()
+    shards = dset.shard_ids()
+    if args.dedup_sampling != 'none':
+        sampler = ClusterSampler([dset.get_field('cluster', i) for i in range(len(dset))], args.dedup_sampling)
+        logging.info('near-duplicate sampling (%s): %d of %d samples per epoch' % (args.dedup_sampling, len(sampler), len(dset)))
+        options = {'batch_size': args.batch_size, 'sampler': sampler}
+    elif args.cost_balance > 0:
+        options = {'batch_sampler': CostBalancedBatchSampler(dset.item_costs, args.batch_size)}
+    elif shards is not None:
+        options = {'batch_size': args.batch_size, 'sampler': ShardShuffleSampler(shards, args.shards_per_block)}
+    else:
+        options = {'batch_size': args.batch_size, 'shuffle': True}
+    if args.batch_ring > 0:
+        if args.augment_mode == 'batched':
+            raise ValueError('--batch-ring cannot be combined with --augment-mode batched')
+        return make_ring_loader(dset, args, **options)
+    return make_loader(dset, args, collate_fn=collate_fn, **options)
+
+
+def make_ring_loader(dset, args, batch_size=1, shuffle=False, sampler=None, batch_sampler=None):
+    """
+    training loader that collates into a ring of preallocated shared batch buffers (--batch-ring);
+    see batch_ring.py. the training loop has to call recycle() after each optimizer step.
+    """
+    if batch_sampler is None:
+        if sampler is None:
+            sampler = RandomSampler(dset) if shuffle else SequentialSampler(dset)
+        batch_sampler = BatchSampler(sampler, batch_size, False)
+
+    # batches loaded ahead of the one being consumed
+    if args.loader == 'thread':
+        in_flight = args.loader_prefetch or 2 * max(args.workers, 1)
+    else:
+        in_flight = 2 * args.workers
+    n_slots = args.batch_ring_slots or in_flight + max(args.grad_accum, 1) + 1
+    if n_slots < in_flight + 2:
+        # otherwise, batch k + n_slots could take the slot before batch k
+        raise ValueError('--batch-ring-slots must be at least %d (batches in flight + 2)' % (in_flight + 2))
+
+    ring = BatchRing(n_slots, args.batch_size, dset[0])
+    logging.info('batch ring: %d slots, %.1f MB shared memory' % (n_slots, ring.nbytes / 1024.0**2))
+    loader = make_loader(SlotDataset(dset), args, batch_sampler=SlotBatchSampler(batch_sampler, n_slots),
+                         collate_fn=ring.collate)
+    return RingLoader(loader, ring)
+
+
+def get_return_fields(args, targets):
+    """fields the data loader should return, for training and for validation"""
+    fields_valid = [args.input_field]
+    for target in targets:
+        fields_valid.append(target['col'])
+    if 'masks_prep' not in fields_valid:
+        fields_valid.append('masks_prep') # for iou
+    fields_train = [x for x in fields_valid]
+    if args.instance_weights is not None:
+        fields_train.append(args.instance_weights)
+    return fields_train, fields_valid
+
+
+def init_global_state(args):
+    return {'epoch': -1,
+            'it': -1,
+            'best_loss': 1e20,
+            'best_it': 0,
+            'best_iou': 0.0,
+            'best_iou_it': 0,
+            'lr': args.lr,
+            'args': args}
+
+
 def make_criterion(args):
     """create a training criterion"""
     if args.instance_weights is not None and args.criterion != 'bce':
@@ -750,6 +1038,9 @@ def epoch_logging_message(global_state, targets, stats_train, stats_valid, len_t
     if global_state['args'].cuda > 0 and stats_train['gpu_mem'].count > 0:
         msg += '\tgpu_mem=%d' % stats_train['gpu_mem'].avg
 
+    if stats_train['worker_rss'].count > 0:
+        msg += '\tworker rss=%d MB (anon=%d MB)' % (stats_train['worker_rss'].max, stats_train['worker_rss_anon'].max)
+
     return msg
 
 
@@ -792,6 +1083,239 @@ def parse_targets(args):
 
     return targets
 
+def train(train_dset, valid_dset, train_loader, valid_loader, targets, model, optimizer, scheduler, global_state, time_start):
+
+    """
+    run the training epochs, with checkpointing and recovery from blowups.
+
+    returns the validation stats of the last epoch, and whether training was stopped due to the time limit.
+    """
+
+    args = global_state['args']
+    stats_valid = None
+
+    recovered_ckpt = None
+    recovery_attempts = 0
+    last_epoch_loss = get_latest_log('train_avg_loss', 1e20)[0]
+
+    for global_state['epoch'] in range(global_state['epoch'] + 1, args.epochs):
+        epoch = global_state['epoch']
+        try:
+            t_epoch, busy_train, busy_valid = time.time(), train_dset.busy_time(), valid_dset.busy_time()
+            stats_train, stats_valid = train_epoch(train_loader, valid_loader, targets, model, optimizer, scheduler, args.eval_every, args.print_every, args.save_every, global_state)
+
+            msg = epoch_logging_message(global_state, targets, stats_train, stats_valid, len(train_dset), len(valid_dset))
+
+            logging.info(msg)
+
+            if args.lazy > 0:
+                for name, d in (('train', train_dset), ('valid', valid_dset)):
+                    logging.info('[%d] %s sample cache (counters over all workers, items/bytes of the main process only): %s' % (epoch, name, d.cache_stats()))
+
+            # worker idle time: loader capacity (workers x epoch time) not spent in __getitem__
+            t_epoch = time.time() - t_epoch
+            busy = train_dset.busy_time() - busy_train + valid_dset.busy_time() - busy_valid
+            workers = max(args.workers, 1)
+            logging.info('[%d] epoch time %.1fs; loader workers busy %.1fs, idle %.1fs (%.0f%%)' % (
+                epoch, t_epoch, busy, workers * t_epoch - busy, 100.0 * (1.0 - busy / (workers * t_epoch))))
+
+            for name, loader in (('train', train_loader), ('valid', valid_loader)):
+                msg = loader_stats_message(loader)
+                if msg is not None:
+                    logging.info('[%d] %s loader: %s' % (epoch, name, msg))
+
+            it = global_state['it']
+
+            # check for blowup
+            epoch_loss = get_latest_log('train_avg_loss', 1e20)[0]
+            if not math.isnan(last_epoch_loss) and epoch_loss > 100.0 * last_epoch_loss:
+                msg = 'iteration %d - training blew up ...' % it
+                logging.error(msg)
+                raise TrainingBlowupError(msg)
+            last_epoch_loss = epoch_loss
+
+            save_checkpoint(
+                get_checkpoint_file(global_state['args'], it),
+                model,
+                optimizer,
+                global_state)
+
+
+            # check elapsed time
+            time_end = time.time()
+            time_total = time_end - time_start
+            logging.info('[%d, %d] total running time: %d seconds' % (global_state['epoch'], it, time_total))
+            if time_total > args.stop_instance_after:
+                ret = stop_current_instance(False)
+                logging.info(ret)
+                return stats_valid, True
+
+            if global_state['args'].scheduler != 'none':
+                # note: different interface:
+                # ReduceLROnPlateau.step() takes metrics as argument,
+                # other schedulers take epoch number
+                if isinstance(scheduler, ReduceLROnPlateau2):
+                    scheduler.step(epoch_loss, epoch)
+                else:
+                    scheduler.step(epoch)
+
+                lr_new = get_learning_rate(optimizer)
+                lr_old = global_state['lr']
+                if lr_old != lr_new:
+                    logging.info(
+                        '[%d, %d]\tLR changed from %f to %f.' % (epoch, it, lr_old, lr_new))
+                    global_state['lr'] = lr_new
+                elif (args.switch_to_lbfgs and not isinstance(optimizer, optim.LBFGS)
+                      and isinstance(scheduler, ReduceLROnPlateau2)
+                      and scheduler.waiting_to_reduce and lr_old == args.min_lr):
+                    logging.info('[%d, %d]\tminimum learn rate reached, switching scheduler to lbfgs' %
+                                 (epoch, it))
+                    lr = 0.8
+                    optimizer = optim.LBFGS(
+                        model.parameters(),
+                        lr=lr,
+                        max_iter=args.lbfgs_max_iter,
+                        history_size=args.lbfgs_history_size,
+                        tolerance_change=args.lbfgs_tolerance_change)
+                    global_state['args'].grad_accum = len(train_loader)
+                    args.grad_accum = len(train_loader)
+                    global_state['args'].optim == 'lbfgs'
+                    args.optim = 'lbfgs'
+                    global_state['args'].clip_gradient = 1e20
+                    args.clip_gradient = 0
+                    global_state['args'].scheduler = 'plateau'
+                    args.scheduler = 'plateau'
+                    global_state['lr'] = lr
+
+                    scheduler = ReduceLROnPlateau2(optimizer,
+                                                   factor=0.9,
+                                                   patience=1,
+                                                   patience_threshold=0.1,
+                                                   min_lr=0.1, verbose=1)
+
+        except TrainingBlowupError:
+            # numerical instability, try to recover
+            # sometime lbfgs blows up, gradient clipping is not applicable
+            # restart with reduced learn rate
+            if isinstance(optimizer, optim.LBFGS):
+                ckpt = get_latest_checkpoint_file(args)
+                if recovered_ckpt == ckpt:
+                    # have tried previously the same checkpoint, reduce lr
+                    recovery_attempts += 1
+                else:
+                    recovery_attempts = 1
+                recovered_ckpt = ckpt
+
+                min_lr = 0.1
+                lr = max(global_state['lr'] * .5, min_lr)
+                if lr >= global_state['lr']:
+                    msg = 'attempt %d: using lbfgs and lr (%f) already at min_lr (%f), giving up' % (
+                        recovery_attempts, global_state['lr'], min_lr)
+                    logging.error(msg)
+                    raise
+                model = load_checkpoint(ckpt,
+                                        model,
+                                        optimizer,
+                                        global_state)
+                global_state['lr'] = lr
+                optimizer = optim.LBFGS(model.parameters(),
+                                        lr=lr,
+                                        max_iter=args.lbfgs_max_iter,
+                                        history_size=args.lbfgs_history_size,
+                                        tolerance_change=args.lbfgs_tolerance_change)
+                global_state['args'].grad_accum = len(train_loader)
+                args.grad_accum = len(train_loader)
+                global_state['args'].optim = 'lbfgs'
+                args.optim = 'lbfgs'
+                global_state['args'].clip_gradient = 1e20
+                args.clip_gradient = 1e20
+                global_state['args'].scheduler = 'plateau'
+                args.scheduler = 'plateau'
+
+                scheduler = ReduceLROnPlateau2(optimizer,
+                                               factor=0.9,
+                                               patience=1,
+                                               patience_threshold=0.1,
+                                               min_lr=0.1, verbose=1)
+
+                logging.error(
+                    'recovered from checkpoint %s (attempt %d), lr = %f. keeping fingers crossed ...' %
+                    (ckpt, recovery_attempts, lr))
+            else:
+                logging.error('cannot recover ... terminating.')
+                raise
+
+    return stats_valid, False
+
+
+def run_folds(dset, targets, args, time_start):
+
+    """
+    k-fold cross validation: train a new model on each fold, and report per-fold and average iou.
+
+    the data is loaded and preprocessed once; folds are views on it. Each fold writes its
+    checkpoints and log to <out_dir>/fold<k>, under the experiment name <experiment>_fold<k>.
+    """
+
+    folds = dset.kfold_split(args.folds, random_state=args.random_seed, stratify=(args.stratify > 0),
+                             shared_memory=(args.shared_memory > 0), by_cluster=(args.dedup_split > 0))
+    fields_train, fields_valid = get_return_fields(args, targets)
+
+    def run_fold(k):
+        fold_args = copy.copy(args)
+        fold_args.experiment = '%s_fold%d' % (args.experiment, k)
+        fold_args.out_dir = os.path.join(args.out_dir, 'fold%d' % k)
+        mkdir_p(fold_args.out_dir)
+
+        if args.random_seed is not None:
+            np.random.seed(args.random_seed)
+            torch.manual_seed(args.random_seed)
+
+        clear_log()
+        global_state = init_global_state(fold_args)
+        model = make_model(fold_args, targets)
+        optimizer = make_optimizer(model, fold_args)
+        scheduler = make_scheduler(optimizer, fold_args)
+
+        train_dset, valid_dset = folds[k]
+        train_dset.return_fields = fields_train
+        valid_dset.return_fields = fields_valid
+        cache_valid_tensors(valid_dset, fold_args)
+        logging.info('fold %d: train set size: %d; test set size: %d' % (k, len(train_dset), len(valid_dset)))
+
+        stats_valid, timed_out = train(train_dset, valid_dset, make_train_loader(train_dset, fold_args),
+                                       make_eval_loader(valid_dset, fold_args), targets, model, optimizer,
+                                       scheduler, global_state, time_start)
+        iou = stats_valid['iou'].avg if stats_valid is not None else float('nan')
+        return {'iou': iou, 'best_iou': global_state['best_iou'], 'epoch': global_state['epoch'], 'timed_out': timed_out}
+
+    if args.fold_workers <= 1:
+        results = []
+        for k in range(args.folds):
+            results.append(run_fold(k))
+            if results[-1]['timed_out']:
+                logging.info('time limit reached, skipping remaining folds')
+                break
+    else:
+        # partition the cpu threads among concurrent folds
+        n_threads = max(1, multiprocessing.cpu_count() // args.fold_workers)
+        results = fork_map(run_fold, range(args.folds), args.fold_workers,
+                           init=lambda: torch.set_num_threads(n_threads))
+
+    msg = 'cross validation (%d folds):' % args.folds
+    for k, r in enumerate(results):
+        msg += '\n  fold %d: epoch %d\tvalid iou = %.4f\tbest smoothed valid iou = %.4f' % (k, r['epoch'], r['iou'], r['best_iou'])
+    ious = np.array([r['iou'] for r in results])
+    msg += '\n  mean valid iou = %.4f +- %.4f' % (ious.mean(), ious.std())
+    logging.info(msg)
+    print msg
+
+    if args.stop_instance_after > 0:
+        ret = stop_current_instance(False)
+        logging.info(ret)
+    return 0
+
+
 def main():
     parser = configargparse.ArgumentParser(description='training and testing of NN model.')
     parser.add('--config', '-c', default='default.cfg', is_config_file=True, help='config file path [default: %(default)s])')
@@ -807,12 +1331,28 @@ def main():
     parser.add('--data', '-d', metavar='DIR', required=True, help='path to dataset')
     parser.add('--stage', '-s', default='stage1', help='stage [default: %(default)s]')
     parser.add('--group', '-g', default='train', help='group name [default: %(default)s]')
+    parser.add('--manifest', help='dataset manifest, see manifest.py [default: <data>/<stage>_<group>_manifest.csv, if it exists]')
+    parser.add('--stream-test', type=int, default=0, help='in submit mode, decode and predict test images one by one with read-ahead, instead of loading the whole set first [default: %(default)s]')
+    parser.add('--stream-prefetch', metavar='N', type=int, default=4, help='with --stream-test, maximum number of images decoded ahead of inference [default: %(default)s]')
+    parser.add('--infer-tile-size', metavar='N', type=int, default=0, help='in submit mode, predict images larger than this in tiles of this size; 0 means no tiling [default: %(default)s]')
+    parser.add('--infer-tile-overlap', metavar='N', type=int, default=32, help='overlap between inference tiles [default: %(default)s]')
+    parser.add('--max-decode-pixels', metavar='N', type=int, default=0, help='images with more pixels are not decoded whole: in submit mode with --stream-test, they are read tile by tile (requires --infer-tile-size); in lazy training, random windows around the training crops are read; 0 means no limit [default: %(default)s]')
+    parser.add('--archive', metavar='ZIP', help='read images and masks from a zip archive without extracting it [default: <data>/<stage>_<group>.zip, if <data>/<stage>_<group> does not exist]')
+    parser.add('--shards', metavar='DIR', help='read images and label images from packed shards (see shards.py) instead of --data [default: %(default)s]')
+    parser.add('--shards-per-block', metavar='N', type=int, default=2, help='with --shards, training samples are shuffled within blocks of N randomly ordered shards [default: %(default)s]')
+    parser.add('--labels-csv', help='run-length encoded ground truth (columns ImageId, EncodedPixels), read instead of the mask files [default: %(default)s]')
+    parser.add('--cache-dir', help='directory for caching decoded images and masks between runs [default: %(default)s]')
     parser.add('--train-img-size', type=int_list, default='192,192', help='image size to used during training [default: %(default)s]')
     parser.add('--train-img-size-mode', choices=('crop', 'resize', 'keep'), default='crop', help='resize or crop training images to obtain consistent sizes [default: %(default)s]')
     parser.add('--valid-fraction', '-v', type=float, default=0.25, help='validation set fraction [default: %(default)s]')
+    parser.add('--folds', metavar='K', type=int, default=0, help='k-fold cross validation with K folds, instead of a single split with --valid-fraction [default: %(default)s]')
+    parser.add('--fold-workers', metavar='N', type=int, default=1, help='number of folds to train concurrently; cpu threads are divided among them [default: %(default)s]')
     parser.add('--stratify', type=int, default=1, help='stratify train/test split according to image size [default: %(default)s]')
     parser.add('--epochs', metavar='N', type=int, default=1, help='number of total epochs to run [default: %(default)s]')
     parser.add('--batch-size', '-b', metavar='N', type=int, default=1, help='mini-batch size [default: %(default)s]')
+    parser.add('--valid-batch-size', metavar='N', type=int, default=1, help='mini-batch size for validation and scoring; images are grouped by size [default: %(default)s]')
+    parser.add('--valid-tensor-cache-mb', metavar='MB', type=int, default=2048, help='keep validation samples as ready tensors, if they fit in MB; 0 disables the cache [default: %(default)s]')
+    parser.add('--valid-max-pad-ratio', type=float, default=0.0, help='for validation batches, group images of different sizes if padding increases the area by at most this fraction (bce criterion only). Note: predictions near the padded border can differ [default: %(default)s]')
     parser.add('--grad-accum', metavar='N', type=int, default=1, help='number of batches between gradient descent [default: %(default)s]')
     parser.add('--weight-init-method', default='kaiming', choices=('kaiming', 'xavier', 'default'), help='weight initialization method default: %(default)s]')
     parser.add('--init-output-bias', type=float_dict, help='initialize biases of output layers to match average value, in the form <target name1>:<value1>,<target name2>:<value2>, default='',... ')
@@ -843,6 +1383,23 @@ def main():
     parser.add('--verbose', '-V', type=int, default=0, help='verbose logging')
     parser.add('--log-file', help='write logging output to file')
     parser.add('--workers', metavar='N', type=int, default=1, help='number of data loader workers [default: %(default)s]')
+    parser.add('--dedup-sampling', choices=('none', 'dedup', 'weight'), default='none', help='training epochs with one random image per near-duplicate cluster, or images drawn with weight 1 / cluster size [default: %(default)s]')
+    parser.add('--dedup-split', type=int, default=0, help='keep near-duplicate clusters on one side of the train/validation split (instead of stratifying) [default: %(default)s]')
+    parser.add('--dedup-max-distance', metavar='BITS', type=int, default=6, help='images whose 64-bit perceptual hashes differ in at most BITS bits are near-duplicates [default: %(default)s]')
+    parser.add('--cost-balance', type=int, default=0, help='balance the loading cost of minibatches, estimated from image sizes and measured timings (takes precedence over --shards-per-block) [default: %(default)s]')
+    parser.add('--loader', choices=('process', 'thread'), default='process', help='data loader workers are processes (torch DataLoader) or threads (see loaders.py) [default: %(default)s]')
+    parser.add('--batch-ring', type=int, default=0, help='workers write training batches into a ring of preallocated shared-memory buffers, reused after each optimizer step [default: %(default)s]')
+    parser.add('--batch-ring-slots', metavar='N', type=int, default=0, help='with --batch-ring, number of batch buffers; 0 means batches in flight + grad accumulation + 1 [default: %(default)s]')
+    parser.add('--loader-prefetch', metavar='N', type=int, default=0, help='with --loader thread, maximum number of batches in flight; 0 means 2 x workers [default: %(default)s]')
+    parser.add('--augment-mode', choices=('sequential', 'crop_first', 'fused', 'batched'), default='sequential', help='geometric augmentation: transform the full image, then crop; only warp the crop region; crop-first with one transform for all fields of a sample; or augment whole minibatches in the collate function [default: %(default)s]')
+    parser.add('--prerendered', metavar='DIR', help='read augmented training samples pre-rendered by prerender_augment.py [default: %(default)s]')
+    parser.add('--prerendered-live-fraction', type=float, default=0.0, help='with --prerendered, fraction of training samples that are still augmented live [default: %(default)s]')
+    parser.add('--color-lut', type=int, default=0, help='color augmentation without the imgaug chain: the channel add goes through a lookup table (HSV branches still convert colorspaces) [default: %(default)s]')
+    parser.add('--augment-rot90', type=float, default=0.0, help='with --augment-mode batched, probability of an additional rotation by a multiple of 90 degrees [default: %(default)s]')
+    parser.add('--lazy', type=int, default=0, help='decode and preprocess images on demand instead of holding the whole dataset in memory [default: %(default)s]')
+    parser.add('--lazy-cache-mb', type=int, default=1024, help='in lazy mode, memory for caching decoded samples, per dataset and loader process [default: %(default)s]')
+    parser.add('--shared-memory', type=int, default=0, help='keep preprocessed data in shared memory, so that data loader workers do not copy it [default: %(default)s]')
+    parser.add('--load-workers', metavar='N', type=int, default=1, help='number of processes for decoding images and masks at startup [default: %(default)s]')
     parser.add('--cuda', type=int, default=0, help='use cuda [default: %(default)s]')
     parser.add('--cuda-benchmark', type=int, default=0, help='use cuda benchmark mode [default: %(default)s]')
     parser.add('--stop-instance-after', metavar='SEC', type=int, default=2592000, help='when running on EC2, stop the instance after that many seconds (or at exit) [default: %(default)s]')
@@ -886,14 +1443,7 @@ def main():
         torch.manual_seed(args.random_seed)
         torch.cuda.manual_seed_all(args.random_seed)
 
-    global_state = {'epoch': -1,
-                    'it': -1,
-                    'best_loss': 1e20,
-                    'best_it': 0,
-                    'best_iou': 0.0,
-                    'best_iou_it': 0,
-                    'lr': args.lr,
-                    'args': args}
+    global_state = init_global_state(args)
 
     # parse target(s)
 
@@ -910,6 +1460,16 @@ def main():
     if args.do != 'train' and args.resume is None:
         raise ValueError('--resume must be specified')
 
+    if args.do == 'submit' and args.stream_test > 0 and args.max_decode_pixels > 0 and args.infer_tile_size <= 0:
+        raise ValueError('--max-decode-pixels in submit mode requires --infer-tile-size')
+
+    if args.folds > 1 and (args.do != 'train' or args.resume is not None):
+        raise ValueError('--folds is only supported for training from scratch')
+    if args.folds > 1 and args.fold_workers > 1 and args.cuda > 0:
+        raise ValueError('concurrent folds are not supported with cuda')
+    if args.dedup_sampling != 'none' and args.cost_balance > 0:
+        raise ValueError('--dedup-sampling and --cost-balance cannot be combined')
+
     if args.resume is not None:
         model = load_checkpoint(checkpoint_file_from_dir(args.resume), None, None, global_state)
         # make sure args here is consistent with possibly updated
@@ -933,14 +1493,7 @@ def main():
 
         # create model
 
-        if args.arch == 'simple':
-            model = CNNSimple(32)
-        else:
-            model = UNetClassifyMulti(targets, layers=4, init_filters=16)
-
-        if args.weight_init_method != 'default' or len(args.init_output_bias) > 0:
-            init_weights(model, args.weight_init_method, args.init_output_bias)
-        model = dev(model)
+        model = make_model(args, targets)
 
 
     logging.info('model:\n')
@@ -948,45 +1501,10 @@ def main():
     logging.info('number of parameters: %d\n' %
                  sum([param.nelement() for param in model.parameters()]))
 
-    # set up optimizer
-
-    if args.optim == 'adam':
-        optimizer = optim.Adam(model.parameters(), args.lr,
-                               weight_decay=args.weight_decay)
-    elif args.optim == 'sgd':
-        optimizer = optim.SGD(model.parameters(), args.lr,
-                              momentum=args.momentum,
-                              weight_decay=args.weight_decay)
-    elif args.optim == 'lbfgs':
-        optimizer = optim.LBFGS(model.parameters(),
-                                lr=args.lr,
-                                max_iter=args.lbfgs_max_iter,
-                                history_size=args.lbfgs_history_size,
-                                tolerance_change=args.lbfgs_tolerance_change)
-    else:
-        raise ValueError('unknown optimizer: %s' % args.optim)
-
-
-    # set up learning rate scheduler
+    # set up optimizer and learning rate scheduler
 
-    scheduler = None
-    if args.scheduler == 'plateau':
-        scheduler = ReduceLROnPlateau2(
-            optimizer,
-            factor=args.lr_decay,
-            patience=args.patience,
-            patience_threshold=args.patience_threshold,
-            cooldown=args.cooldown,
-            min_lr=args.min_lr,
-            verbose=1)
-    elif args.scheduler == 'multistep':
-        if args.scheduler_milestones is None or len(
-                args.scheduler_milestones) == 0:
-            raise ValueError(
-                'scheduler-milestones cannot be empty for multi-step')
-        scheduler = MultiStepLR(optimizer, args.scheduler_milestones)
-    elif args.scheduler == 'exp':
-        scheduler = LambdaLR(optimizer, lr_lambda=lambda epoch: args.lr_decay)
+    optimizer = make_optimizer(model, args)
+    scheduler = make_scheduler(optimizer, args)
 
 
     # load data
@@ -1005,7 +1523,25 @@ def main():
             group_name=args.group,
             dset_type=dset_type,
             img_size=args.train_img_size,
-            img_size_mode=args.train_img_size_mode)
+            img_size_mode=args.train_img_size_mode,
+            cache_dir=args.cache_dir,
+            load_workers=args.load_workers,
+            lazy=(args.lazy > 0),
+            lazy_cache_bytes=args.lazy_cache_mb * 1024**2,
+            manifest=args.manifest,
+            augment_mode=args.augment_mode,
+            color_lut=(args.color_lut > 0),
+            max_decode_pixels=(args.max_decode_pixels or None),
+            labels_csv=args.labels_csv,
+            shards=args.shards,
+            archive=args.archive)
+
+    if args.do == 'submit' and args.stream_test > 0:
+        stream = TestImageStream(args.data, args.stage, args.group, img_size=args.train_img_size,
+                                 img_size_mode=args.train_img_size_mode, prefetch=args.stream_prefetch,
+                                 workers=args.load_workers, manifest=args.manifest,
+                                 max_decode_pixels=(args.max_decode_pixels or None))
+        return make_submission_stream(stream, model, args)
 
     timer = timeit.Timer(load_data)
     t, dset = timer.timeit(number=1)
@@ -1018,15 +1554,25 @@ def main():
         return make_submission(dset, model, args)
 
 
+    # near-duplicate clusters
+
+    if args.dedup_sampling != 'none' or args.dedup_split > 0:
+        t = time.time()
+        clusters = dset.duplicate_clusters(args.dedup_max_distance)
+        logging.info('near-duplicates (%.1fs): %s' % (time.time() - t, cluster_summary(clusters)))
+
+
+    # cross validation
+
+    if args.folds > 1:
+        return run_folds(dset, targets, args, time_start)
+
+
     # split data
 
-    batch_size_train = args.batch_size
-    if args.do != 'train':
-        # original images have varying dimensions, but minibatching requires identical sizes
-        batch_size_train = 1
-    batch_size_valid = 1
     train_dset, valid_dset = dset.train_test_split(
-        test_size = args.valid_fraction, random_state=args.random_seed, shuffle=True, stratify=(args.stratify>0))
+        test_size = args.valid_fraction, random_state=args.random_seed, shuffle=True, stratify=(args.stratify>0),
+        by_cluster=(args.dedup_split > 0))
 
     if args.do in ('score', 'baseline'):
         train_dset.dset_type = 'valid'
@@ -1034,24 +1580,28 @@ def main():
     train_dset.preprocess()
     valid_dset.preprocess()
 
-    train_loader = DataLoader(train_dset, batch_size=batch_size_train, shuffle=True,
-                              pin_memory=(args.cuda > 0), num_workers=args.workers)
-    valid_loader = DataLoader(valid_dset, batch_size=batch_size_valid, shuffle=True,
-                               pin_memory=(args.cuda > 0), num_workers=args.workers)
-
-    logging.info('train set size: %d; test set size: %d' % (len(train_dset), len(valid_dset)))
+    if args.shared_memory > 0 and args.lazy == 0:
+        train_dset.share_memory()
+        valid_dset.share_memory()
 
 
     # which fields should the data loader return?
 
-    fields_valid = [args.input_field]
-    for target in targets:
-        fields_valid.append(target['col'])
-    if 'masks_prep' not in fields_valid:
-        fields_valid.append('masks_prep') # for iou
-    fields_train = [x for x in fields_valid]
-    if args.instance_weights is not None:
-        fields_train.append(args.instance_weights)
+    fields_train, fields_valid = get_return_fields(args, targets)
+
+    if args.do == 'train':
+        # validation samples are not augmented; compute them once
+        valid_dset.return_fields = fields_valid
+        cache_valid_tensors(valid_dset, args)
+        # set before creating the loader: --batch-ring sizes its buffers from a sample
+        train_dset.return_fields = fields_train
+        train_loader = make_train_loader(train_dset, args)
+    else:
+        # original images have varying dimensions
+        train_loader = make_eval_loader(train_dset, args)
+    valid_loader = make_eval_loader(valid_dset, args)
+
+    logging.info('train set size: %d; test set size: %d' % (len(train_dset), len(valid_dset)))
 
 
     # score data
@@ -1086,139 +1636,11 @@ def main():
         logging.info('> %s = %s' % (k, str(global_state['args'].__dict__[k])))
     logging.info('')
 
-    recovered_ckpt = None
-    recovery_attempts = 0
-    last_epoch_loss = get_latest_log('train_avg_loss', 1e20)[0]
-
-    for global_state['epoch'] in range(global_state['epoch'] + 1, args.epochs):
-        epoch = global_state['epoch']
-        try:
-            stats_train, stats_valid = train_epoch(train_loader, valid_loader, targets, model, optimizer, scheduler, args.eval_every, args.print_every, args.save_every, global_state)
-
-            msg = epoch_logging_message(global_state, targets, stats_train, stats_valid, len(train_dset), len(valid_dset))
-
-            logging.info(msg)
-
-            it = global_state['it']
-
-            # check for blowup
-            epoch_loss = get_latest_log('train_avg_loss', 1e20)[0]
-            if not math.isnan(last_epoch_loss) and epoch_loss > 100.0 * last_epoch_loss:
-                msg = 'iteration %d - training blew up ...' % it
-                logging.error(msg)
-                raise TrainingBlowupError(msg)
-            last_epoch_loss = epoch_loss
-
-            save_checkpoint(
-                get_checkpoint_file(global_state['args'], it),
-                model,
-                optimizer,
-                global_state)
-
-
-            # check elapsed time
-            time_end = time.time()
-            time_total = time_end - time_start
-            logging.info('[%d, %d] total running time: %d seconds' % (global_state['epoch'], it, time_total))
-            if time_total > args.stop_instance_after:
-                ret = stop_current_instance(False)
-                logging.info(ret)
-                return 0
-
-            if global_state['args'].scheduler != 'none':
-                # note: different interface:
-                # ReduceLROnPlateau.step() takes metrics as argument,
-                # other schedulers take epoch number
-                if isinstance(scheduler, ReduceLROnPlateau2):
-                    scheduler.step(epoch_loss, epoch)
-                else:
-                    scheduler.step(epoch)
-
-                lr_new = get_learning_rate(optimizer)
-                lr_old = global_state['lr']
-                if lr_old != lr_new:
-                    logging.info(
-                        '[%d, %d]\tLR changed from %f to %f.' % (epoch, it, lr_old, lr_new))
-                    global_state['lr'] = lr_new
-                elif (args.switch_to_lbfgs and not isinstance(optimizer, optim.LBFGS)
-                      and isinstance(scheduler, ReduceLROnPlateau2)
-                      and scheduler.waiting_to_reduce and lr_old == args.min_lr):
-                    logging.info('[%d, %d]\tminimum learn rate reached, switching scheduler to lbfgs' %
-                                 (epoch, it))
-                    lr = 0.8
-                    optimizer = optim.LBFGS(
-                        model.parameters(),
-                        lr=lr,
-                        max_iter=args.lbfgs_max_iter,
-                        history_size=args.lbfgs_history_size,
-                        tolerance_change=args.lbfgs_tolerance_change)
-                    global_state['args'].grad_accum = len(train_loader)
-                    args.grad_accum = len(train_loader)
-                    global_state['args'].optim == 'lbfgs'
-                    args.optim = 'lbfgs'
-                    global_state['args'].clip_gradient = 1e20
-                    args.clip_gradient = 0
-                    global_state['args'].scheduler = 'plateau'
-                    args.scheduler = 'plateau'
-                    global_state['lr'] = lr
-
-                    scheduler = ReduceLROnPlateau2(optimizer,
-                                                   factor=0.9,
-                                                   patience=1,
-                                                   patience_threshold=0.1,
-                                                   min_lr=0.1, verbose=1)
-
-        except TrainingBlowupError:
-            # numerical instability, try to recover
-            # sometime lbfgs blows up, gradient clipping is not applicable
-            # restart with reduced learn rate
-            if isinstance(optimizer, optim.LBFGS):
-                ckpt = get_latest_checkpoint_file(args)
-                if recovered_ckpt == ckpt:
-                    # have tried previously the same checkpoint, reduce lr
-                    recovery_attempts += 1
-                else:
-                    recovery_attempts = 1
-                recovered_ckpt = ckpt
-
-                min_lr = 0.1
-                lr = max(global_state['lr'] * .5, min_lr)
-                if lr >= global_state['lr']:
-                    msg = 'attempt %d: using lbfgs and lr (%f) already at min_lr (%f), giving up' % (
-                        recovery_attempts, global_state['lr'], min_lr)
-                    logging.error(msg)
-                    raise
-                model = load_checkpoint(ckpt,
-                                        model,
-                                        optimizer,
-                                        global_state)
-                global_state['lr'] = lr
-                optimizer = optim.LBFGS(model.parameters(),
-                                        lr=lr,
-                                        max_iter=args.lbfgs_max_iter,
-                                        history_size=args.lbfgs_history_size,
-                                        tolerance_change=args.lbfgs_tolerance_change)
-                global_state['args'].grad_accum = len(train_loader)
-                args.grad_accum = len(train_loader)
-                global_state['args'].optim = 'lbfgs'
-                args.optim = 'lbfgs'
-                global_state['args'].clip_gradient = 1e20
-                args.clip_gradient = 1e20
-                global_state['args'].scheduler = 'plateau'
-                args.scheduler = 'plateau'
-
-                scheduler = ReduceLROnPlateau2(optimizer,
-                                               factor=0.9,
-                                               patience=1,
-                                               patience_threshold=0.1,
-                                               min_lr=0.1, verbose=1)
+    stats_valid, timed_out = train(train_dset, valid_dset, train_loader, valid_loader, targets, model, optimizer,
+                                   scheduler, global_state, time_start)
+    if timed_out:
+        return 0
 
-                logging.error(
-                    'recovered from checkpoint %s (attempt %d), lr = %f. keeping fingers crossed ...' %
-                    (ckpt, recovery_attempts, lr))
-            else:
-                logging.error('cannot recover ... terminating.')
-                raise
 
     msg = 'done with epoch %d' % global_state['epoch']
     print msg
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+dataset manifest: a compact index of all images and masks of a stage and group.
+
+the manifest replaces the directory walk at startup. It is a csv file with one row per image:
+    id, stage, group, image, masks, width, height
+paths are relative to the data root; mask file names are space-separated and relative
+to the <id>/masks directory.
+
+usage:
+    python manifest.py --data <root> --stage stage1 --group train
+"""
+
+import os
+import logging
+
+import configargparse
+import pandas as pd
+
+from PIL import Image
+
+
+def manifest_file(root_dir, stage_name, group_name):
+    """default location of the manifest"""
+    return os.path.join(root_dir, '%s_%s_manifest.csv' % (stage_name, group_name))
+
+
+def _list_png(d):
+    if not os.path.isdir(d):
+        return []
+    return sorted([f for f in os.listdir(d) if f.endswith('.png')])
+
+
+def build_manifest(root_dir, stage_name, group_name, fname=None):
+    """walk <root>/<stage>_<group>/<id>/{images,masks} once and write the manifest"""
+
+    if fname is None:
+        fname = manifest_file(root_dir, stage_name, group_name)
+
+    sub = '%s_%s' % (stage_name, group_name)
+    base = os.path.join(root_dir, sub)
+    rows = []
+    for img_id in sorted(os.listdir(base)):
+        images = _list_png(os.path.join(base, img_id, 'images'))
+        if not images:
+            continue
+        image = os.path.join(sub, img_id, 'images', images[0])
+        # PIL only reads the header here
+        width, height = Image.open(os.path.join(root_dir, image)).size
+        rows.append({'id': img_id,
+                     'stage': stage_name,
+                     'group': group_name,
+                     'image': image,
+                     'masks': ' '.join(_list_png(os.path.join(base, img_id, 'masks'))),
+                     'width': width,
+                     'height': height})
+
+    if not rows:
+        raise ValueError('no images found in %s' % base)
+
+    df = pd.DataFrame(rows, columns=['id', 'stage', 'group', 'image', 'masks', 'width', 'height'])
+    tmp = '%s.tmp.%d' % (fname, os.getpid())
+    df.to_csv(tmp, index=False)
+    os.rename(tmp, fname)
+    logging.info('wrote manifest for %d images to %s' % (len(df), fname))
+    return fname
+
+
+def read_manifest(fname, root_dir, with_masks=True):
+    """
+    read a manifest into a data frame in the format used by NucleusDataset:
+    columns stage, id, images (list of paths), masks (list of paths), size ((width, height)).
+    """
+
+    df = pd.read_csv(fname, dtype={'id': str, 'masks': str}, keep_default_na=False)
+    data_df = pd.DataFrame({'stage': df['stage'].values, 'id': df['id'].values})
+    data_df['images'] = [[os.path.join(root_dir, p)] for p in df['image']]
+    if with_masks:
+        masks = []
+        for image, names in zip(df['image'], df['masks']):
+            mask_dir = os.path.join(root_dir, os.path.dirname(os.path.dirname(image)), 'masks')
+            masks.append([os.path.join(mask_dir, m) for m in names.split()])
+        data_df['masks'] = masks
+    data_df['size'] = [(int(w), int(h)) for w, h in zip(df['width'], df['height'])]
+    return data_df
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgumentParser(description='build the dataset manifest.')
+    parser.add('--data', '-d', metavar='DIR', required=True, help='path to dataset')
+    parser.add('--stage', '-s', default='stage1', help='stage [default: %(default)s]')
+    parser.add('--group', '-g', default='train', help='group name [default: %(default)s]')
+    parser.add('--out', '-o', help='output file [default: <data>/<stage>_<group>_manifest.csv]')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print build_manifest(args.data, args.stage, args.group, args.out)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+pre-rendered augmentation: augmented training crops of several epochs, written to disk ahead of training.
+
+each epoch is rendered by a separate process, with its own random seed, into packed shards
+(see shards.py); a record holds all fields of one augmented sample, back to back:
+
+    <out>/
+        fields.csv          one row per field: field, dtype, orig_dtype, shape, scale, offset, tensor
+        index.csv           one row per record: epoch, stage, id, shard, offset
+        epoch-000/shard-00000.bin, ...
+
+to keep the records compact, float fields are stored as uint8 where this is lossless: RGB image
+tensors (values k/255) with scale 255, and fields with integer values in [0, 255] with scale 1.
+
+with NucleusDataset.use_prerendered(), training samples are read back from the records, which
+only costs a copy; a fraction of the samples can still be augmented live.
+
+usage:
+    python prerender_augment.py --data <root> --stage stage1 --group train --epochs 20 --out <dir>
+"""
+
+import os
+import logging
+
+import configargparse
+import numpy as np
+import pandas as pd
+
+import imgaug as ia
+
+import torch
+
+from shards import ShardWriter, shard_file
+from utils import mkdir_p, fork_map, int_list, csv_list
+
+
+FIELDS_FILE = 'fields.csv'
+INDEX_FILE = 'index.csv'
+
+
+def epoch_dir(out_dir, epoch):
+    return os.path.join(out_dir, 'epoch-%03d' % epoch)
+
+
+def field_layout(sample, fields):
+    """storage layout of the fields of a sample (as returned by NucleusDataset.__getitem__)"""
+    rows = []
+    offset = 0
+    for k in fields:
+        v = sample[k]
+        is_tensor = torch.is_tensor(v)
+        arr = np.asarray(v.numpy() if is_tensor else v)
+        dtype, scale = arr.dtype, 0.0
+        if arr.dtype.kind == 'f':
+            if arr.ndim == 3 and arr.shape[0] == 3:
+                # image tensor from ToTensor(), k/255
+                dtype, scale = np.dtype(np.uint8), 255.0
+            elif arr.size > 0 and arr.min() >= 0 and arr.max() <= 255 and np.array_equal(arr, np.round(arr)):
+                dtype, scale = np.dtype(np.uint8), 1.0
+        rows.append({'field': k, 'dtype': str(dtype), 'orig_dtype': str(arr.dtype),
+                     'shape': ' '.join([str(s) for s in arr.shape]), 'scale': scale, 'offset': offset,
+                     'tensor': int(is_tensor)})
+        offset += int(np.prod(arr.shape)) * dtype.itemsize
+    return pd.DataFrame(rows, columns=['field', 'dtype', 'orig_dtype', 'shape', 'scale', 'offset', 'tensor'])
+
+
+def encode_record(sample, layout):
+    """bytes of one record, as a uint8 array"""
+    parts = []
+    for f in layout.itertuples():
+        v = sample[f.field]
+        arr = np.asarray(v.numpy() if torch.is_tensor(v) else v)
+        if ' '.join([str(s) for s in arr.shape]) != f.shape:
+            raise ValueError('field %s has shape %s, expected %s (crops must have a fixed size)' % (f.field, arr.shape, f.shape))
+        if f.scale > 0:
+            arr = np.round(arr * f.scale)
+            if arr.min() < 0 or arr.max() > 255:
+                raise ValueError('field %s: values out of range for uint8 storage' % f.field)
+        parts.append(np.ascontiguousarray(arr.astype(f.dtype)).view(np.uint8).ravel())
+    return np.concatenate(parts)
+
+
+def prerender(dset, out_dir, epochs, fields, shard_mb=256, workers=1, seed=0):
+    """
+    render epochs of augmented samples of a (preprocessed) training dataset to out_dir.
+
+    each epoch runs in a forked process (up to workers at a time), seeded with seed + epoch.
+    """
+    mkdir_p(out_dir)
+    dset.return_fields = fields
+    first = dset[0]
+    layout = field_layout(first, fields)
+    logging.info('prerendering %d epochs of %d samples, %.1f KB per sample' % (
+        epochs, len(dset), len(encode_record(first, layout)) / 1024.0))
+
+    def render_epoch(epoch):
+        # the forked processes start with copies of the parent's random generators
+        np.random.seed(seed + epoch)
+        ia.seed(seed + epoch)
+        d = epoch_dir(out_dir, epoch)
+        mkdir_p(d)
+        writer = ShardWriter(d, shard_mb * 1024**2)
+        rows = []
+        try:
+            for i in range(len(dset)):
+                writer.next_record()
+                rows.append({'epoch': epoch,
+                             'stage': dset.get_field('stage', i),
+                             'id': dset.get_field('id', i),
+                             'shard': writer.shard,
+                             'offset': writer.write(encode_record(dset[i], layout))})
+        finally:
+            writer.close()
+        return rows
+
+    rows = []
+    for epoch_rows in fork_map(render_epoch, range(epochs), workers):
+        rows.extend(epoch_rows)
+
+    for df, name in ((layout, FIELDS_FILE), (pd.DataFrame(rows, columns=['epoch', 'stage', 'id', 'shard', 'offset']), INDEX_FILE)):
+        fname = os.path.join(out_dir, name)
+        tmp = '%s.tmp.%d' % (fname, os.getpid())
+        df.to_csv(tmp, index=False)
+        os.rename(tmp, fname)
+    logging.info('wrote %d samples to %s' % (len(rows), out_dir))
+    return out_dir
+
+
+class PrerenderedStore(object):
+
+    """
+    read access to pre-rendered samples. Shard files are memory-mapped on first use, per process.
+
+    args:
+        out_dir (string): directory written by prerender()
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.layout = pd.read_csv(os.path.join(out_dir, FIELDS_FILE), dtype={'shape': str}, keep_default_na=False)
+        self.index = pd.read_csv(os.path.join(out_dir, INDEX_FILE), dtype={'id': str}, keep_default_na=False)
+        self.fields = list(self.layout['field'])
+        self.by_key = {}
+        for r, key in enumerate(zip(self.index['stage'], self.index['id'])):
+            self.by_key.setdefault(key, []).append(r)
+        self.epochs = self.index['epoch'].nunique()
+        self._maps = {}
+
+
+    @property
+    def crop_size(self):
+        """(height, width) of the pre-rendered crops, from the first image-like field"""
+        for shape in self.layout['shape']:
+            shape = [int(s) for s in shape.split()]
+            if len(shape) == 3:
+                return tuple(shape[1:])
+        return None
+
+
+    def _map(self, epoch, shard):
+        m = self._maps.get((epoch, shard))
+        if m is None:
+            m = np.memmap(shard_file(epoch_dir(self.out_dir, epoch), shard), dtype=np.uint8, mode='r')
+            self._maps[(epoch, shard)] = m
+        return m
+
+
+    def record(self, r, fields):
+        """decoded fields of index row r"""
+        missing = [k for k in fields if k not in self.fields]
+        if missing:
+            raise ValueError('fields %s are not pre-rendered in %s' % (', '.join(missing), self.out_dir))
+        buf = self._map(int(self.index['epoch'].iat[r]), int(self.index['shard'].iat[r]))
+        base = int(self.index['offset'].iat[r])
+        sample = {}
+        for f in self.layout.itertuples():
+            if f.field not in fields:
+                continue
+            shape = tuple([int(s) for s in f.shape.split()])
+            dtype = np.dtype(f.dtype)
+            n = int(np.prod(shape)) * dtype.itemsize
+            arr = buf[base + f.offset:base + f.offset + n].view(dtype).reshape(shape)
+            if f.scale > 0:
+                arr = arr.astype(f.orig_dtype)
+                if f.scale != 1.0:
+                    arr /= np.asarray(f.scale, dtype=arr.dtype)
+            else:
+                arr = np.array(arr)
+            if f.tensor:
+                sample[f.field] = torch.from_numpy(arr)
+            elif arr.ndim == 0:
+                sample[f.field] = arr[()]
+            else:
+                sample[f.field] = arr
+        return sample
+
+
+    def sample(self, stage, img_id, fields):
+        """fields of a randomly chosen rendering of an image, or None if it was not pre-rendered"""
+        rows = self.by_key.get((stage, img_id))
+        if rows is None:
+            return None
+        return self.record(rows[np.random.randint(len(rows))], fields)
+
+
+if __name__ == '__main__':
+    from dataset import NucleusDataset
+
+    parser = configargparse.ArgumentParser(description='pre-render augmented training samples.')
+    parser.add('--data', '-d', metavar='DIR', help='path to dataset')
+    parser.add('--stage', '-s', default='stage1', help='stage [default: %(default)s]')
+    parser.add('--group', '-g', default='train', help='group name [default: %(default)s]')
+    parser.add('--manifest', help='dataset manifest, see manifest.py [default: <data>/<stage>_<group>_manifest.csv, if it exists]')
+    parser.add('--labels-csv', help='run-length encoded ground truth, read instead of the mask files [default: %(default)s]')
+    parser.add('--shards', metavar='DIR', help='read images and label images from packed shards instead of --data [default: %(default)s]')
+    parser.add('--train-img-size', type=int_list, default='192,192', help='training crop size [default: %(default)s]')
+    parser.add('--augment-mode', choices=('sequential', 'crop_first', 'fused'), default='sequential', help='geometric augmentation, see main.py [default: %(default)s]')
+    parser.add('--color-lut', type=int, default=0, help='color augmentation without the imgaug chain: the channel add goes through a lookup table (HSV branches still convert colorspaces) [default: %(default)s]')
+    parser.add('--fields', type=csv_list, default='images_prep,masks_prep_bin,contours,inst_wt', help='fields to render [default: %(default)s]')
+    parser.add('--epochs', metavar='N', type=int, default=10, help='number of epochs to render [default: %(default)s]')
+    parser.add('--workers', metavar='N', type=int, default=1, help='number of epochs rendered in parallel [default: %(default)s]')
+    parser.add('--load-workers', metavar='N', type=int, default=1, help='number of processes for decoding and preprocessing [default: %(default)s]')
+    parser.add('--shard-mb', type=int, default=256, help='approximate size of each shard in MB [default: %(default)s]')
+    parser.add('--seed', type=int, default=0, help='random seed of the first epoch [default: %(default)s]')
+    parser.add('--out', '-o', required=True, help='output directory')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.data is None and args.shards is None:
+        raise ValueError('either --data or --shards is required')
+
+    dset = NucleusDataset(args.data, stage_name=args.stage, group_name=args.group, dset_type='train',
+                          img_size=args.train_img_size, img_size_mode='crop', load_workers=args.load_workers,
+                          manifest=args.manifest, augment_mode=args.augment_mode, color_lut=(args.color_lut > 0),
+                          labels_csv=args.labels_csv, shards=args.shards)
+    dset.preprocess()
+    print prerender(dset, args.out, args.epochs, args.fields, args.shard_mb, args.workers, args.seed)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+label images from run-length encoded ground truth (stage1_train_labels.csv, stage1_solution.csv).
+
+the csv has one row per nucleus, with columns ImageId and EncodedPixels; runs are
+'start length' pairs of 1-based pixel positions in column-major order (top to bottom,
+then left to right), as written by utils.rle_encoding.
+
+usage (compare decoding time with reading the mask pngs):
+    python rle_labels.py --data <root> --stage stage1 --group train --labels-csv <root>/stage1_train_labels.csv
+"""
+
+import os
+import time
+import logging
+from glob import glob
+
+import configargparse
+import numpy as np
+import pandas as pd
+
+
+def read_rle_csv(fname):
+    """dict of image id -> list of run-length encodings (strings), one per nucleus"""
+    df = pd.read_csv(fname, dtype={'ImageId': str, 'EncodedPixels': str}, keep_default_na=False)
+    if 'ImageId' not in df.columns or 'EncodedPixels' not in df.columns:
+        raise ValueError('%s: expected columns ImageId and EncodedPixels' % fname)
+    rles = {}
+    for img_id, enc in zip(df['ImageId'].values, df['EncodedPixels'].values):
+        rles.setdefault(img_id, []).append(enc)
+    return rles
+
+
+def rle_to_labels(rles, shape):
+    """
+    uint16 label image of the given (height, width), with nucleus i+1 from rles[i].
+
+    all runs of all nuclei are decoded at once: the pixel positions are built with a single
+    np.repeat over the run lengths. Where nuclei overlap, the pixel keeps the first nucleus that
+    covers it, as if nuclei were written in order, each only where labels are still 0.
+    """
+    h, w = shape
+    if len(rles) >= 2**16:
+        raise ValueError('too many nuclei for uint16 labels: %d' % len(rles))
+
+    runs = [np.array(r.split(), dtype=np.int64).reshape(-1, 2) for r in rles]
+    counts = np.array([len(r) for r in runs], dtype=np.int64)
+    labels = np.zeros(h * w, dtype=np.uint16)
+    if counts.sum() == 0:
+        return labels.reshape(w, h).T.copy()
+
+    runs = np.concatenate(runs)
+    starts, lengths = runs[:, 0] - 1, runs[:, 1]
+    run_labels = np.repeat(np.arange(1, len(rles) + 1, dtype=np.uint16), counts)
+
+    # position k of the concatenated runs belongs to run j: starts[j] + (k - offset[j])
+    offsets = np.cumsum(lengths) - lengths
+    pos = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - offsets, lengths)
+    if pos.size > 0 and (pos.min() < 0 or pos.max() >= h * w):
+        raise ValueError('run-length encoding out of range for image of shape %s' % (shape,))
+
+    pos_labels = np.repeat(run_labels, lengths)
+    if np.bincount(pos, minlength=h * w).max() > 1:
+        # overlapping runs: keep the first occurrence of each position, in nucleus order
+        pos, first = np.unique(pos, return_index=True)
+        pos_labels = pos_labels[first]
+    labels[pos] = pos_labels
+    # column-major
+    return labels.reshape(w, h).T.copy()
+
+
+def check_rle_overlap():
+    """regression check: overlapping runs keep the first nucleus"""
+    # 4 x 3 image, column-major positions 1..12; nucleus 2 overlaps 1 at 3-4, nucleus 3 overlaps 2 at 6
+    labels = rle_to_labels(['1 4', '3 4', '6 2 12 1', '9 1'], (4, 3))
+    expected = np.array([1, 1, 1, 1, 2, 2, 3, 0, 4, 0, 0, 3], dtype=np.uint16).reshape(3, 4).T
+    assert labels.dtype == np.uint16 and np.array_equal(labels, expected), labels
+    # within one nucleus, overlapping runs are harmless
+    assert np.array_equal(rle_to_labels(['1 3 2 3'], (2, 2)), np.ones((2, 2), dtype=np.uint16))
+
+
+if __name__ == '__main__':
+    from dataset import NucleusDataset
+
+    parser = configargparse.ArgumentParser(description='compare rle decoding with reading mask pngs.')
+    parser.add('--data', '-d', metavar='DIR', required=True, help='path to dataset')
+    parser.add('--stage', '-s', default='stage1', help='stage [default: %(default)s]')
+    parser.add('--group', '-g', default='train', help='group name [default: %(default)s]')
+    parser.add('--labels-csv', required=True, help='run-length encoded labels')
+    parser.add('--n', type=int, default=100, help='number of images [default: %(default)s]')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    t = time.time()
+    rles = read_rle_csv(args.labels_csv)
+    t_csv = time.time() - t
+
+    base = os.path.join(args.data, '%s_%s' % (args.stage, args.group))
+    ids = [i for i in sorted(os.listdir(base)) if i in rles][:args.n]
+
+    t_png, t_rle, mismatches = 0.0, 0.0, 0
+    for img_id in ids:
+        mask_paths = sorted(glob(os.path.join(base, img_id, 'masks', '*.png')))
+        t = time.time()
+        m_png = NucleusDataset.read_and_stack(mask_paths)
+        t_png += time.time() - t
+
+        t = time.time()
+        m_rle = rle_to_labels(rles[img_id], m_png.shape)
+        t_rle += time.time() - t
+
+        if m_png.max() != m_rle.max() or not np.array_equal(m_png > 0, m_rle > 0):
+            mismatches += 1
+
+    print 'csv read: %.2fs for %d images' % (t_csv, len(rles))
+    print 'read_and_stack: %.3fs, rle: %.3fs for %d images (x%.1f); %d mismatches' % (
+        t_png, t_rle, len(ids), t_png / max(t_rle, 1e-9), mismatches)
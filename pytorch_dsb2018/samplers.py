@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""batch samplers and collate functions for the data loader"""
+
+import logging
+
+import numpy as np
+
+import torch
+from torch.utils.data.sampler import Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+class SizeBucketBatchSampler(Sampler):
+
+    """
+    Batch sampler that only puts images of the same (padded) size into a minibatch.
+
+    Images are grouped into buckets; all images in a bucket are padded to the largest height and
+    width in the bucket. Sizes are merged into a bucket only as long as the padded area exceeds
+    the area of each member image by at most a factor of (1 + max_pad_ratio). With
+    max_pad_ratio=0, a bucket holds exactly one image size, and no padding occurs.
+
+    args:
+        sizes: (height, width) of each image in the dataset
+    """
+
+    def __init__(self, sizes, batch_size, max_pad_ratio=0.0, shuffle=True):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        by_size = {}
+        for i, sz in enumerate(sizes):
+            by_size.setdefault(tuple(sz), []).append(i)
+
+        # greedily merge sizes, from small to large area
+        self.buckets = []
+        cur, cur_sizes = [], []
+        for sz in sorted(by_size.keys(), key=lambda x: (x[0] * x[1], x)):
+            cand = cur_sizes + [sz]
+            h = max([s[0] for s in cand])
+            w = max([s[1] for s in cand])
+            if cur and any([h * w > (1.0 + max_pad_ratio) * s[0] * s[1] for s in cand]):
+                self.buckets.append(cur)
+                cur, cur_sizes = [], []
+            cur = cur + by_size[sz]
+            cur_sizes.append(sz)
+        if cur:
+            self.buckets.append(cur)
+
+        logging.info('%d image sizes in %d buckets' % (len(by_size), len(self.buckets)))
+
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            bucket = list(bucket)
+            if self.shuffle:
+                np.random.shuffle(bucket)
+            batches.extend([bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)])
+        if self.shuffle:
+            np.random.shuffle(batches)
+        return iter(batches)
+
+
+    def __len__(self):
+        return sum([(len(b) + self.batch_size - 1) // self.batch_size for b in self.buckets])
+
+
+class ShardShuffleSampler(Sampler):
+
+    """
+    Sampler that shuffles at the level of shards (see shards.py) instead of single images.
+
+    the shards are visited in random order, shards_per_block at a time; the images of a block
+    are shuffled among themselves. Data loader workers then only touch the shards of the current
+    block, and each shard is read about once per epoch, instead of at random offsets all over
+    the archive.
+
+    args:
+        shards: shard of each image in the dataset
+    """
+
+    def __init__(self, shards, shards_per_block=2, shuffle=True):
+        self.shuffle = shuffle
+        self.shards_per_block = max(1, shards_per_block)
+        self.by_shard = {}
+        for i, s in enumerate(shards):
+            self.by_shard.setdefault(s, []).append(i)
+        self.n = len(shards)
+
+
+    def __iter__(self):
+        order = sorted(self.by_shard.keys())
+        if self.shuffle:
+            np.random.shuffle(order)
+        indices = []
+        for b in range(0, len(order), self.shards_per_block):
+            block = []
+            for s in order[b:b + self.shards_per_block]:
+                block.extend(self.by_shard[s])
+            if self.shuffle:
+                np.random.shuffle(block)
+            indices.extend(block)
+        return iter(indices)
+
+
+    def __len__(self):
+        return self.n
+
+
+class CostBalancedBatchSampler(Sampler):
+
+    """
+    Batch sampler that gives every minibatch about the same total cost (e.g., loading time).
+
+    with shuffle, samples are sorted by cost and cut into batch_size strata of consecutive
+    samples; each batch takes one random sample from each stratum. Batches thus contain one
+    sample of every cost range, differ from epoch to epoch, and take about equally long to load,
+    so that no data loader worker lags behind the others with a batch of large images.
+
+    without shuffle (e.g., validation with batch_size 1), batches are filled greedily in order of
+    decreasing cost, and returned from most to least expensive, so that workers do not end the
+    epoch with an expensive batch while the others are idle.
+
+    args:
+        cost_fn: function returning the cost of each sample; called at the start of every epoch,
+                 so that costs can be refined with measured timings (see NucleusDataset.item_costs)
+    """
+
+    def __init__(self, cost_fn, batch_size, shuffle=True):
+        self.cost_fn = cost_fn
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.n = len(cost_fn())
+        self.imbalance = None
+
+
+    def __iter__(self):
+        costs = np.asarray(self.cost_fn(), dtype=np.float64)
+        n_batches = len(self)
+        order = np.argsort(-costs, kind='mergesort')
+        if self.shuffle:
+            batches = [[] for _ in range(n_batches)]
+            for s in range(0, self.n, n_batches):
+                stratum = order[s:s + n_batches]
+                slots = np.random.permutation(n_batches)[:len(stratum)]
+                for slot, i in zip(slots, stratum):
+                    batches[slot].append(i)
+            np.random.shuffle(batches)
+        else:
+            # largest processing time first
+            batches = [[] for _ in range(n_batches)]
+            totals = np.zeros(n_batches)
+            for i in order:
+                free = [b for b in range(n_batches) if len(batches[b]) < self.batch_size]
+                b = free[int(np.argmin(totals[free]))]
+                batches[b].append(i)
+                totals[b] += costs[i]
+            batches.sort(key=lambda b: -costs[b].sum())
+
+        batch_costs = np.array([costs[b].sum() for b in batches])
+        self.imbalance = batch_costs.max() / max(batch_costs.mean(), 1e-12)
+        return iter([[int(i) for i in b] for b in batches])
+
+
+    def __len__(self):
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+
+class ClusterSampler(Sampler):
+
+    """
+    Sampler that reduces the share of near-duplicate images (see dedup.py) in an epoch.
+
+    modes:
+        'dedup': each epoch contains one randomly chosen image of every cluster
+        'weight': images are drawn with replacement, with probability proportional to
+                  1 / (cluster size) ** alpha; an epoch has sum(weights) samples
+
+    with alpha=1, both modes give one sample per cluster and epoch on average.
+
+    args:
+        clusters: cluster of each image in the dataset
+    """
+
+    def __init__(self, clusters, mode='dedup', alpha=1.0):
+        if mode not in ('dedup', 'weight'):
+            raise ValueError('invalid cluster sampling mode: %s' % mode)
+        self.mode = mode
+        self.clusters = np.asarray(clusters)
+        self.members = {}
+        for i, c in enumerate(self.clusters):
+            self.members.setdefault(c, []).append(i)
+        sizes = np.array([len(self.members[c]) for c in self.clusters], dtype=np.float64)
+        self.weights = 1.0 / sizes ** alpha
+        if mode == 'dedup':
+            self.n = len(self.members)
+        else:
+            self.n = max(1, int(round(self.weights.sum())))
+
+
+    def __iter__(self):
+        if self.mode == 'dedup':
+            picks = [m[np.random.randint(len(m))] for m in self.members.values()]
+            np.random.shuffle(picks)
+            return iter(picks)
+        p = self.weights / self.weights.sum()
+        return iter([int(i) for i in np.random.choice(len(self.clusters), self.n, replace=True, p=p)])
+
+
+    def __len__(self):
+        return self.n
+
+
+def pad_collate(batch):
+    """
+    collate samples of different sizes by zero-padding images at the bottom and right.
+
+    adds two fields to the batch:
+        valid_mask: B x 1 x H x W, 1 for original and 0 for padded pixels
+        size_hw: B x 2, original height and width of each sample
+    """
+
+    img_keys = [k for k, v in batch[0].items() if torch.is_tensor(v) and v.dim() == 3]
+    if not img_keys:
+        return default_collate(batch)
+
+    sizes = [tuple(sample[img_keys[0]].size()[1:]) for sample in batch]
+    h = max([s[0] for s in sizes])
+    w = max([s[1] for s in sizes])
+
+    padded = []
+    for sample, (sh, sw) in zip(batch, sizes):
+        sample = dict(sample)
+        for k in img_keys:
+            v = sample[k]
+            if v.size(1) != sh or v.size(2) != sw:
+                raise ValueError('field %s has size %s, expected %s' % (k, tuple(v.size()[1:]), (sh, sw)))
+            if sh != h or sw != w:
+                p = v.new(v.size(0), h, w).zero_()
+                p[:, :sh, :sw] = v
+                sample[k] = p
+        m = torch.zeros(1, h, w)
+        m[:, :sh, :sw] = 1.0
+        sample['valid_mask'] = m
+        sample['size_hw'] = torch.LongTensor([sh, sw])
+        padded.append(sample)
+    return default_collate(padded)
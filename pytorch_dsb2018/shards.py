@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+packed shard archives: decoded images and label images of a stage and group in a few large files.
+
+instead of one png per image and per nucleus, the arrays are stored uncompressed, back to back,
+in shard files of roughly equal size, with an index of offsets:
+
+    <root>/<stage>_<group>_shards/
+        index.csv           one row per image: id, stage, group, shard, offset, height, width,
+                            label_offset, label_dtype, n_labels
+        shard-00000.bin     RGB uint8 image (height x width x 3), label image (height x width), ...
+        shard-00001.bin
+
+records start at page boundaries. Shards are opened memory-mapped, so that a (window of an) image
+only reads the pages it covers, and reading a shard front to back is sequential I/O.
+
+usage:
+    python shards.py --data <root> --stage stage1 --group train [--labels-csv <csv>]
+"""
+
+import os
+import logging
+
+import configargparse
+import numpy as np
+import pandas as pd
+
+from tqdm import tqdm
+
+from utils import mkdir_p
+
+
+INDEX_FILE = 'index.csv'
+ALIGN = 4096
+
+INDEX_COLUMNS = ['id', 'stage', 'group', 'shard', 'offset', 'height', 'width', 'label_offset', 'label_dtype', 'n_labels']
+
+
+def shard_dir(root_dir, stage_name, group_name):
+    """default location of the shards"""
+    return os.path.join(root_dir, '%s_%s_shards' % (stage_name, group_name))
+
+
+def shard_file(out_dir, shard):
+    return os.path.join(out_dir, 'shard-%05d.bin' % shard)
+
+
+class ShardWriter(object):
+
+    """append arrays to shard files, starting a new shard when the current one exceeds shard_bytes"""
+
+    def __init__(self, out_dir, shard_bytes):
+        self.out_dir = out_dir
+        self.shard_bytes = shard_bytes
+        self.shard = -1
+        self.f = None
+        self.pos = 0
+
+
+    def next_record(self):
+        """start a new record (image and label image), in a new shard if the current one is full"""
+        if self.f is None or self.pos >= self.shard_bytes:
+            self.close()
+            self.shard += 1
+            self.f = open(shard_file(self.out_dir, self.shard) + '.tmp', 'wb')
+            self.pos = 0
+
+
+    def write(self, arr):
+        """write an array at the next page boundary; returns its offset"""
+        pad = -self.pos % ALIGN
+        if pad:
+            self.f.write(b'\0' * pad)
+            self.pos += pad
+        offset = self.pos
+        arr = np.ascontiguousarray(arr)
+        self.f.write(arr.tobytes())
+        self.pos += arr.nbytes
+        return offset
+
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            os.rename(self.f.name, shard_file(self.out_dir, self.shard))
+            self.f = None
+
+
+def pack_shards(root_dir, stage_name, group_name, out_dir=None, shard_mb=256, labels_csv=None, manifest=None,
+                seed=0):
+    """
+    decode all images (and label images, except for test groups) and write them to shards.
+
+    images are written in random order (seeded), so that each shard is a random sample of the
+    set, and shuffling at the shard level does not group similar images together.
+    """
+
+    from dataset import NucleusDataset
+
+    if out_dir is None:
+        out_dir = shard_dir(root_dir, stage_name, group_name)
+    mkdir_p(out_dir)
+
+    dset_type = 'test' if group_name == 'test' else 'train'
+    dset = NucleusDataset(root_dir, stage_name, group_name, dset_type=dset_type, lazy=True, manifest=manifest,
+                          labels_csv=labels_csv)
+    order = np.arange(len(dset))
+    if seed is not None:
+        order = np.random.RandomState(seed).permutation(len(dset))
+
+    writer = ShardWriter(out_dir, shard_mb * 1024**2)
+    rows = []
+    try:
+        for i in tqdm(order):
+            img, m = dset.decode_row(i)
+            writer.next_record()
+            row = {'id': dset.get_field('id', i),
+                   'stage': dset.get_field('stage', i),
+                   'group': group_name,
+                   'shard': writer.shard,
+                   'offset': writer.write(img),
+                   'height': img.shape[0],
+                   'width': img.shape[1],
+                   'label_offset': -1,
+                   'label_dtype': '',
+                   'n_labels': 0}
+            if m is not None:
+                row.update({'label_offset': writer.write(m),
+                            'label_dtype': str(m.dtype),
+                            'n_labels': int(m.max()) if m.size else 0})
+            rows.append(row)
+    finally:
+        writer.close()
+
+    fname = os.path.join(out_dir, INDEX_FILE)
+    tmp = '%s.tmp.%d' % (fname, os.getpid())
+    pd.DataFrame(rows, columns=INDEX_COLUMNS).to_csv(tmp, index=False)
+    os.rename(tmp, fname)
+    logging.info('wrote %d images to %d shards in %s' % (len(rows), writer.shard + 1, out_dir))
+    return out_dir
+
+
+class ShardStore(object):
+
+    """
+    read access to packed shards. Shard files are memory-mapped on first use, per process.
+
+    args:
+        shard_dir (string): directory with index.csv and the shard files
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.index = pd.read_csv(os.path.join(shard_dir, INDEX_FILE), dtype={'id': str, 'label_dtype': str},
+                                 keep_default_na=False)
+        self._maps = {}
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def data_df(self):
+        """data frame with the columns stage, id, size ((width, height)), shard and n_labels, in index order"""
+        data_df = pd.DataFrame({'stage': self.index['stage'].values, 'id': self.index['id'].values})
+        data_df['size'] = list(zip(self.index['width'], self.index['height']))
+        data_df['shard'] = self.index['shard'].values
+        data_df['n_labels'] = self.index['n_labels'].values
+        return data_df
+
+
+    @property
+    def has_labels(self):
+        return len(self.index) > 0 and (self.index['label_offset'] >= 0).all()
+
+
+    def _map(self, shard):
+        m = self._maps.get(shard)
+        if m is None:
+            m = np.memmap(shard_file(self.shard_dir, shard), dtype=np.uint8, mode='r')
+            self._maps[shard] = m
+        return m
+
+
+    def _array(self, row, offset, dtype, shape, window):
+        dtype = np.dtype(dtype)
+        n = int(np.prod(shape)) * dtype.itemsize
+        arr = self._map(int(self.index['shard'].iat[row]))[offset:offset + n].view(dtype).reshape(shape)
+        if window is not None:
+            top, left, height, width = window
+            arr = arr[top:top + height, left:left + width]
+        return arr
+
+
+    def image(self, row, window=None):
+        """read-only RGB image of an index row, or a window (top, left, height, width) of it"""
+        h, w = self.index['height'].iat[row], self.index['width'].iat[row]
+        return self._array(row, int(self.index['offset'].iat[row]), np.uint8, (h, w, 3), window)
+
+
+    def labels(self, row, window=None):
+        """read-only label image of an index row, or a window of it"""
+        offset = int(self.index['label_offset'].iat[row])
+        if offset < 0:
+            raise ValueError('no label image for %s in %s' % (self.index['id'].iat[row], self.shard_dir))
+        h, w = self.index['height'].iat[row], self.index['width'].iat[row]
+        return self._array(row, offset, self.index['label_dtype'].iat[row], (h, w), window)
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgumentParser(description='pack images and label images into shards.')
+    parser.add('--data', '-d', metavar='DIR', required=True, help='path to dataset')
+    parser.add('--stage', '-s', default='stage1', help='stage [default: %(default)s]')
+    parser.add('--group', '-g', default='train', help='group name [default: %(default)s]')
+    parser.add('--manifest', help='dataset manifest, see manifest.py [default: <data>/<stage>_<group>_manifest.csv, if it exists]')
+    parser.add('--labels-csv', help='run-length encoded ground truth, read instead of the mask files [default: %(default)s]')
+    parser.add('--shard-mb', type=int, default=256, help='approximate size of each shard in MB [default: %(default)s]')
+    parser.add('--seed', type=int, default=0, help='random seed for the order of images [default: %(default)s]')
+    parser.add('--out', '-o', help='output directory [default: <data>/<stage>_<group>_shards]')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print pack_shards(args.data, args.stage, args.group, args.out, args.shard_mb, args.labels_csv, args.manifest,
+                      args.seed)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""streaming access to the test images, for submit mode"""
+
+import os
+import logging
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from dataset import prep_sample
+from image_reader import open_image
+from manifest import manifest_file, read_manifest
+from zip_source import find_archive, scan_zip
+
+
+class TestImageStream(object):
+
+    """
+    Iterable over the test images of a stage and group.
+
+    images are discovered, decoded and preprocessed on the fly, by a pool of threads that works
+    at most `prefetch` images ahead of the consumer. Memory is bounded by the prefetch depth,
+    and the first image is available as soon as it is decoded, instead of after the whole set.
+
+    yields dicts with the fields stage, id, size, images (decoded RGB image), and images_prep.
+    Images with more than max_decode_pixels pixels are not decoded; for them, images and
+    images_prep hold an image reader (see image_reader.py), for reading them tile by tile.
+
+    args:
+        root_dir, stage_name, group_name, manifest: as for NucleusDataset
+        img_size, img_size_mode: images are resized to img_size if img_size_mode is 'resize'
+        prefetch (int): maximum number of images decoded ahead
+        workers (int): number of decoding threads
+        max_decode_pixels (int): maximum size of images to decode whole
+    """
+
+    def __init__(self, root_dir, stage_name, group_name='test', img_size=None, img_size_mode=None,
+                 prefetch=4, workers=2, manifest=None, max_decode_pixels=None):
+        self.root_dir = root_dir
+        self.stage_name = stage_name
+        self.group_name = group_name
+        self.prefetch = max(1, prefetch)
+        self.workers = max(1, workers)
+        self.manifest = manifest
+        self.max_decode_pixels = max_decode_pixels
+        if manifest is None:
+            self.manifest = manifest_file(root_dir, stage_name, group_name)
+        elif not os.path.isfile(manifest):
+            raise ValueError('manifest %s does not exist' % manifest)
+
+        resize = None
+        if img_size is not None and img_size_mode == 'resize':
+            resize = tuple(img_size)
+        self.prep_params = {'dset_type': 'test', 'resize': resize, 'erosion_size': 0}
+
+
+    def discover(self):
+        """generator of (stage, id, image paths), from the manifest if present, else from the zip archive or by listing directories"""
+        if os.path.isfile(self.manifest):
+            data_df = read_manifest(self.manifest, self.root_dir, with_masks=False)
+            logging.info('streaming %d images from manifest %s' % (len(data_df), self.manifest))
+            for stage, img_id, images in zip(data_df['stage'], data_df['id'], data_df['images']):
+                yield stage, img_id, images
+            return
+
+        archive = find_archive(self.root_dir, self.stage_name, self.group_name)
+        if archive is not None:
+            data_df = scan_zip(archive, self.stage_name, with_masks=False)
+            logging.info('streaming %d images from archive %s' % (len(data_df), archive))
+            for stage, img_id, images in zip(data_df['stage'], data_df['id'], data_df['images']):
+                yield stage, img_id, images
+            return
+
+        base = os.path.join(self.root_dir, '%s_%s' % (self.stage_name, self.group_name))
+        if not os.path.isdir(base):
+            raise ValueError('Failed to find any images :( [%s]' % base)
+        for img_id in sorted(os.listdir(base)):
+            img_dir = os.path.join(base, img_id, 'images')
+            if not os.path.isdir(img_dir):
+                continue
+            images = sorted([os.path.join(img_dir, f) for f in os.listdir(img_dir)])
+            if images:
+                yield self.stage_name, img_id, images
+
+
+    def load(self, item):
+        stage, img_id, images = item
+        reader = open_image(images[0])
+        size = reader.size
+        if (self.max_decode_pixels is not None and self.prep_params['resize'] is None
+                and size[0] * size[1] > self.max_decode_pixels):
+            return {'stage': stage, 'id': img_id, 'size': size, 'images': reader, 'images_prep': reader}
+        img = reader.read()
+        reader.close()
+        sample = prep_sample(img, None, ['image'], self.prep_params)
+        sample.update({'stage': stage, 'id': img_id, 'size': size, 'images': img})
+        return sample
+
+
+    def __iter__(self):
+        pool = ThreadPool(self.workers)
+        pending = deque()
+        try:
+            for item in self.discover():
+                pending.append(pool.apply_async(self.load, (item,)))
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
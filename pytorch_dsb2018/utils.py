@@ -11,6 +11,10 @@ import pickle
 import re
 import urllib2
 import boto3
+import multiprocessing
+import Queue
+import threading
+from collections import OrderedDict
 
 from PIL import Image
 
@@ -139,6 +143,175 @@ def moving_average(a, n=3):
     return ret[n - 1:] / n
 
 
+def parallel_map(fn, items, workers=1, chunksize=None):
+    """
+    map fn over items using a process pool; results are returned in input order.
+
+    fn must be picklable, i.e. defined at module level.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [fn(x) for x in items]
+    if chunksize is None:
+        chunksize = max(1, len(items) // (4 * workers))
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(fn, items, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fork_map(fn, items, workers=1, init=None):
+    """
+    map fn over items in forked processes, at most workers at a time; results are returned in input order.
+
+    unlike parallel_map, fn does not have to be picklable, since the processes are forked; only
+    its results are passed back. init is called in each process before fn.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [fn(x) for x in items]
+
+    queue = multiprocessing.Queue()
+
+    def run(i, x):
+        if init is not None:
+            init()
+        try:
+            queue.put((i, True, fn(x)))
+        except Exception:
+            queue.put((i, False, exceptions_str()))
+
+    results = [None] * len(items)
+    pending = list(enumerate(items))
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                i, x = pending.pop(0)
+                running[i] = multiprocessing.Process(target=run, args=(i, x))
+                running[i].start()
+            try:
+                i, ok, ret = queue.get(timeout=5)
+            except Queue.Empty:
+                # no result yet; check for processes that died without one
+                for i, p in running.items():
+                    if not p.is_alive() and p.exitcode != 0:
+                        raise RuntimeError('job %d died with exit code %d' % (i, p.exitcode))
+                continue
+            running.pop(i).join()
+            if not ok:
+                raise RuntimeError('job %d failed:\n%s' % (i, ret))
+            results[i] = ret
+    finally:
+        for p in running.values():
+            p.terminate()
+    return results
+
+
+class LRUCache(object):
+
+    """
+    least-recently-used cache, bounded by the total size of its values in bytes.
+
+    hit/miss/eviction counters live in shared memory, so that they are aggregated
+    across forked data loader workers (each worker has its own cache contents).
+    get and put are thread-safe, for thread data loaders (see loaders.py).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = multiprocessing.Value('l', 0)
+        self._misses = multiprocessing.Value('l', 0)
+        self._evictions = multiprocessing.Value('l', 0)
+
+
+    @staticmethod
+    def _incr(counter):
+        with counter.get_lock():
+            counter.value += 1
+
+
+    def get(self, key):
+        """return the cached value, or None"""
+        with self._lock:
+            if key not in self._items:
+                self._incr(self._misses)
+                return None
+            value, nbytes = self._items.pop(key)
+            self._items[key] = (value, nbytes)
+        self._incr(self._hits)
+        return value
+
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._items:
+                self.cur_bytes -= self._items.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            while self.cur_bytes + nbytes > self.max_bytes:
+                _, (_, nb) = self._items.popitem(last=False)
+                self.cur_bytes -= nb
+                self._incr(self._evictions)
+            self._items[key] = (value, nbytes)
+            self.cur_bytes += nbytes
+
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.cur_bytes = 0
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def stats(self):
+        """
+        counters summed over all processes; items and bytes are the contents of the calling
+        process's cache only (workers' caches are not visible from the main process)
+        """
+        return {'hits': self._hits.value,
+                'misses': self._misses.value,
+                'evictions': self._evictions.value,
+                'items_this_process': len(self._items),
+                'bytes_this_process': self.cur_bytes}
+
+
+def get_children_rss(pid=None):
+    """
+    memory usage of the child processes (e.g., data loader workers) of pid, in MB.
+
+    returns a dict pid -> (rss, anonymous rss). Private copies of the parent's memory,
+    e.g. from copy-on-write, show up in the anonymous part. Linux only.
+    """
+    if pid is None:
+        pid = os.getpid()
+    ret = {}
+    for d in os.listdir('/proc'):
+        if not d.isdigit():
+            continue
+        try:
+            with open('/proc/%s/status' % d) as f:
+                status = f.read()
+        except IOError:
+            continue
+        fields = dict([line.split(':', 1) for line in status.splitlines() if ':' in line])
+        if int(fields.get('PPid', '-1')) != pid:
+            continue
+        def mb(k):
+            # values are in kB
+            return float(fields.get(k, '0 kB').split()[0]) / 1024.0
+        ret[int(d)] = (mb('VmRSS'), mb('RssAnon'))
+    return ret
+
+
 def save_object(obj, filename):
     with open(filename, 'wb') as output:  # Overwrites any existing file.
         pickle.dump(obj, output, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+zip archives as a data source, without extracting them.
+
+the Kaggle archives (stage1_train.zip, stage1_test.zip, ...) hold <id>/{images,masks}/*.png. Files
+inside an archive are addressed by paths of the form <archive>.zip/<member>, e.g.
+    /data/stage1_train.zip/<id>/images/<id>.png
+so that they can be passed around like the paths of extracted files. The central directory of
+the archive serves as the index; members are read into memory and decoded from there.
+
+each process (and thread) keeps its own open handle per archive, since a ZipFile shares a single
+file position among its users.
+"""
+
+import os
+import threading
+import zipfile
+from io import BytesIO
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from PIL import Image
+
+from skimage.io import imread
+
+
+_local = threading.local()
+
+
+def archive_file(root_dir, stage_name, group_name):
+    """default location of the archive of a stage and group"""
+    return os.path.join(root_dir, '%s_%s.zip' % (stage_name, group_name))
+
+
+def find_archive(root_dir, stage_name, group_name):
+    """the archive of a stage and group, if it exists and has not been extracted; else None"""
+    if os.path.isdir(os.path.join(root_dir, '%s_%s' % (stage_name, group_name))):
+        return None
+    fname = archive_file(root_dir, stage_name, group_name)
+    return fname if os.path.isfile(fname) else None
+
+
+def member_path(archive, name):
+    return archive + '/' + name
+
+
+def split_zip_path(path):
+    """(archive, member) for a path into a zip archive, else None"""
+    i = path.find('.zip/')
+    if i < 0:
+        return None
+    return path[:i + 4], path[i + 5:]
+
+
+def _handle(archive):
+    handles = getattr(_local, 'handles', None)
+    if handles is None:
+        handles = _local.handles = {}
+    # handles are not shared with forked children
+    key = (os.getpid(), archive)
+    zf = handles.get(key)
+    if zf is None:
+        zf = handles[key] = zipfile.ZipFile(archive, 'r')
+    return zf
+
+
+def read_member(path):
+    """contents of an archive member, as bytes"""
+    archive, name = split_zip_path(path)
+    return _handle(archive).read(name)
+
+
+def open_member(path):
+    """PIL image of an archive member; the member is read into memory first"""
+    return Image.open(BytesIO(read_member(path)))
+
+
+def imread_any(path):
+    """decode an image file or archive member into an array (like skimage.io.imread)"""
+    if split_zip_path(path) is None:
+        return imread(path)
+    return np.array(open_member(path))
+
+
+def scan_zip(archive, stage_name, with_masks=True):
+    """
+    data frame with columns stage, id, images, masks (lists of member paths) from the
+    central directory of an archive; only member names are read.
+    """
+    rows = OrderedDict()
+    for name in sorted(_handle(archive).namelist()):
+        parts = name.split('/')
+        if len(parts) < 3 or parts[-2] not in ('images', 'masks') or not parts[-1].endswith('.png'):
+            continue
+        img_id, kind = parts[-3], parts[-2]
+        row = rows.setdefault(img_id, {'stage': stage_name, 'id': img_id, 'images': [], 'masks': []})
+        row[kind].append(member_path(archive, name))
+
+    rows = [r for r in rows.values() if r['images']]
+    if not rows:
+        raise ValueError('no images found in %s' % archive)
+    columns = ['stage', 'id', 'images', 'masks'] if with_masks else ['stage', 'id', 'images']
+    return pd.DataFrame(rows, columns=columns)
+
+
+def _decode_row(paths):
+    images, masks = paths
+    return imread_any(images[0]).shape, [imread_any(m).shape for m in masks]
+
+
+if __name__ == '__main__':
+    import time
+    import logging
+
+    import configargparse
+
+    from utils import parallel_map
+
+    parser = configargparse.ArgumentParser(description='compare decoding from a zip archive with extracted files.')
+    parser.add('--archive', required=True, help='zip archive, e.g. <data>/stage1_train.zip')
+    parser.add('--extracted', help='directory the archive was extracted to, for comparison, e.g. <data>/stage1_train')
+    parser.add('--stage', '-s', default='stage1', help='stage [default: %(default)s]')
+    parser.add('--n', type=int, default=100, help='number of images [default: %(default)s]')
+    parser.add('--workers', type=int, default=4, help='number of decoding processes [default: %(default)s]')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    t = time.time()
+    df = scan_zip(args.archive, args.stage).iloc[:args.n]
+    print 'central directory: %.2fs' % (time.time() - t)
+
+    sources = [('zip', [(i, m) for i, m in zip(df['images'], df['masks'])])]
+    if args.extracted is not None:
+        def extracted(p):
+            # <id>/{images,masks}/<file>
+            return os.path.join(args.extracted, *split_zip_path(p)[1].split('/')[-3:])
+        sources.append(('extracted', [([extracted(p) for p in i], [extracted(p) for p in m])
+                                      for i, m in sources[0][1]]))
+
+    for name, rows in sources:
+        t = time.time()
+        parallel_map(_decode_row, rows, args.workers)
+        print '%-10s %d images with masks: %.2fs' % (name, len(rows), time.time() - t)